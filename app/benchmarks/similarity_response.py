@@ -0,0 +1,69 @@
+import argparse
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List
+import orjson
+from app.config import VECTOR_DIMENSION
+from app.db.utils import clean_elastic_response, similar_records_from_response
+from app.models.api import SimilarRecord, SimilarRecordsResponse
+
+# Compares the previous /similarities response path (full _source including the vector, pydantic models built
+# twice, response_model serialization) against the lean path on synthetic Elasticsearch responses.
+# Run with: python -m app.benchmarks.similarity_response --top-n 10 100 1000
+
+
+def fake_search_response(top_n: int, with_vector: bool) -> bytes:
+    hits = []
+    for i in range(top_n):
+        source: Dict[str, Any] = {"id": str(i), "name": f"Skill {i}", "description": "Lorem ipsum dolor sit amet",
+                                  "status": "1"}
+        if with_vector:
+            source["vector"] = [random.uniform(-1, 1) for _ in range(VECTOR_DIMENSION)]
+        hits.append({"_index": "embeddings_skills", "_id": f"doc-{i}", "_score": 1.0 - i / (top_n + 1),
+                     "_source": source})
+    return orjson.dumps({
+        "took": 5, "timed_out": False,
+        "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+        "hits": {"total": {"value": top_n, "relation": "eq"}, "max_score": 1.0, "hits": hits}
+    })
+
+
+def legacy_path(raw: bytes) -> bytes:
+    response = clean_elastic_response(json.loads(raw))
+    result = SimilarRecordsResponse(data=[])
+    for hit in response.hits.hits:
+        result.data.append(SimilarRecord(**hit.source.model_dump(), score=hit.score))
+    # FastAPI validates the returned model against response_model before serializing it
+    return SimilarRecordsResponse.model_validate(result.model_dump()).model_dump_json().encode()
+
+
+def lean_path(raw: bytes) -> bytes:
+    return orjson.dumps({"data": similar_records_from_response(orjson.loads(raw))})
+
+
+def measure(func: Callable[[bytes], bytes], raw: bytes, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(raw)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(top_ns: List[int], repeat: int) -> None:
+    print(f"{'top_n':>7} {'legacy ms':>10} {'lean ms':>10} {'speedup':>8} {'legacy KB':>10} {'lean KB':>8}")
+    for top_n in top_ns:
+        legacy_raw = fake_search_response(top_n, with_vector=True)
+        lean_raw = fake_search_response(top_n, with_vector=False)
+        assert orjson.loads(lean_path(lean_raw)) == orjson.loads(legacy_path(legacy_raw))
+        legacy_ms = measure(legacy_path, legacy_raw, repeat)
+        lean_ms = measure(lean_path, lean_raw, repeat)
+        print(f"{top_n:>7} {legacy_ms:>10.3f} {lean_ms:>10.3f} {legacy_ms / lean_ms:>7.1f}x "
+              f"{len(legacy_raw) / 1024:>10.1f} {len(lean_raw) / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the /similarities response path")
+    parser.add_argument("--top-n", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.top_n, args.repeat)
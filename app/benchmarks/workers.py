@@ -0,0 +1,94 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List
+import requests
+
+# Throughput of /similarities as the number of preloaded gunicorn workers varies, for a fixed CPU budget.
+# Starts the service with gunicorn.conf.py for every worker count, so Elasticsearch credentials must be set.
+# Run from the repository root with: python -m app.benchmarks.workers --workers 1 2 4 8 --cpu-budget 16
+
+
+def wait_until_ready(base_url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/monitoring", timeout=2).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"Service at {base_url} did not become ready within {timeout}s")
+
+
+def load(base_url: str, collection: str, clients: int, duration: float) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client() -> None:
+        nonlocal errors
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            # Unique texts, so the result cache does not answer instead of the model
+            payload = {"query": [f"python developer {uuid.uuid4().hex[:8]}"]}
+            started = time.monotonic()
+            response = session.post(f"{base_url}/collections/{collection}/similarities?top_n=5", json=payload)
+            elapsed = time.monotonic() - started
+            with lock:
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {
+        "rps": len(latencies) / duration,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+        "errors": errors
+    }
+
+
+def main(worker_counts: List[int], cpu_budget: int, clients: int, duration: float, port: int,
+         collection: str) -> None:
+    base_url = f"http://127.0.0.1:{port}/api/v1"
+    print(f"{'workers':>8} {'threads':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for workers in worker_counts:
+        # A reseed or change capture in the background would compete with the measured requests
+        env = {**os.environ, "CPU_BUDGET": str(cpu_budget), "WEB_CONCURRENCY": str(workers),
+               "BIND": f"127.0.0.1:{port}", "RESEED_ON_STARTUP": "false", "CHANGE_CAPTURE_ENABLED": "false"}
+        server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app.main:app"],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_ready(base_url, timeout=600)
+            load(base_url, collection, clients, duration=5)  # warm-up
+            result = load(base_url, collection, clients, duration)
+            print(f"{workers:>8} {max(1, cpu_budget // workers):>8} {result['rps']:>8.1f} {result['p50_ms']:>8.1f} "
+                  f"{result['p95_ms']:>8.1f} {result['errors']:>7}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark /similarities throughput against the worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--cpu-budget", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent client threads")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds measured per worker count")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--collection", default="skills")
+    args = parser.parse_args()
+    main(args.workers, args.cpu_budget, args.clients, args.duration, args.port, args.collection)
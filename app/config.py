@@ -1,3 +1,97 @@
-from typing import List
+from typing import Dict, List, Tuple
 
 VECTOR_DIMENSION = 1024
+
+MODEL_NAME = 'Alibaba-NLP/gte-large-en-v1.5'
+MODEL_REVISION = 'a0d6174973604c8ef416d9f6ed0f4c17ab32d78d'
+
+# Background model migrations: share of wall time the re-embedding may keep the CPU busy, an upper bound on
+# re-embedded documents per second and the number of names embedded per model call
+MIGRATION_CPU_BUDGET = 0.25
+MIGRATION_MAX_DOCS_PER_SECOND = 50.0
+MIGRATION_BATCH_SIZE = 32
+# Models a migration may switch to, as (name, revision) pairs. Loading a model runs the code of its repository
+# (trust_remote_code), so only pinned revisions of reviewed repositories belong here. Starting a migration also
+# requires the MIGRATION_TOKEN environment variable in the X-Migration-Token header.
+MIGRATION_ALLOWED_MODELS: List[Tuple[str, str]] = []
+# The status of a running migration is saved in Elasticsearch every MIGRATION_HEARTBEAT_SECONDS. Without a save
+# for MIGRATION_STALE_SECONDS its worker is considered gone: other workers stop dual writing and a new migration
+# of the collection may start.
+MIGRATION_HEARTBEAT_SECONDS = 10.0
+MIGRATION_STALE_SECONDS = 60.0
+
+# Similarity result cache, entries are also dropped whenever their collection's generation changes
+SIMILARITY_CACHE_MAX_ENTRIES = 10000
+SIMILARITY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SIMILARITY_CACHE_TTL_SECONDS = 600.0
+# Writes become visible to searches only after the next index refresh, results computed within this window
+# after a write are not cached
+ELASTIC_REFRESH_INTERVAL_SECONDS = 1.0
+
+# Incremental change capture from the CRM database: rows are picked up by their (updated_at, id) watermark
+CHANGE_CAPTURE_UPDATED_AT_COLUMN = 'updated_at'
+CHANGE_CAPTURE_INTERVAL_SECONDS = 5.0
+CHANGE_CAPTURE_BATCH_SIZE = 500
+CHANGE_CAPTURE_WATERMARK_FILE = 'data/change_capture_watermarks.json'
+CHANGE_CAPTURE_LOCK_FILE = 'data/change_capture.lock'
+# Without a watermark, capture starts at the seeded_at of the collection's index minus this margin for clock skew
+# between the API and the database (whose timestamps are taken to be UTC); re-applying a row is harmless
+CHANGE_CAPTURE_SEED_MARGIN_SECONDS = 300
+
+# The API reseeds Elasticsearch in the background on startup unless every collection was seeded within this age
+RESEED_MAX_AGE_SECONDS = 24 * 3600
+RESEED_STATUS_FILE = 'data/reseed_status.json'
+RESEED_LOCK_FILE = 'data/reseed.lock'
+
+# Typeahead over collection names: prefix matches come first, fuzzy trigram matches fill the remaining slots when
+# they share at least this fraction of the query's trigrams
+SUGGEST_DEFAULT_TOP_K = 10
+SUGGEST_MAX_TOP_K = 50
+SUGGEST_FUZZY_MIN_SIMILARITY = 0.6
+# Name indices take in at most this many changed records at once, larger changes rebuild them from the collection
+NAME_INDEX_MAX_CHANGES = 1000
+
+# Per-request profiling. A request is profiled on demand when it carries the PROFILING_TOKEN environment variable in
+# the X-Profile header or the profile query parameter, and automatically when it takes longer than the threshold
+# (None disables it). Profiles are kept in a ring of the newest PROFILE_RING_SIZE files.
+PROFILE_SLOW_REQUEST_SECONDS = 2.0
+PROFILE_RING_DIR = 'data/profiles'
+PROFILE_RING_SIZE = 200
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+
+# Collections whose vectors are reduced with a PCA projection fitted while seeding, e.g. {'markets': 128}. Compare
+# the top-k results against full dimension first: python -m app.db.reduction --collections markets
+VECTOR_REDUCTION_DIMENSIONS: Dict[str, int] = {}
+
+# Admission control per worker. Search and sync requests beyond MAX_CONCURRENT_REQUESTS in flight are rejected with
+# 503 up front; their embedding work runs at most EMBEDDING_MAX_CONCURRENT at a time with at most
+# EMBEDDING_MAX_QUEUED waiting, the rest is rejected with 503 as well. Every such request has a deadline, the
+# X-Request-Timeout header (seconds) capped at REQUEST_TIMEOUT_SECONDS, and is dropped once it has passed.
+MAX_CONCURRENT_REQUESTS = 64
+EMBEDDING_MAX_CONCURRENT = 1
+EMBEDDING_MAX_QUEUED = 32
+REQUEST_TIMEOUT_SECONDS = 30.0
+
+# Near-duplicate detection: records are grouped when their stored vectors have at least this cosine similarity.
+# All pairs are compared DEDUPE_BLOCK_SIZE rows at a time (block x collection float32 scores in memory) and at most
+# DEDUPE_TOP_K matches are kept per record and block.
+DEDUPE_DEFAULT_THRESHOLD = 0.92
+DEDUPE_TOP_K = 10
+DEDUPE_BLOCK_SIZE = 256
+
+# CRM database (MySQL on Azure). Pooled connections idle longer than DB_POOL_RECYCLE_SECONDS are dropped before the
+# Azure gateway silently closes them, connections idle longer than DB_HEALTH_CHECK_IDLE_SECONDS are pinged before
+# use. Reads failing with a connection error are retried DB_QUERY_RETRIES times with exponential backoff.
+DB_POOL_MIN_SIZE = 1
+DB_POOL_RECYCLE_SECONDS = 180
+DB_HEALTH_CHECK_IDLE_SECONDS = 30.0
+DB_CONNECT_TIMEOUT_SECONDS = 10
+DB_QUERY_TIMEOUT_SECONDS = 120.0
+DB_QUERY_RETRIES = 3
+DB_RETRY_BACKOFF_SECONDS = 0.5
+
+# Replicas on other hosts only learn about writes through Elasticsearch: one worker per host polls the indexing
+# counters of every alias at this interval and bumps the local generation when they moved, so other replicas serve
+# cached results at most about this long after a write (SIMILARITY_CACHE_TTL_SECONDS if polling fails). None disables.
+GENERATION_SYNC_INTERVAL_SECONDS = 2.0
+GENERATION_SYNC_LOCK_FILE = 'data/generation_sync.lock'
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from app.config import (CHANGE_CAPTURE_UPDATED_AT_COLUMN, CHANGE_CAPTURE_INTERVAL_SECONDS, CHANGE_CAPTURE_BATCH_SIZE,
+                        CHANGE_CAPTURE_WATERMARK_FILE, CHANGE_CAPTURE_LOCK_FILE)
+from app.db.collection_manager import CollectionManager
+from app.db.crm_db import crm_db, row_to_record
+from app.db.elastic import Elastic
+from app.db.migration import get_dual_writer
+from app.db.seed_elastic import get_record_keys, seed_watermark
+from app.models.api import RecordCreateReplace
+from app.modules.generations import bump_generation
+from app.utils import write_json_atomic, try_lock_file
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def rewind_watermark(watermark: Dict[str, Any], seeded_at: Optional[str]) -> Dict[str, Any]:
+    # A watermark belongs to the index seeded at its seeded_at. Once a reseed or snapshot import replaced that index,
+    # rows captured into the old one after the new one's table read are missing from it and are captured again.
+    if not seeded_at or watermark.get("seeded_at") == seeded_at:
+        return watermark
+    since = seed_watermark(seeded_at)
+    if isinstance(watermark["updated_at"], str) and datetime.fromisoformat(watermark["updated_at"]) <= since:
+        return {**watermark, "seeded_at": seeded_at}
+    return {"updated_at": since.isoformat(), "id": None, "seeded_at": seeded_at}
+
+
+class ChangeCapture:
+    # Polls every mapped CRM table for rows changed after a persisted (updated_at, id) watermark and applies only
+    # those rows to the collection through one _bulk request per batch. Hard deletes are not visible to polling
+    # and still reach the index through /sync or a reseed.
+    def __init__(self, es: Elastic, watermark_file: str = CHANGE_CAPTURE_WATERMARK_FILE,
+                 updated_at_column: str = CHANGE_CAPTURE_UPDATED_AT_COLUMN,
+                 batch_size: int = CHANGE_CAPTURE_BATCH_SIZE, interval: float = CHANGE_CAPTURE_INTERVAL_SECONDS):
+        self.es = es
+        self.watermark_file = watermark_file
+        self.updated_at_column = updated_at_column
+        self.batch_size = batch_size
+        self.interval = interval
+        self.tables = CollectionManager().get_used_collections()
+        self.record_keys = get_record_keys()
+        self.watermarks: Dict[str, Dict[str, Any]] = self.load_watermarks()
+
+    def load_watermarks(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(self.watermark_file):
+            return {}
+        with open(self.watermark_file, 'r') as file:
+            return json.load(file)
+
+    def save_watermarks(self) -> None:
+        write_json_atomic(self.watermark_file, self.watermarks)
+
+    def _set_watermark(self, table: str, row: Dict[str, Any]) -> None:
+        updated_at = row[self.updated_at_column]
+        self.watermarks[table] = {
+            "updated_at": updated_at.isoformat() if isinstance(updated_at, datetime) else updated_at,
+            "id": row[self.record_keys[0]],
+            "seeded_at": self.watermarks.get(table, {}).get("seeded_at")
+        }
+
+    async def _initialize_watermark(self, table: str) -> None:
+        # Without a watermark, rows changed since the index was seeded are captured; the seed may be a day old
+        seeded_at = (await self.es.get_index_meta(self.tables[table])).get('seeded_at')
+        if seeded_at:
+            self.watermarks[table] = {"updated_at": seed_watermark(seeded_at).isoformat(), "id": None,
+                                      "seeded_at": seeded_at}
+        else:
+            logger.warning(f"Index of {table} has no seeded_at, change capture starts at its newest row")
+            row = await crm_db.query_watermark(table, self.record_keys[0], self.updated_at_column)
+            if not row:
+                return
+            self._set_watermark(table, row)
+        self.save_watermarks()
+        logger.info(f"Initialized change capture watermark of {table} at {self.watermarks[table]}")
+
+    async def _fetch_changes(self, table: str) -> List[Dict[str, Any]]:
+        if table not in self.watermarks:
+            await self._initialize_watermark(table)
+            if table not in self.watermarks:
+                return []
+        seeded_at = (await self.es.get_cached_index_meta(self.tables[table])).get('seeded_at')
+        watermark = rewind_watermark(self.watermarks[table], seeded_at)
+        if watermark != self.watermarks[table]:
+            logger.info(f"Index of {table} was seeded again at {seeded_at}, change capture continues from "
+                        f"{watermark['updated_at']}")
+            self.watermarks[table] = watermark
+            self.save_watermarks()
+        since = watermark["updated_at"]
+        if isinstance(since, str):
+            since = datetime.fromisoformat(since)
+        return await crm_db.query_changes(table, self.record_keys, self.updated_at_column, since, watermark["id"],
+                                          self.batch_size)
+
+    async def capture_table(self, table: str, alias: str) -> int:
+        applied = 0
+        while True:
+            rows = await self._fetch_changes(table)
+            if not rows:
+                break
+            records = [row_to_record(row, self.record_keys) for row in rows]
+            applied += await self.es.bulk_upsert_records(alias, records)
+            bump_generation(alias, [record.id for record in records])
+            dual_writer = await get_dual_writer(self.es, alias)
+            if dual_writer:
+                for record in records:
+                    await dual_writer.dual_write(RecordCreateReplace(method='PUT', **record.model_dump()))
+            self._set_watermark(table, rows[-1])
+            self.save_watermarks()
+            if len(rows) < self.batch_size:
+                break
+        if applied:
+            logger.info(f"Captured {applied} changed records of {table} into '{alias}'")
+        return applied
+
+    async def run_once(self) -> Dict[str, int]:
+        applied: Dict[str, int] = {}
+        for table, alias in self.tables.items():
+            try:
+                applied[table] = await self.capture_table(table, alias)
+            except Exception as e:
+                logger.error(f"Change capture of {table} failed: {e}", exc_info=True)
+        return applied
+
+    async def run_forever(self) -> None:
+        # Every API worker may run this loop, the lock lets one process per host poll and another one takes over
+        # when it exits. The watermarks are read again on taking over, the previous holder has moved them.
+        lock_fd: Optional[int] = None
+        try:
+            while True:
+                if lock_fd is None:
+                    lock_fd = try_lock_file(CHANGE_CAPTURE_LOCK_FILE)
+                    if lock_fd is not None:
+                        self.watermarks = self.load_watermarks()
+                        logger.info(f"Change capture started for {list(self.tables.keys())}, "
+                                    f"polling every {self.interval}s")
+                if lock_fd is not None:
+                    await self.run_once()
+                await asyncio.sleep(self.interval)
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+
+
+async def run_change_capture(once: bool = False, interval: Optional[float] = None) -> None:
+    es = Elastic()
+    try:
+        change_capture = ChangeCapture(es, interval=interval or CHANGE_CAPTURE_INTERVAL_SECONDS)
+        if once:
+            lock_fd = try_lock_file(CHANGE_CAPTURE_LOCK_FILE)
+            if lock_fd is None:
+                logger.info("Change capture is running in another process")
+                return
+            try:
+                await change_capture.run_once()
+            finally:
+                os.close(lock_fd)
+        else:
+            await change_capture.run_forever()
+    finally:
+        await es.client.close()
+        await crm_db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply CRM rows changed since the last watermark to the indices")
+    parser.add_argument("--once", action="store_true", help="Run a single capture pass and exit")
+    parser.add_argument("--interval", type=float, help="Seconds between capture passes")
+    args = parser.parse_args()
+    asyncio.run(run_change_capture(once=args.once, interval=args.interval))
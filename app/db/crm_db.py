@@ -1,7 +1,14 @@
+import asyncio
 import os
-import mysql.connector
-from typing import List, Any, Optional
+import ssl
+import time
+from contextlib import asynccontextmanager
+from typing import List, Any, Optional, Dict, AsyncIterator, Sequence
+import aiomysql
+import pymysql
 from dotenv import load_dotenv
+from app.config import (DB_POOL_MIN_SIZE, DB_POOL_RECYCLE_SECONDS, DB_HEALTH_CHECK_IDLE_SECONDS,
+                        DB_CONNECT_TIMEOUT_SECONDS, DB_QUERY_TIMEOUT_SECONDS, DB_QUERY_RETRIES, DB_RETRY_BACKOFF_SECONDS)
 from app.db.collection_manager import CollectionManager
 from app.models.api import RecordInDb, StatusEnum
 from app.logs.logger import get_logger
@@ -9,76 +16,173 @@ from app.logs.logger import get_logger
 logger = get_logger(__name__)
 load_dotenv()
 
+# Table names cannot be query parameters, only these are ever formatted into a query
+CRM_TABLES = frozenset(CollectionManager().get_used_collections())
 
-class MySQLConnection:
-    def __init__(self):
-        config = {
-            'user': os.getenv('DB_USERNAME'),
-            'password': os.getenv('DB_PASSWORD'),
-            'host': os.getenv('DB_HOST'),
-            'database': os.getenv('DB_DATABASE'),
-            'port': int(os.getenv('DB_PORT', 3306))
-        }
-        try:
-            db = mysql.connector.connect(**config)
-            self.db = db
-            logger.info("Connection successful")
-        except mysql.connector.Error as error:
-            logger.info("Error in database connection:", error)
-
-    def __enter__(self):
-        return self.db
-
-    def __exit__(self):
-        if self.db:
-            self.db.close()
-
-    def query_db(self, table_name: str, col_names: List[str]) -> Optional[List[RecordInDb]]:
-        if not self.db:
-            logger.error("No database connection")
-            return None
-
-        # Validate table name against MAPPING.keys()
-        if not self._is_valid_table_name(table_name):
-            logger.error(f"Invalid table name: {table_name}")
-            return None
-
-        cursor = self.db.cursor(dictionary=True)
+# Connection-level errors: too many connections, refused, gone away and lost connections. Errors of the query
+# itself, including hitting DB_QUERY_TIMEOUT_SECONDS, would most likely fail again and are not retried.
+TRANSIENT_ERROR_CODES = frozenset([1040, 2003, 2006, 2013])
+
+
+def db_config() -> Dict[str, Any]:
+    config = {
+        'user': os.getenv('DB_USERNAME'),
+        'password': os.getenv('DB_PASSWORD'),
+        'host': os.getenv('DB_HOST'),
+        'db': os.getenv('DB_DATABASE'),
+        'port': int(os.getenv('DB_PORT', 3306))
+    }
+    # Azure requires TLS; DB_SSL=false for a local server without it
+    if os.getenv('DB_SSL', 'true').lower() == 'true':
+        config['ssl'] = ssl.create_default_context(cafile=os.getenv('DB_SSL_CA'))
+    return config
+
+
+def row_to_record(result: Dict[str, Any], col_names: List[str]) -> RecordInDb:
+    return RecordInDb(
+        id=str(result[col_names[0]]),
+        name=result[col_names[1]],
+        description=result[col_names[2]],
+        status=StatusEnum(str(result[col_names[3]])) if result[col_names[3]] else None
+    )
+
+
+def validate_table_name(table_name: str) -> None:
+    if table_name not in CRM_TABLES:
+        raise ValueError(f"Invalid table name: {table_name}")
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, pymysql.err.InterfaceError)):
+        return True
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) and \
+        error.args[0] in TRANSIENT_ERROR_CODES
+
+
+class CrmDatabase:
+    # Pool of async connections to the CRM database shared by seeding and change capture. Every read is a single
+    # autocommitted SELECT, so it sees the latest committed rows and can be retried on another connection.
+    def __init__(self, max_size: int = int(os.getenv('DB_POOL_SIZE', 5))):
+        self.max_size = max_size
+        self.pool: Optional[aiomysql.Pool] = None
+        self.pool_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.pool_lock = asyncio.Lock()
+        self.queries = 0
+        self.retries = 0
+        self.failures = 0
+        self.pings = 0
+
+    async def get_pool(self) -> aiomysql.Pool:
+        async with self.pool_lock:
+            # A pool belongs to the event loop it was created in (the CLIs run one loop each)
+            if self.pool is None or self.pool_loop is not asyncio.get_running_loop():
+                self.pool = await aiomysql.create_pool(minsize=DB_POOL_MIN_SIZE, maxsize=self.max_size,
+                                                       pool_recycle=DB_POOL_RECYCLE_SECONDS,
+                                                       connect_timeout=DB_CONNECT_TIMEOUT_SECONDS, autocommit=True,
+                                                       **db_config())
+                self.pool_loop = asyncio.get_running_loop()
+                logger.info(f"Created CRM database connection pool of up to {self.max_size} connections")
+            return self.pool
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[aiomysql.Connection]:
+        pool = await self.get_pool()
+        connection = await pool.acquire()
         try:
-            col_names_str = ', '.join([f"{col}" for col in col_names])
-            query = f"SELECT {col_names_str} FROM {table_name}"
-            cursor.execute(query)
-            results: List[Any] = cursor.fetchall()
-            records = [
-                RecordInDb(
-                    id=str(result[col_names[0]]),
-                    name=result[col_names[1]],
-                    description=result[col_names[2]],
-                    status=StatusEnum(str(result[col_names[3]])) if result[col_names[3]] else None
-                ) for result in results
-            ]
-            return records
-        except mysql.connector.Error as error:
-            logger.error("Error querying database:", error)
-            return []
+            # A connection idle for a while may have been dropped by the network without notice
+            if asyncio.get_running_loop().time() - connection.last_usage > DB_HEALTH_CHECK_IDLE_SECONDS:
+                self.pings += 1
+                await connection.ping(reconnect=True)
+            yield connection
+        except BaseException:
+            # A query failed or was cancelled halfway, the connection is closed instead of going back to the pool
+            connection.close()
+            raise
         finally:
-            cursor.close()
+            pool.release(connection)
+
+    async def fetch_all(self, query: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        attempt = 0
+        while True:
+            try:
+                self.queries += 1
+                async with self.connection() as connection:
+                    async with connection.cursor(aiomysql.DictCursor) as cursor:
+                        await asyncio.wait_for(cursor.execute(query, params), DB_QUERY_TIMEOUT_SECONDS)
+                        return await cursor.fetchall()
+            except Exception as e:
+                if not is_transient(e) or attempt == DB_QUERY_RETRIES:
+                    self.failures += 1
+                    logger.error(f"Error querying database: {e!r}")
+                    raise
+                self.retries += 1
+                delay = DB_RETRY_BACKOFF_SECONDS * 2 ** attempt
+                logger.warning(f"Transient database error {e!r}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def query_table(self, table_name: str, col_names: List[str]) -> List[RecordInDb]:
+        validate_table_name(table_name)
+        col_names_str = ', '.join([f"{col}" for col in col_names])
+        results = await self.fetch_all(f"SELECT {col_names_str} FROM {table_name}")
+        return [row_to_record(result, col_names) for result in results]
+
+    async def query_changes(self, table_name: str, col_names: List[str], updated_at_column: str, since: Any,
+                            last_id: Any, limit: int) -> List[Dict[str, Any]]:
+        # Rows changed after the (updated_at, id) watermark, in watermark order
+        validate_table_name(table_name)
+        col_names_str = ', '.join([f"{col}" for col in col_names + [updated_at_column]])
+        query = (f"SELECT {col_names_str} FROM {table_name} "
+                 f"WHERE {updated_at_column} > %s OR ({updated_at_column} = %s AND {col_names[0]} > %s) "
+                 f"ORDER BY {updated_at_column}, {col_names[0]} LIMIT %s")
+        return await self.fetch_all(query, (since, since, last_id, limit))
+
+    async def query_watermark(self, table_name: str, id_column: str,
+                              updated_at_column: str) -> Optional[Dict[str, Any]]:
+        validate_table_name(table_name)
+        rows = await self.fetch_all(f"SELECT {updated_at_column}, {id_column} FROM {table_name} "
+                                    f"ORDER BY {updated_at_column} DESC, {id_column} DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    async def query_ids(self, table_name: str, id_column: str) -> List[str]:
+        validate_table_name(table_name)
+        rows = await self.fetch_all(f"SELECT {id_column} FROM {table_name}")
+        return [str(row[id_column]) for row in rows]
+
+    async def list_tables(self) -> List[str]:
+        rows = await self.fetch_all("SELECT table_name AS name FROM information_schema.tables WHERE table_schema = %s",
+                                    (db_config()['db'],))
+        return [row['name'] for row in rows]
 
-    @staticmethod
-    def _is_valid_table_name(table_name: str) -> bool:
-        collection_manager = CollectionManager()
-        return table_name in collection_manager.get_used_collections().keys()
+    async def health_check(self) -> Dict[str, Any]:
+        # A single attempt bounded by the connect timeout, also while seeding holds every pooled connection
+        async def ping() -> None:
+            async with self.connection() as connection:
+                await connection.ping(reconnect=False)
 
-    def list_tables(self) -> List[str]:
-        cursor = self.db.cursor()
+        start = time.perf_counter()
         try:
-            query = "SELECT table_name FROM information_schema.tables WHERE table_schema = %s"
-            cursor.execute(query)
-            tables = [row[0] for row in cursor.fetchall()]  # type: ignore
-            return tables  # type: ignore
-        except mysql.connector.Error as error:
-            logger.error("Error in listing tables:", error)
-            return []
-        finally:
-            if cursor:
-                cursor.close()
+            await asyncio.wait_for(ping(), DB_CONNECT_TIMEOUT_SECONDS)
+            return {"status": "success", "latency_ms": round((time.perf_counter() - start) * 1000, 3)}
+        except Exception as e:
+            return {"status": f"an error has occurred while connecting to the CRM database: {e}"}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pool_size": self.pool.size if self.pool else 0,
+            "pool_free": self.pool.freesize if self.pool else 0,
+            "pool_max_size": self.max_size,
+            "queries": self.queries,
+            "retries": self.retries,
+            "failures": self.failures,
+            "pings": self.pings
+        }
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+
+crm_db = CrmDatabase()
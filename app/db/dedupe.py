@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional
+from app.config import DEDUPE_DEFAULT_THRESHOLD, DEDUPE_TOP_K, DEDUPE_BLOCK_SIZE
+from app.db.collection_manager import CollectionManager
+from app.db.elastic import Elastic
+from app.modules.near_duplicates import duplicate_clusters
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+# One report at a time per worker, each holds the collection's vectors and a block of scores in memory
+dedupe_lock = asyncio.Lock()
+
+
+async def find_duplicates(es: Elastic, index_name: str, threshold: float = DEDUPE_DEFAULT_THRESHOLD,
+                          top_k: int = DEDUPE_TOP_K, block_size: int = DEDUPE_BLOCK_SIZE) -> Dict[str, Any]:
+    # Compares the stored vectors, nothing is embedded
+    async with dedupe_lock:
+        start = time.perf_counter()
+        records, vectors = await es.record_vectors(index_name)
+        loaded = time.perf_counter()
+        clusters = await asyncio.to_thread(duplicate_clusters, records, vectors, threshold, top_k, block_size)
+        logger.info(f"Found {len(clusters)} near-duplicate clusters among {len(records)} records of '{index_name}' "
+                    f"in {time.perf_counter() - start:.1f} s ({loaded - start:.1f} s loading vectors)")
+        return {
+            "records": len(records),
+            "threshold": threshold,
+            "duplicates": sum(cluster["size"] for cluster in clusters),
+            "clusters": clusters
+        }
+
+
+async def report(collection: str, threshold: float, top_k: int, block_size: int, output: Optional[str]) -> None:
+    mapping = CollectionManager().get_used_collections()
+    es = Elastic()
+    try:
+        result = await find_duplicates(es, mapping[collection], threshold, top_k, block_size)
+    finally:
+        await es.client.close()
+    if output:
+        with open(output, 'w') as file:
+            json.dump(result, file, indent=2, ensure_ascii=False)
+        print(f"{collection}: {len(result['clusters'])} clusters, {result['duplicates']} of {result['records']} "
+              f"records, written to {output}")
+        return
+    for cluster in result["clusters"]:
+        print(f"{cluster['min_score']:.3f}  " + " | ".join(f"{record['name']} ({record['id']})"
+                                                        for record in cluster["records"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report clusters of near-duplicate records of a collection")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--threshold", type=float, default=DEDUPE_DEFAULT_THRESHOLD,
+                        help="Minimum cosine similarity of two records in the same cluster")
+    parser.add_argument("--top-k", type=int, default=DEDUPE_TOP_K, help="Matches kept per record and block")
+    parser.add_argument("--block-size", type=int, default=DEDUPE_BLOCK_SIZE)
+    parser.add_argument("--output", help="Write the report as JSON to this file instead of printing the clusters")
+    args = parser.parse_args()
+    asyncio.run(report(args.collection, args.threshold, args.top_k, args.block_size, args.output))
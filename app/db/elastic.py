@@ -1,14 +1,22 @@
 import os
 import sys
 import aiohttp
-from typing import List, Dict, Any, Optional
+import numpy as np
+from typing import List, Dict, Any, Optional, Iterable, AsyncIterator, Tuple, Callable
 from dotenv import load_dotenv
 from elasticsearch import AsyncElasticsearch, NotFoundError, ApiError
-from app.config import VECTOR_DIMENSION as DIMENSION
-from app.modules.embedding_model import get_embedding
+from elasticsearch.helpers import async_bulk, async_scan
+from elastic_transport import AiohttpHttpNode
+from app.config import VECTOR_DIMENSION as DIMENSION, MODEL_NAME, MODEL_REVISION, ELASTIC_REFRESH_INTERVAL_SECONDS
+from app.modules.embedding_model import get_embedding, evict_models
+from app.modules.generations import get_generation, seconds_since_bump, count_local_writes
+from app.modules.profiling import span
+from app.modules.projection import Projection
+from app.db.collection_manager import PREFIX
 from app.models.api import RecordCreateReplace, RecordDelete, RecordPatch, RecordInDb
 from app.models.elastic import ElasticSearchResponse, Hit
-from app.db.utils import clean_elastic_response, elastic_search_response_is_empty
+from app.db.utils import (clean_elastic_response, elastic_search_response_is_empty, similar_records_from_response,
+                          SIMILAR_RECORD_FIELDS, SIMILAR_RECORD_FILTER_PATH)
 from app.logs.logger import get_logger
 
 logger = get_logger(__name__)
@@ -18,17 +26,49 @@ load_dotenv()
 ELASTICSEARCH_CLOUD_ID = os.getenv('ELASTICSEARCH_CLOUD_ID')
 ELASTICSEARCH_API_KEY = os.getenv('ELASTICSEARCH_API_KEY')
 
+# _meta of each index or alias (model it was embedded with, projection of reduced collections) with the index it was
+# read from, re-read whenever the collection generation changes (alias swaps bump it in every worker)
+index_metas: Dict[str, Tuple[int, str, Dict[str, Any]]] = {}
+# Writes that embed are retried this many times when the alias moves to another index while they run
+ALIAS_WRITE_ATTEMPTS = 3
+# Projections of reduced indices by id; a projection never changes once its index is created
+projections: Dict[str, Projection] = {}
+PROJECTIONS_INDEX = f"{PREFIX}projections"
+
+
+def model_of(meta: Dict[str, Any]) -> Tuple[str, str]:
+    # Indices created before the model was recorded were embedded with the configured model
+    return meta.get('model_name', MODEL_NAME), meta.get('model_revision', MODEL_REVISION)
+
+
+class AliasMoved(Exception):
+    pass
+
+
+class ProfiledNode(AiohttpHttpNode):
+    # Every Elasticsearch request shows up as its own span in profiled requests
+    async def perform_request(self, method: str, target: str, *args: Any, **kwargs: Any) -> Any:
+        with span(f"elasticsearch {method} {target.split('?')[0]}"):
+            return await super().perform_request(method, target, *args, **kwargs)
+
 
 class Elastic:
     def __init__(self):
         self.client = AsyncElasticsearch(cloud_id=ELASTICSEARCH_CLOUD_ID,
-                                         api_key=ELASTICSEARCH_API_KEY)
+                                         api_key=ELASTICSEARCH_API_KEY,
+                                         node_class=ProfiledNode)
 
-    async def create_index(self, index_name: str, vector_dim: int = DIMENSION) -> None:
+    async def create_index(self, index_name: str, vector_dim: int = DIMENSION, model_name: str = MODEL_NAME,
+                           model_revision: str = MODEL_REVISION, meta: Optional[Dict[str, Any]] = None) -> None:
         try:
             if not await self.client.indices.exists(index=index_name):
                 mapping = {
                     "mappings": {
+                        "_meta": {
+                            **(meta or {}),
+                            "model_name": model_name,
+                            "model_revision": model_revision
+                        },
                         "properties": {
                             "id": {"type": "keyword"},
                             "name": {"type": "text"},
@@ -42,26 +82,219 @@ class Elastic:
                     }
                 }
                 await self.client.indices.create(index=index_name, body=mapping)
-                logger.info(f"Index '{index_name}' created with vector dimension {vector_dim}")
+                logger.info(f"Index '{index_name}' created with vector dimension {vector_dim} "
+                            f"for model {model_name}@{model_revision}")
             else:
                 logger.info(f"Index '{index_name}' already exists")
         except Exception as e:
             logger.error(f"Error creating index '{index_name}': {e}", exc_info=True)
             raise e
 
-    async def populate_es(self, index_name: str, data: List[RecordInDb]) -> None:
-        for item in data:
+    async def read_index_meta(self, index_name: str) -> Tuple[str, Dict[str, Any]]:
+        # The index an alias points to (an index is its own) and its _meta
+        response = await self.client.indices.get_mapping(index=index_name)
+        index, mapping = next(iter(response.items()))
+        return index, mapping['mappings'].get('_meta', {})
+
+    async def get_index_meta(self, index_name: str) -> Dict[str, Any]:
+        return (await self.read_index_meta(index_name))[1]
+
+    async def resolve_index(self, index_name: str) -> str:
+        try:
+            response = await self.client.indices.get_alias(name=index_name)
+        except NotFoundError:
+            return index_name
+        return next(iter(response))
+
+    async def get_cached_index_meta(self, index_name: str, index: Optional[str] = None) -> Dict[str, Any]:
+        # Writes pass the index they resolved the alias to. An alias swap on another host reaches this host's
+        # generation only with the next poll, so a meta read from another index is read again, and AliasMoved raised
+        # if the alias points elsewhere by then.
+        generation = get_generation(index_name)
+        cached = index_metas.get(index_name)
+        if cached is None or cached[0] != generation or (index is not None and cached[1] != index):
+            previous = cached
+            cached = (generation, *await self.read_index_meta(index_name))
+            index_metas[index_name] = cached
+            if previous is not None and model_of(previous[2]) != model_of(cached[2]):
+                # The alias was switched to another model, the previous one may not be used anymore
+                from app.db.migration import models_in_use  # migration imports this module
+                evict_models(models_in_use())
+        if index is not None and cached[1] != index:
+            raise AliasMoved(f"'{index_name}' no longer points to {index}")
+        return cached[2]
+
+    async def get_index_model(self, index_name: str) -> Tuple[str, str]:
+        return model_of(await self.get_cached_index_meta(index_name))
+
+    async def save_projection(self, projection_id: str, projection: Projection) -> None:
+        if not await self.client.indices.exists(index=PROJECTIONS_INDEX):
+            # The matrices are only stored, never searched
+            await self.client.indices.create(index=PROJECTIONS_INDEX, body={
+                "mappings": {"properties": {"projection": {"type": "object", "enabled": False}}}
+            })
+        await self.client.index(index=PROJECTIONS_INDEX, id=projection_id, document=projection.to_doc(),
+                                refresh='wait_for')
+        logger.info(f"Saved {projection.source_dimension} -> {projection.dimension} projection '{projection_id}' "
+                    f"({projection.explained_variance:.1%} of the variance)")
+
+    async def load_projection(self, projection_id: str) -> Projection:
+        response = await self.client.get(index=PROJECTIONS_INDEX, id=projection_id)
+        return Projection.from_doc(response['_source'])
+
+    async def delete_projection(self, projection_id: str) -> None:
+        projections.pop(projection_id, None)
+        try:
+            await self.client.delete(index=PROJECTIONS_INDEX, id=projection_id)
+        except NotFoundError:
+            pass
+
+    async def get_index_projection(self, index_name: str) -> Optional[Projection]:
+        return await self.get_projection(await self.get_cached_index_meta(index_name))
+
+    async def get_projection(self, meta: Dict[str, Any]) -> Optional[Projection]:
+        projection_id = meta.get('projection')
+        if projection_id is None:
+            return None
+        if projection_id not in projections:
+            # Projections of indices no alias points to anymore are dropped
+            in_use = {meta.get('projection') for _, _, meta in index_metas.values()}
+            for unused in [cached for cached in projections if cached not in in_use]:
+                del projections[unused]
+            projections[projection_id] = await self.load_projection(projection_id)
+        return projections[projection_id]
+
+    async def embed(self, index_name: str, texts: List[str], index: Optional[str] = None) -> List[List[float]]:
+        # With index, the texts are embedded for that index behind the alias (see get_cached_index_meta)
+        meta = await self.get_cached_index_meta(index_name, index)
+        vectors = await get_embedding(texts, *model_of(meta))
+        # Reduced collections store projected vectors, queries and writes are projected the same way
+        projection = await self.get_projection(meta)
+        return projection.apply(vectors).tolist() if projection else vectors
+
+    async def populate_es(self, index_name: str, data: List[RecordInDb], batch_size: int = 32,
+                          progress: Optional[Callable[[int], None]] = None,
+                          vectors: Optional[List[List[float]]] = None) -> None:
+        # Records are embedded and indexed batch by batch, so a reseed running next to live traffic only holds
+        # the model for one batch at a time. Precomputed vectors (one per record) are indexed as they are.
+        for start in range(0, len(data), batch_size):
+            batch = data[start:start + batch_size]
             try:
-                vector = await get_embedding([item.name])
-                doc = {
-                    **item.model_dump(),
-                    'vector': vector[0]
-                }
-                await self.client.index(index=index_name, document=doc)
+                if vectors is not None:
+                    batch_vectors = vectors[start:start + batch_size]
+                else:
+                    batch_vectors = await self.embed(index_name, [item.name for item in batch])
+                actions = ({"_index": index_name, "_source": {**item.model_dump(), 'vector': vector}}
+                           for item, vector in zip(batch, batch_vectors))
+                _, errors = await async_bulk(self.client, actions, raise_on_error=False)
+                for error in errors:  # type: ignore
+                    logger.error(f"Error indexing document: {error}")
             except Exception as e:
-                logger.error(f"Error indexing document {item.id}: {e}")
+                logger.error(f"Error indexing documents {[item.id for item in batch]}: {e}")
+            if progress:
+                progress(len(batch))
         logger.info(f"Data populated in index '{index_name}'")
 
+    async def bulk_index(self, index_name: str, docs: Iterable[Dict[str, Any]], chunk_size: int = 500) -> int:
+        # Refresh is disabled while loading and the index is refreshed once at the end
+        await self.client.indices.put_settings(index=index_name, body={"index": {"refresh_interval": "-1"}})
+        try:
+            actions = ({"_index": index_name, "_source": doc} for doc in docs)
+            indexed, errors = await async_bulk(self.client, actions, chunk_size=chunk_size, raise_on_error=False)
+            if errors:
+                logger.error(f"{len(errors)} documents failed to index into '{index_name}', first error: {errors[0]}")
+            logger.info(f"Bulk indexed {indexed} documents into '{index_name}'")
+            return indexed
+        finally:
+            await self.client.indices.put_settings(index=index_name, body={"index": {"refresh_interval": None}})
+            await self.client.indices.refresh(index=index_name)
+
+    async def bulk_upsert_records(self, index_name: str, records: List[RecordInDb]) -> int:
+        # Creates or replaces records by their CRM id in one _bulk request. Records whose name did not change keep
+        # their stored vector, only the others are embedded (in a single model call).
+        if not records:
+            return 0
+        # Written into the index the alias points to with vectors embedded for it, again if the alias moved meanwhile
+        for _ in range(ALIAS_WRITE_ATTEMPTS):
+            index = await self.resolve_index(index_name)
+            query: Any = {
+                "size": len(records) * 2,
+                "_source": ["id", "name"],
+                "query": {"terms": {"id": [record.id for record in records]}}
+            }
+            response = await self.client.search(index=index, body=query)
+            existing = {hit['_source']['id']: hit for hit in response['hits']['hits']}
+
+            to_embed = [record for record in records
+                        if record.id not in existing or existing[record.id]['_source'].get('name') != record.name]
+            try:
+                vectors = await self.embed(index_name, [record.name for record in to_embed], index) if to_embed else []
+            except AliasMoved:
+                continue
+            embedded = {record.id: vector for record, vector in zip(to_embed, vectors)}
+
+            actions: List[Dict[str, Any]] = []
+            for record in records:
+                doc = record.model_dump(mode='json')
+                hit = existing.get(record.id)
+                if record.id in embedded:
+                    action: Dict[str, Any] = {"_op_type": "index", "_index": index,
+                                              "_source": {**doc, 'vector': embedded[record.id]}}
+                    if hit:
+                        action["_id"] = hit['_id']
+                else:
+                    # Never a noop, so every successful action is one indexing operation (see count_local_writes)
+                    action = {"_op_type": "update", "_index": index, "_id": hit['_id'], "doc": doc,  # type: ignore
+                              "detect_noop": False}
+                actions.append(action)
+
+            applied, errors = await async_bulk(self.client, actions, raise_on_error=False)
+            if await self.resolve_index(index_name) != index:
+                logger.warning(f"Alias '{index_name}' moved from {index} while upserting {len(records)} records")
+                continue
+            count_local_writes(index_name, indexed=applied)
+            if errors:
+                logger.error(f"{len(errors)} records failed to upsert into '{index_name}', first error: {errors[0]}")
+            logger.info(f"Upserted {applied} records into '{index_name}', {len(to_embed)} of them re-embedded")
+            return applied
+        raise AliasMoved(f"'{index_name}' moved to another index during each of {ALIAS_WRITE_ATTEMPTS} attempts to "
+                         f"upsert {len(records)} records")
+
+    async def scan_records(self, index_name: str, fields: Optional[List[str]] = None, batch_size: int = 1000,
+                           scroll: str = "5m", ids: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        query: Dict[str, Any] = {"query": {"terms": {"id": ids}} if ids is not None else {"match_all": {}}}
+        if fields is not None:
+            query["_source"] = fields
+        async for hit in async_scan(self.client, index=index_name, query=query, size=batch_size, scroll=scroll):
+            yield hit
+
+    async def name_records(self, index_name: str, ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        # Source for the in-memory name index, all records or those with the given ids. Right after a write the
+        # index is refreshed first, otherwise the scan could miss the write and the name index would be built for
+        # a generation it does not reflect.
+        if seconds_since_bump(index_name) < ELASTIC_REFRESH_INTERVAL_SECONDS:
+            await self.client.indices.refresh(index=index_name)
+        return [hit["_source"] async for hit in self.scan_records(index_name, fields=SIMILAR_RECORD_FIELDS, ids=ids)]
+
+    async def record_vectors(self, index_name: str, batch_size: int = 1000) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+        # Ids, names and stored vectors of the whole index. Vectors are converted to float32 a scroll page at a time,
+        # so a large collection never exists as a list of Python floats.
+        records: List[Dict[str, Any]] = []
+        pages: List[np.ndarray] = []
+        page: List[List[float]] = []
+        async for hit in self.scan_records(index_name, fields=["id", "name", "vector"], batch_size=batch_size):
+            source = hit["_source"]
+            if source.get("vector") is None:
+                continue
+            records.append({"id": source["id"], "name": source["name"]})
+            page.append(source["vector"])
+            if len(page) == batch_size:
+                pages.append(np.asarray(page, dtype=np.float32))
+                page = []
+        if page:
+            pages.append(np.asarray(page, dtype=np.float32))
+        return records, np.vstack(pages) if pages else np.empty((0, 0), dtype=np.float32)
+
     async def find_record_by_doc_id(self, index_name: str, doc_id: str) -> Optional[Hit]:
         try:
             response = await self.client.get(index=index_name, id=doc_id)
@@ -84,21 +317,26 @@ class Elastic:
             logger.error(f"Error querying index '{index_name}' for query '{query}': {e}")
             return None
 
-    async def similarity_search(self, index_name: str, text: str, top_n: int = 1) -> Optional[ElasticSearchResponse]:
-        try:
-            query_vector = await get_embedding([text])
-            query: Any = {
-                "size": top_n,
-                "query": {
-                    "script_score": {
-                        "query": {"match_all": {}},
-                        "script": {
-                            "source": "cosineSimilarity(params.query_vector, 'vector')",
-                            "params": {"query_vector": query_vector[0]}
-                        }
+    @staticmethod
+    def similarity_query(query_vector: List[float], top_n: int) -> Dict[str, Any]:
+        return {
+            "size": top_n,
+            "_source": SIMILAR_RECORD_FIELDS,
+            "query": {
+                "script_score": {
+                    "query": {"match_all": {}},
+                    "script": {
+                        "source": "cosineSimilarity(params.query_vector, 'vector')",
+                        "params": {"query_vector": query_vector}
                     }
                 }
             }
+        }
+
+    async def similarity_search(self, index_name: str, text: str, top_n: int = 1) -> Optional[ElasticSearchResponse]:
+        try:
+            query_vector = await self.embed(index_name, [text])
+            query = self.similarity_query(query_vector[0], top_n)
             results = await self.query_es(index_name, query)
             logger.info(f"Performed similarity search for index '{index_name}' with text '{text}'")
             return results
@@ -106,46 +344,153 @@ class Elastic:
             logger.error(f"Error performing similarity search in index '{index_name}' for text: '{text}': {e}")
             return None
 
+    async def find_similar_records(self, index_name: str, texts: List[str], top_n: int = 1) -> List[
+        Optional[List[Dict[str, Any]]]]:
+        # Lean response path: one embedding call for all texts, only the record fields are fetched from
+        # Elasticsearch and hits are turned into plain dicts without building pydantic models.
+        # A failed search yields None for its text.
+        if not texts:
+            return []
+        query_vectors = await self.embed(index_name, texts)
+        results: List[Optional[List[Dict[str, Any]]]] = []
+        for text, query_vector in zip(texts, query_vectors):
+            try:
+                response = await self.client.search(index=index_name, body=self.similarity_query(query_vector, top_n),
+                                                    filter_path=SIMILAR_RECORD_FILTER_PATH)
+                results.append(similar_records_from_response(response))
+                logger.info(f"Performed similarity search for index '{index_name}' with text '{text}'")
+            except Exception as e:
+                logger.error(f"Error performing similarity search in index '{index_name}' for text: '{text}': {e}")
+                results.append(None)
+        return results
+
+    async def find_similar_records_multi(self, index_names: List[str], texts: List[str], top_n: int = 1) -> Dict[
+            str, List[Optional[List[Dict[str, Any]]]]]:
+        # Every text is embedded once per model the indices were embedded with (reduced indices project that
+        # vector themselves) and all (index, text) searches go to Elasticsearch in a single _msearch.
+        # A failed search yields None for its text.
+        models = {index_name: await self.get_index_model(index_name) for index_name in index_names}
+        vectors = {model: await get_embedding(texts, *model) for model in set(models.values())}
+        searches: List[Dict[str, Any]] = []
+        for index_name in index_names:
+            projection = await self.get_index_projection(index_name)
+            index_vectors = vectors[models[index_name]]
+            if projection:
+                index_vectors = projection.apply(index_vectors).tolist()
+            for query_vector in index_vectors:
+                searches.append({"index": index_name})
+                searches.append(self.similarity_query(query_vector, top_n))
+
+        response = await self.client.msearch(searches=searches, filter_path=[
+            "responses.hits.hits._score", "responses.hits.hits._source", "responses.error.reason"])
+        responses = iter(response['responses'])
+        results: Dict[str, List[Optional[List[Dict[str, Any]]]]] = {}
+        for index_name in index_names:
+            results[index_name] = []
+            for text in texts:
+                item = next(responses)
+                if 'error' in item:
+                    logger.error(f"Error performing similarity search in index '{index_name}' for text: '{text}': "
+                                 f"{item['error'].get('reason')}")
+                    results[index_name].append(None)
+                else:
+                    results[index_name].append(similar_records_from_response(item))
+        logger.info(f"Performed {len(searches) // 2} similarity searches across {index_names}")
+        return results
+
+    async def expand_exact_hits(self, index_name: str, exact_hits: List[Optional[List[Dict[str, Any]]]],
+                                top_n: int) -> List[Optional[List[Dict[str, Any]]]]:
+        # Fills exact name matches up to top_n with the nearest neighbours of the matched record's stored vector, so
+        # no query needs to be embedded. A text whose neighbours cannot be fetched falls back to None.
+        ids = list({hits[0]['id'] for hits in exact_hits if hits is not None and len(hits) < top_n})
+        if not ids:
+            return exact_hits
+        try:
+            response = await self.client.search(index=index_name, body={
+                "size": len(ids),
+                "_source": ["id", "vector"],
+                "query": {"terms": {"id": ids}}
+            }, filter_path=["hits.hits._source"])
+            vectors = {hit['_source']['id']: hit['_source']['vector'] for hit in response['hits']['hits']}
+        except Exception as e:
+            logger.error(f"Error fetching stored vectors from index '{index_name}': {e}")
+            vectors = {}
+
+        results: List[Optional[List[Dict[str, Any]]]] = []
+        for hits in exact_hits:
+            if hits is None or len(hits) >= top_n:
+                results.append(hits)
+                continue
+            vector = vectors.get(hits[0]['id'])
+            if vector is None:
+                results.append(None)
+                continue
+            try:
+                response = await self.client.search(index=index_name,
+                                                    body=self.similarity_query(vector, top_n + len(hits)),
+                                                    filter_path=SIMILAR_RECORD_FILTER_PATH)
+                exact_ids = {hit['id'] for hit in hits}
+                neighbours = [hit for hit in similar_records_from_response(response) if hit['id'] not in exact_ids]
+                results.append(hits + neighbours[:top_n - len(hits)])
+            except Exception as e:
+                logger.error(f"Error performing similarity search in index '{index_name}' for record "
+                             f"'{hits[0]['id']}': {e}")
+                results.append(None)
+        return results
+
     async def create_replace_record(self, collection_name: str, record: RecordCreateReplace) -> str:
         try:
             logger.info(f"Starting create_replace_record for collection: {collection_name}, record: {record}")
+            # The vector is embedded for the index the alias points to and written into that index directly. A
+            # model migration or reseed may switch the alias meanwhile, the record is then written again.
+            for _ in range(ALIAS_WRITE_ATTEMPTS):
+                index = await self.resolve_index(collection_name)
 
-            # Embedding vector
-            vector = await get_embedding([record.name])
-            logger.info(f"Embedding vector obtained: {vector}")
+                # Embedding vector
+                try:
+                    vector = await self.embed(collection_name, [record.name], index)
+                except AliasMoved:
+                    continue
+                logger.info(f"Embedding vector obtained: {vector}")
 
-            doc = {
-                **record.model_dump(),
-                'vector': vector[0]
-            }
-            logger.info(f"Document to be indexed: {doc}")
+                doc = {
+                    **record.model_dump(),
+                    'vector': vector[0]
+                }
+                logger.info(f"Document to be indexed: {doc}")
 
-            # Query for existing record by ID
-            query: Any = {
-                "query": {
-                    "term": {
-                        "id": record.id
+                # Query for existing record by ID
+                query: Any = {
+                    "query": {
+                        "term": {
+                            "id": record.id
+                        }
                     }
                 }
-            }
-            logger.info(f"Query to search for the existing record: {query}")
+                logger.info(f"Query to search for the existing record: {query}")
 
-            response = await self.client.search(index=collection_name, body=query)
-            logger.info(f"Elasticsearch search response: {response}")
+                response = await self.client.search(index=index, body=query)
+                logger.info(f"Elasticsearch search response: {response}")
 
-            doc_id: Optional[str] = None
+                doc_id: Optional[str] = None
 
-            if response['hits']['hits']:
-                doc_id = response['hits']['hits'][0]['_id']
-                action = 'replaced'
-            else:
-                action = 'created'
-            logger.info(f"Action to be performed: {action}, doc_id: {doc_id}")
+                if response['hits']['hits']:
+                    doc_id = response['hits']['hits'][0]['_id']
+                    action = 'replaced'
+                else:
+                    action = 'created'
+                logger.info(f"Action to be performed: {action}, doc_id: {doc_id}")
 
-            # Indexing the document: create or replace
-            saved_record = await self.client.index(index=collection_name, document=doc, id=doc_id)
-            logger.info(f"Record {action} successfully with ID: {saved_record['_id']}")
-            return saved_record['_id']
+                # Indexing the document: create or replace
+                saved_record = await self.client.index(index=index, document=doc, id=doc_id)
+                if await self.resolve_index(collection_name) != index:
+                    logger.warning(f"Alias '{collection_name}' moved from {index} while writing record {record.id}")
+                    continue
+                count_local_writes(collection_name, indexed=1)
+                logger.info(f"Record {action} successfully with ID: {saved_record['_id']}")
+                return saved_record['_id']
+            raise AliasMoved(f"'{collection_name}' moved to another index during each of {ALIAS_WRITE_ATTEMPTS} "
+                             f"attempts to write record {record.id}")
 
         except ApiError as e:
             logger.error(f"Failed to create or replace record: {e}")
@@ -170,6 +515,8 @@ class Elastic:
             if not elastic_search_response_is_empty(response):
                 doc_id = response['hits']['hits'][0]['_id']
                 update = await self.client.update(index=collection_name, id=doc_id, body={"doc": update_fields})
+                if update['result'] != 'noop':
+                    count_local_writes(collection_name, indexed=1)
                 logger.info(f"Updated document with ID: {doc_id}")
                 return update['_id']
 
@@ -196,6 +543,7 @@ class Elastic:
             if not elastic_search_response_is_empty(response):
                 doc_id = response['hits']['hits'][0]['_id']
                 await self.client.delete(index=collection_name, id=doc_id)
+                count_local_writes(collection_name, deleted=1)
                 logger.info(f"Deleted document with ID: {doc_id}")
             else:
                 logger.info(f"No document found with id {record.id} in index {collection_name}")
@@ -211,6 +559,8 @@ class Elastic:
             if await self.client.indices.exists(index=index_name):
                 await self.client.indices.delete(index=index_name)
                 logger.info(f"Index '{index_name}' deleted successfully.")
+                # Projections are stored under the name of the index they were fitted for
+                await self.delete_projection(index_name)
             else:
                 logger.info(f"Index '{index_name}' does not exist.")
         except NotFoundError:
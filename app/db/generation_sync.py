@@ -0,0 +1,63 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from app.config import GENERATION_SYNC_INTERVAL_SECONDS, GENERATION_SYNC_LOCK_FILE
+from app.db.collection_manager import CollectionManager
+from app.db.elastic import Elastic
+from app.modules.generations import bump_generation, local_writes
+from app.utils import try_lock_file
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Index an alias points to and its indexing and delete counters; any write or alias swap changes it
+Signature = Tuple[str, int, int]
+# Signature and this host's own (indexed, deleted) operation counts of an alias at the last poll
+Seen = Tuple[Signature, Tuple[int, int]]
+
+
+async def read_signatures(es: Elastic, aliases: List[str]) -> Dict[str, Signature]:
+    indices = await es.client.indices.get_alias(index=",".join(aliases), ignore_unavailable=True)
+    alias_indices = {alias: index for index, entry in indices.items() for alias in entry['aliases'] if alias in aliases}
+    if not alias_indices:
+        return {}
+    stats = await es.client.indices.stats(index=",".join(alias_indices.values()), metric="indexing", filter_path=[
+        "indices.*.primaries.indexing.index_total", "indices.*.primaries.indexing.delete_total"])
+    signatures: Dict[str, Signature] = {}
+    for alias, index in alias_indices.items():
+        if index in stats['indices']:
+            indexing = stats['indices'][index]['primaries']['indexing']
+            signatures[alias] = (index, indexing['index_total'], indexing['delete_total'])
+    return signatures
+
+
+async def poll(es: Elastic, aliases: List[str], seen: Dict[str, Seen]) -> None:
+    # Writes of this host bumped the generations with their record ids already. Another bump here would leave
+    # those ids out of the change journal, so only operations beyond the host's own count as other replicas'.
+    signatures = await read_signatures(es, aliases)
+    for alias, signature in signatures.items():
+        writes = local_writes(alias)
+        if alias in seen:
+            (index, indexed, deleted), (own_indexed, own_deleted) = seen[alias]
+            if signature[0] != index or signature[1] - indexed != writes[0] - own_indexed or \
+                    signature[2] - deleted != writes[1] - own_deleted:
+                bump_generation(alias)
+        seen[alias] = (signature, writes)
+
+
+async def sync_generations(es: Elastic, interval: Optional[float] = GENERATION_SYNC_INTERVAL_SECONDS) -> None:
+    # Bumps the host's generations for writes made through other replicas. Every worker runs this task, the lock
+    # lets one of them poll; another worker takes over if it exits.
+    if interval is None:
+        return
+    aliases = list(CollectionManager().get_used_collections().values())
+    lock_fd: Optional[int] = None
+    seen: Dict[str, Seen] = {}
+    while True:
+        if lock_fd is None:
+            lock_fd = try_lock_file(GENERATION_SYNC_LOCK_FILE)
+        if lock_fd is not None:
+            try:
+                await poll(es, aliases, seen)
+            except Exception as e:
+                logger.error(f"Error polling the collections for writes of other replicas: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,470 @@
+import asyncio
+import hmac
+import json
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from elasticsearch import NotFoundError, ConflictError, BadRequestError
+from elasticsearch.helpers import async_bulk
+from app.config import (MIGRATION_CPU_BUDGET, MIGRATION_MAX_DOCS_PER_SECOND, MIGRATION_BATCH_SIZE,
+                        MIGRATION_HEARTBEAT_SECONDS, MIGRATION_STALE_SECONDS)
+from app.db.collection_manager import PREFIX
+from app.db.elastic import Elastic, index_metas, model_of
+from app.db.utils import text_fingerprint
+from app.models.api import RecordCreateReplace, RecordPatch, RecordDelete, ModelMigrationStatus
+from app.modules.embedding_model import (get_embedding, get_model_dimension, is_allowed_model, preload_model,
+                                        evict_models)
+from app.modules.generations import bump_generation, get_generation
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+RECORD_FIELDS = ["id", "name", "description", "status"]
+# Migrations can only be started when a token is configured
+MIGRATION_TOKEN = os.getenv('MIGRATION_TOKEN')
+# Status of the latest migration of every alias, by alias. The document doubles as the lock: only the worker that
+# created it (or took it over from a stale one) runs the migration, and every worker reads the shadow index from it.
+MIGRATIONS_INDEX = f"{PREFIX}migrations"
+SyncedRecord = Union[RecordCreateReplace, RecordPatch, RecordDelete]
+
+
+def migration_target_alias(alias: str) -> str:
+    # Points at the shadow index while a migration dual-writes, so the shadow index can be told apart in Elasticsearch
+    return f"{alias}_migration_target"
+
+
+def is_live(doc: Dict[str, Any]) -> bool:
+    # A migration whose worker stopped saving its status died with it
+    return doc['state'] not in ("completed", "failed") and time.time() - doc['heartbeat_at'] < MIGRATION_STALE_SECONDS
+
+
+class MigrationTakenOver(Exception):
+    pass
+
+
+class ShadowWriter:
+    # Applies /sync writes to the shadow index of a running migration, embedded with the migration's model.
+    # Shadow documents use the record id as _id.
+    def __init__(self, es: Elastic, alias: str, shadow_index: str, model_name: str, model_revision: str):
+        self.es = es
+        self.alias = alias
+        self.shadow_index = shadow_index
+        self.model_name = model_name
+        self.model_revision = model_revision
+
+    async def index_doc(self, doc: Dict[str, Any]) -> None:
+        vector = await get_embedding([doc['name']], self.model_name, self.model_revision)
+        await self.es.client.index(index=self.shadow_index, id=doc['id'], document={**doc, 'vector': vector[0]})
+
+    async def delete(self, record_id: str) -> None:
+        try:
+            await self.es.client.delete(index=self.shadow_index, id=record_id)
+        except NotFoundError:
+            pass
+
+    async def copy_from_source(self, record_id: str) -> None:
+        query: Any = {"size": 1, "_source": False, "query": {"term": {"id": record_id}}}
+        response = await self.es.client.search(index=self.alias, body=query)
+        if not response['hits']['hits']:
+            await self.delete(record_id)
+            return
+        # Get by _id is realtime, unlike search, so a just-patched document is read in its latest state
+        source = (await self.es.client.get(index=self.alias, id=response['hits']['hits'][0]['_id']))['_source']
+        await self.index_doc({field: source.get(field) for field in RECORD_FIELDS})
+
+    async def write(self, record: SyncedRecord) -> None:
+        match record.method:
+            case 'POST' | 'PUT':
+                await self.index_doc(record.model_dump(include=set(RECORD_FIELDS), mode='json'))
+            case 'PATCH':
+                # The serving index already holds the patched record, re-embed it from there
+                await self.copy_from_source(record.id)
+            case 'DELETE':
+                await self.delete(record.id)
+
+    async def dual_write(self, record: SyncedRecord) -> None:
+        try:
+            await self.write(record)
+        except Exception as e:
+            # Missing or extra shadow documents are reconciled by the migrating worker before the switch
+            logger.error(f"Dual write of record {record.id} into {self.shadow_index} failed: {e}")
+
+
+class ModelMigration:
+    # Re-embeds a collection with another model into a shadow index while the alias keeps serving the old one.
+    # Backfill uses op_type create, so it never overwrites a newer dual write.
+    def __init__(self, es: Elastic, collection: str, alias: str, model_name: str, model_revision: str,
+                 cpu_budget: float = MIGRATION_CPU_BUDGET,
+                 max_docs_per_second: Optional[float] = MIGRATION_MAX_DOCS_PER_SECOND,
+                 batch_size: int = MIGRATION_BATCH_SIZE):
+        self.es = es
+        self.collection = collection
+        self.alias = alias
+        self.model_name = model_name
+        self.model_revision = model_revision
+        self.cpu_budget = cpu_budget
+        self.max_docs_per_second = max_docs_per_second
+        self.batch_size = batch_size
+        self.shadow_index = f"{alias}_migration_{uuid.uuid4()}"
+        self.writer = ShadowWriter(es, alias, self.shadow_index, model_name, model_revision)
+        self.source_index: Optional[str] = None
+        self.state = "pending"
+        self.total = 0
+        self.processed = 0
+        self.dual_writes = 0
+        self.error: Optional[str] = None
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self.dual_write_enabled = False
+        # Ids written through /sync in this worker since dual writes started, the backfill must not resurrect
+        # or overwrite them
+        self.touched_ids: Set[str] = set()
+        # Ids whose shadow copy failed and has to be copied again from the serving index before switching
+        self.retry_ids: Set[str] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # Version of the status document this worker wrote last, a save fails once another worker took it over
+        self.seq_no: Optional[int] = None
+        self.primary_term: Optional[int] = None
+        self.save_lock = asyncio.Lock()
+        self.taken_over = False
+
+    @property
+    def running(self) -> bool:
+        return self.state not in ("completed", "failed")
+
+    def status(self) -> ModelMigrationStatus:
+        return ModelMigrationStatus(collection=self.collection, model_name=self.model_name,
+                                    model_revision=self.model_revision, state=self.state,
+                                    source_index=self.source_index, shadow_index=self.shadow_index, total=self.total,
+                                    processed=self.processed, dual_writes=self.dual_writes,
+                                    started_at=self.started_at, finished_at=self.finished_at, error=self.error)
+
+    def to_doc(self) -> Dict[str, Any]:
+        return {**self.status().model_dump(mode='json'), "owner": self.owner, "heartbeat_at": time.time(),
+                "dual_write": self.dual_write_enabled}
+
+    async def claim(self) -> None:
+        await ensure_migrations_index(self.es)
+        try:
+            response = await self.es.client.index(index=MIGRATIONS_INDEX, id=self.alias, document=self.to_doc(),
+                                                  op_type='create')
+        except ConflictError:
+            current = await self.es.client.get(index=MIGRATIONS_INDEX, id=self.alias)
+            if is_live(current['_source']):
+                raise ValueError(f"A migration of '{self.collection}' to {current['_source']['model_name']}@"
+                                 f"{current['_source']['model_revision']} is already running")
+            try:
+                response = await self.es.client.index(index=MIGRATIONS_INDEX, id=self.alias, document=self.to_doc(),
+                                                      if_seq_no=current['_seq_no'],
+                                                      if_primary_term=current['_primary_term'])
+            except ConflictError:
+                raise ValueError(f"Another migration of '{self.collection}' was started at the same time")
+            await remove_stale_target_aliases(self.es, self.alias)
+        self.seq_no, self.primary_term = response['_seq_no'], response['_primary_term']
+
+    async def save(self) -> None:
+        async with self.save_lock:
+            if self.taken_over:
+                raise MigrationTakenOver(f"Migration of '{self.alias}' was taken over by another worker")
+            try:
+                response = await self.es.client.index(index=MIGRATIONS_INDEX, id=self.alias, document=self.to_doc(),
+                                                      if_seq_no=self.seq_no, if_primary_term=self.primary_term)
+            except ConflictError:
+                self.taken_over = True
+                raise MigrationTakenOver(f"Migration of '{self.alias}' was taken over by another worker")
+            self.seq_no, self.primary_term = response['_seq_no'], response['_primary_term']
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(MIGRATION_HEARTBEAT_SECONDS)
+            try:
+                await self.save()
+            except MigrationTakenOver:
+                return
+            except Exception as e:
+                logger.error(f"Failed to save the status of the migration of '{self.alias}': {e}")
+
+    async def run(self) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            self.state = "preparing"
+            await self.save()
+            # The new weights are loaded (off the event loop) before any dual write can need them
+            dimension = await get_model_dimension(self.model_name, self.model_revision)
+            aliases = await self.es.client.indices.get_alias(name=self.alias)
+            self.source_index = list(aliases.keys())[0]
+            # The records are those of the source index, so is the time they were seeded at
+            source_meta = await self.es.get_index_meta(self.source_index)
+            meta = {"seeded_at": source_meta["seeded_at"]} if source_meta.get("seeded_at") else None
+            await self.es.create_index(self.shadow_index, vector_dim=dimension, model_name=self.model_name,
+                                       model_revision=self.model_revision, meta=meta)
+            self.dual_write_enabled = True
+            await self.es.client.indices.put_alias(index=self.shadow_index, name=migration_target_alias(self.alias))
+            self.total = (await self.es.client.count(index=self.alias))['count']
+            self.state = "backfilling"
+            await self.save()
+            # Other workers read the shadow index from the saved status on their next write, no record changed
+            bump_generation(self.alias, [])
+
+            logger.info(f"Migrating {self.total} records of '{self.alias}' to {self.model_name}@"
+                        f"{self.model_revision} in {self.shadow_index}")
+            await self._backfill()
+
+            self.state = "catching_up"
+            await self.save()
+            await self._catch_up()
+
+            # Fails if another worker took the migration over in the meantime, the alias is only switched by one
+            self.state = "switching"
+            await self.save()
+            await self._switch_alias()
+            self.state = "completed"
+            logger.info(f"Migration of '{self.alias}' completed, previous index {self.source_index} kept for rollback")
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            self.dual_write_enabled = False
+            logger.error(f"Migration of '{self.alias}' to {self.model_name}@{self.model_revision} failed: {e}",
+                         exc_info=True)
+        finally:
+            heartbeat.cancel()
+            self.finished_at = datetime.now(timezone.utc)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Failed to save the final status of the migration of '{self.alias}': {e}")
+            # Other workers look at the saved status again (and stop dual writing) once the generation changes
+            if self.state == "completed":
+                bump_generation(self.alias)
+            else:
+                await self._remove_target_alias()
+            await evict_unused_models(self.es, self.alias)
+
+    async def _backfill(self) -> None:
+        batch: List[Dict[str, Any]] = []
+        # The scroll outlives the throttling pauses between batches
+        async for hit in self.es.scan_records(self.alias, fields=RECORD_FIELDS, scroll="30m"):
+            batch.append(hit['_source'])
+            if len(batch) >= self.batch_size:
+                await self._copy_batch(batch)
+                batch = []
+        if batch:
+            await self._copy_batch(batch)
+
+    async def _copy_batch(self, batch: List[Dict[str, Any]]) -> None:
+        started = time.monotonic()
+        records = [record for record in batch if record['id'] not in self.touched_ids]
+        if records:
+            vectors = await get_embedding([record['name'] for record in records], self.model_name,
+                                          self.model_revision)
+            actions = [
+                {
+                    "_op_type": "create",
+                    "_index": self.shadow_index,
+                    "_id": record['id'],
+                    "_source": {**{field: record.get(field) for field in RECORD_FIELDS}, 'vector': vector}
+                } for record, vector in zip(records, vectors) if record['id'] not in self.touched_ids
+            ]
+            _, errors = await async_bulk(self.es.client, actions, raise_on_error=False)
+            for error in errors:  # type: ignore
+                item = error.get('create', {})
+                # 409 means a dual write got there first, which is the newer version
+                if item.get('status') != 409:
+                    logger.error(f"Failed to copy record {item.get('_id')} into {self.shadow_index}: {item}")
+                    self.retry_ids.add(item.get('_id'))
+        self.processed += len(batch)
+        if self.taken_over:
+            raise MigrationTakenOver(f"Migration of '{self.alias}' was taken over by another worker")
+        await self._throttle(started, len(batch))
+
+    async def _throttle(self, started: float, batch_size: int) -> None:
+        busy = time.monotonic() - started
+        # Keep the busy share of wall time within the CPU budget and the rate within max_docs_per_second
+        pause = busy * (1 - self.cpu_budget) / self.cpu_budget
+        if self.max_docs_per_second:
+            pause = max(pause, batch_size / self.max_docs_per_second - busy)
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def _catch_up(self) -> None:
+        while self.retry_ids:
+            await self.writer.copy_from_source(self.retry_ids.pop())
+        # Dual writes of other workers are not tracked here; reconciling the records of both indices makes sure
+        # failed writes, records deleted while the backfill copied them and copies of an older version of a record
+        # do not survive the switch
+        await self.es.client.indices.refresh(index=self.shadow_index)
+        source = await self._fingerprints(self.alias)
+        shadow = await self._fingerprints(self.shadow_index)
+        missing, extra = source.keys() - shadow.keys(), shadow.keys() - source.keys()
+        stale = {record_id for record_id in source.keys() & shadow.keys() if source[record_id] != shadow[record_id]}
+        if missing or extra or stale:
+            logger.warning(f"Reconciling {self.shadow_index}: {len(missing)} missing, {len(extra)} extra, "
+                           f"{len(stale)} stale records")
+        for record_id in missing | extra | stale:
+            await self.writer.copy_from_source(record_id)
+
+    async def _fingerprints(self, index: str) -> Dict[str, str]:
+        # Fingerprint of the fields of every record by id, the vector follows from the name
+        fingerprints: Dict[str, str] = {}
+        async for hit in self.es.scan_records(index, fields=RECORD_FIELDS):
+            fields = [hit['_source'].get(field) for field in RECORD_FIELDS]
+            fingerprints[hit['_source']['id']] = text_fingerprint(json.dumps(fields))
+        return fingerprints
+
+    async def _switch_alias(self) -> None:
+        logger.info(f"Switching alias {self.alias} from {self.source_index} to {self.shadow_index}")
+        await self.es.client.indices.update_aliases(body={
+            "actions": [
+                {"remove": {"index": self.source_index, "alias": self.alias}},
+                {"add": {"index": self.shadow_index, "alias": self.alias}},
+                {"remove": {"index": self.shadow_index, "alias": migration_target_alias(self.alias)}}
+            ]
+        })
+        self.dual_write_enabled = False
+        if self.retry_ids:
+            logger.error(f"Records {sorted(self.retry_ids)} failed to reach {self.shadow_index} before the switch")
+
+    async def _remove_target_alias(self) -> None:
+        try:
+            await self.es.client.indices.delete_alias(index=self.shadow_index, name=migration_target_alias(self.alias))
+            bump_generation(self.alias, [])
+        except NotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Failed to remove migration target alias of '{self.alias}': {e}")
+
+    async def dual_write(self, record: SyncedRecord) -> None:
+        if not self.dual_write_enabled:
+            return
+        self.touched_ids.add(record.id)
+        try:
+            await self.writer.write(record)
+            self.dual_writes += 1
+        except Exception as e:
+            logger.error(f"Dual write of record {record.id} into {self.shadow_index} failed: {e}")
+            self.retry_ids.add(record.id)
+
+
+# Migrations started in this worker by collection alias
+migrations: Dict[str, ModelMigration] = {}
+# Shadow writers of migrations running in other workers with the generation and time they were looked up at,
+# looked up again whenever the generation changes or after a heartbeat interval. The generation of other hosts does
+# not change when a migration starts or stops, so a missing writer expires as well.
+shadow_writers: Dict[str, Tuple[int, float, Optional[ShadowWriter]]] = {}
+
+
+async def ensure_migrations_index(es: Elastic) -> None:
+    if await es.client.indices.exists(index=MIGRATIONS_INDEX):
+        return
+    try:
+        # The status documents are only read by id, never searched
+        await es.client.indices.create(index=MIGRATIONS_INDEX, body={"mappings": {"dynamic": False}})
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+async def read_migration(es: Elastic, alias: str) -> Optional[Dict[str, Any]]:
+    try:
+        return (await es.client.get(index=MIGRATIONS_INDEX, id=alias))['_source']
+    except NotFoundError:
+        return None
+
+
+async def read_migration_status(es: Elastic, alias: str) -> Optional[ModelMigrationStatus]:
+    doc = await read_migration(es, alias)
+    if doc is None:
+        return None
+    if doc['state'] not in ("completed", "failed") and not is_live(doc):
+        doc = {**doc, "state": "failed",
+               "error": f"The worker running the migration ({doc['owner']}) stopped during {doc['state']}"}
+    return ModelMigrationStatus(**doc)
+
+
+async def get_dual_writer(es: Elastic, alias: str) -> Optional[Union[ModelMigration, ShadowWriter]]:
+    migration = migrations.get(alias)
+    if migration and migration.dual_write_enabled:
+        return migration
+    generation = get_generation(alias)
+    cached = shadow_writers.get(alias)
+    if cached is None or cached[0] != generation or time.monotonic() - cached[1] > MIGRATION_HEARTBEAT_SECONDS:
+        writer: Optional[ShadowWriter] = None
+        doc = await read_migration(es, alias)
+        if doc and doc.get('dual_write') and is_live(doc):
+            writer = ShadowWriter(es, alias, doc['shadow_index'], doc['model_name'], doc['model_revision'])
+            # Loaded in the background, the first dual write waits for it without blocking the event loop
+            preload_model(doc['model_name'], doc['model_revision'])
+        previous = cached[2] if cached else None
+        cached = (generation, time.monotonic(), writer)
+        shadow_writers[alias] = cached
+        if previous is not None and writer is None:
+            await evict_unused_models(es, alias)
+    return cached[2]
+
+
+async def remove_stale_target_aliases(es: Elastic, alias: str) -> None:
+    # Target aliases left behind by migrations whose worker died, only a live migration's shadow index keeps its own
+    try:
+        target = await es.client.indices.get_alias(name=migration_target_alias(alias))
+    except NotFoundError:
+        return
+    doc = await read_migration(es, alias)
+    live_index = doc['shadow_index'] if doc and is_live(doc) else None
+    for index in target.keys():
+        if index == live_index:
+            continue
+        try:
+            await es.client.indices.delete_alias(index=index, name=migration_target_alias(alias))
+            logger.warning(f"Removed the migration target alias of '{alias}' from {index}, its migration stopped")
+        except NotFoundError:
+            pass
+
+
+async def cleanup_stale_migrations(es: Elastic, aliases: List[str]) -> None:
+    for alias in aliases:
+        try:
+            await remove_stale_target_aliases(es, alias)
+        except Exception as e:
+            logger.error(f"Failed to clean up stale migrations of '{alias}': {e}")
+
+
+def models_in_use() -> Set[Tuple[str, str]]:
+    # Models of the indices the aliases point to, of running migrations and of the shadow indices being written
+    in_use = {model_of(meta) for _, _, meta in index_metas.values()}
+    in_use |= {(migration.model_name, migration.model_revision) for migration in migrations.values()
+               if migration.running}
+    in_use |= {(writer.model_name, writer.model_revision) for _, _, writer in shadow_writers.values() if writer}
+    return in_use
+
+
+async def evict_unused_models(es: Elastic, alias: str) -> None:
+    # The alias may have just been switched, its model is read again first so the new one is kept
+    try:
+        await es.get_cached_index_meta(alias)
+    except Exception as e:
+        logger.error(f"Error reading the model of '{alias}': {e}")
+        return
+    evict_models(models_in_use())
+
+
+def migration_authorized(token: Optional[str]) -> bool:
+    return bool(MIGRATION_TOKEN) and token is not None and hmac.compare_digest(token.encode(), MIGRATION_TOKEN.encode())
+
+
+async def start_migration(es: Elastic, collection: str, alias: str, model_name: str, model_revision: str,
+                          cpu_budget: Optional[float] = None,
+                          max_docs_per_second: Optional[float] = None) -> ModelMigration:
+    if not is_allowed_model(model_name, model_revision):
+        raise PermissionError(f"Model {model_name}@{model_revision} is not in MIGRATION_ALLOWED_MODELS")
+    migration = ModelMigration(es, collection, alias, model_name, model_revision,
+                               cpu_budget=cpu_budget or MIGRATION_CPU_BUDGET,
+                               max_docs_per_second=max_docs_per_second or MIGRATION_MAX_DOCS_PER_SECOND)
+    # Raises ValueError while a migration of the collection runs in any worker
+    await migration.claim()
+    migrations[alias] = migration
+    migration.task = asyncio.create_task(migration.run())
+    return migration
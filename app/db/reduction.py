@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import random
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from app.config import VECTOR_DIMENSION, VECTOR_REDUCTION_DIMENSIONS, MODEL_NAME, MODEL_REVISION
+from app.db.collection_manager import CollectionManager
+from app.db.elastic import Elastic
+from app.models.api import RecordInDb
+from app.modules.embedding_model import get_embedding
+from app.modules.projection import fit_projection, top_k_neighbours
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+async def embed_names(names: List[str], model_name: str = MODEL_NAME, revision: str = MODEL_REVISION,
+                      batch_size: int = 32) -> np.ndarray:
+    vectors: List[List[float]] = []
+    for start in range(0, len(names), batch_size):
+        vectors.extend(await get_embedding(names[start:start + batch_size], model_name, revision))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+async def prepare_reduction(es: Elastic, index_name: str, table: str,
+                            records: List[RecordInDb]) -> Tuple[int, Optional[List[List[float]]], Dict[str, Any]]:
+    # Vector dimension, precomputed vectors and _meta for a new index of the table. Reduced tables are embedded
+    # once up front to fit the projection, the projected vectors are then indexed as they are.
+    dimension = VECTOR_REDUCTION_DIMENSIONS.get(table)
+    if not dimension:
+        return VECTOR_DIMENSION, None, {}
+    if len(records) <= dimension:
+        logger.warning(f"{table} has only {len(records)} records, not reducing it to {dimension} dimensions")
+        return VECTOR_DIMENSION, None, {}
+    vectors = await embed_names([record.name for record in records])
+    projection = await asyncio.to_thread(fit_projection, vectors, dimension)
+    await es.save_projection(index_name, projection)
+    return dimension, projection.apply(vectors).tolist(), {"projection": index_name}
+
+
+def evaluate_dimensions(vectors: np.ndarray, dimensions: List[int], top_k: int,
+                        sample: int) -> List[Dict[str, Any]]:
+    # Nearest neighbours of a sample of the collection's own names, at full dimension and after each reduction
+    queries = random.Random(0).sample(range(len(vectors)), min(sample, len(vectors)))
+    full = top_k_neighbours(vectors, queries, top_k)
+    rows = []
+    for dimension in dimensions:
+        projection = fit_projection(vectors, dimension)
+        reduced = top_k_neighbours(projection.apply(vectors), queries, top_k)
+        overlap = np.mean([len(set(a) & set(b)) / top_k for a, b in zip(full.tolist(), reduced.tolist())])
+        rows.append({
+            "dimension": dimension,
+            "explained_variance": projection.explained_variance,
+            "overlap": float(overlap),
+            "top1_agreement": float(np.mean(full[:, 0] == reduced[:, 0])),
+            "vector_bytes": 4 * dimension
+        })
+    return rows
+
+
+async def evaluate(collections: List[str], dimensions: List[int], top_k: int, sample: int) -> None:
+    mapping = CollectionManager().get_used_collections()
+    es = Elastic()
+    try:
+        for collection in collections:
+            alias = mapping[collection]
+            names = [record['name'] for record in await es.name_records(alias)]
+            model_name, model_revision = await es.get_index_model(alias)
+            # Always compared against the model's full dimension, also for collections that are already reduced
+            vectors = await embed_names(names, model_name, model_revision)
+            usable = [dimension for dimension in dimensions if dimension < min(vectors.shape)]
+            k = min(top_k, len(names) - 2)
+            print(f"{collection}: {len(names)} records, {vectors.shape[1]} dimensions, "
+                  f"{min(sample, len(names))} sample queries")
+            print(f"{'dimension':>10} {'variance':>9} {f'overlap@{k}':>11} {'top1':>6} {'size':>6}")
+            for row in evaluate_dimensions(vectors, usable, k, sample):
+                print(f"{row['dimension']:>10} {row['explained_variance']:>9.1%} {row['overlap']:>11.3f} "
+                      f"{row['top1_agreement']:>6.3f} {row['vector_bytes'] / (4 * vectors.shape[1]):>6.1%}")
+    finally:
+        await es.client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the top-k neighbours of PCA-reduced vectors with the "
+                                                 "full-dimension ones, per collection")
+    parser.add_argument("--collections", nargs="+", required=True)
+    parser.add_argument("--dimensions", nargs="+", type=int, default=[32, 64, 128, 256])
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--sample", type=int, default=500, help="Number of record names used as queries")
+    args = parser.parse_args()
+    asyncio.run(evaluate(args.collections, args.dimensions, args.top_k, args.sample))
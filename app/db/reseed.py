@@ -0,0 +1,127 @@
+import asyncio
+import fcntl
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from app.config import RESEED_MAX_AGE_SECONDS, RESEED_STATUS_FILE, RESEED_LOCK_FILE
+from app.db.collection_manager import CollectionManager
+from app.db.elastic import Elastic
+from app.utils import write_json_atomic
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ReseedStatus:
+    # Progress of a reseed, kept in a file so that every worker can report it, not only the one reseeding
+    def __init__(self, path: str = RESEED_STATUS_FILE):
+        self.path = path
+        self.status: Dict[str, Any] = {
+            "state": "running",
+            "started_at": utc_now(),
+            "finished_at": None,
+            "tables_total": 0,
+            "tables_done": 0,
+            "current_table": None,
+            "records_total": 0,
+            "records_indexed": 0,
+            "alias_swaps": {},
+            "error": None
+        }
+
+    def update(self, **fields: Any) -> None:
+        self.status.update(fields)
+        write_json_atomic(self.path, self.status)
+
+    def start(self, tables_total: int) -> None:
+        self.update(tables_total=tables_total)
+
+    def start_table(self, table: str, records: int) -> None:
+        self.update(current_table=table, records_total=self.status["records_total"] + records)
+
+    def add_indexed(self, records: int) -> None:
+        self.update(records_indexed=self.status["records_indexed"] + records)
+
+    def alias_switched(self, alias: str) -> None:
+        self.status["alias_swaps"][alias] = utc_now()
+        self.update(tables_done=self.status["tables_done"] + 1)
+
+    def finish(self) -> None:
+        self.update(state="done", current_table=None, finished_at=utc_now())
+
+    def skip(self, reason: str) -> None:
+        self.update(state="skipped", finished_at=utc_now(), error=None, reason=reason)
+
+    def fail(self, error: Exception) -> None:
+        self.update(state="failed", finished_at=utc_now(), error=str(error))
+
+
+def read_reseed_status(path: str = RESEED_STATUS_FILE) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+async def data_is_fresh(es: Elastic, max_age: float = RESEED_MAX_AGE_SECONDS) -> bool:
+    # Fresh when every collection alias exists and points to an index seeded within max_age
+    for alias in CollectionManager().get_used_collections().values():
+        if not await es.client.indices.exists_alias(name=alias):
+            return False
+        seeded_at = (await es.get_index_meta(alias)).get('seeded_at')
+        if seeded_at is None:
+            return False
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(seeded_at)
+        if age.total_seconds() > max_age:
+            return False
+    return True
+
+
+async def reseed_in_background(es: Elastic, max_age: float = RESEED_MAX_AGE_SECONDS) -> None:
+    # The API keeps serving from the current aliases, each one is swapped as soon as its new index is complete.
+    # Every worker starts this task, the lock lets only one of them reseed.
+    from app.db.seed_elastic import seed_elastic  # seed_elastic imports ReseedStatus from here
+
+    directory = os.path.dirname(RESEED_LOCK_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock_fd = os.open(RESEED_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Reseed already running in another process")
+            return
+
+        try:
+            fresh = await data_is_fresh(es, max_age)
+        except Exception as e:
+            logger.error(f"Could not check the age of the collections: {e}", exc_info=True)
+            fresh = False
+        if fresh:
+            logger.info(f"Collections were seeded within {max_age}s, skipping reseed")
+            # Keep the status of the reseed that produced the data, unless that run never finished
+            previous = read_reseed_status()
+            if previous is None or previous["state"] == "running":
+                ReseedStatus().skip("data is fresh")
+            return
+
+        status = ReseedStatus()
+        try:
+            logger.info("Reseeding Elasticsearch in the background")
+            await seed_elastic(status)
+            status.finish()
+        except asyncio.CancelledError:
+            status.fail(RuntimeError("reseed cancelled"))
+            raise
+        except Exception as e:
+            logger.error(f"Background reseed failed: {e}", exc_info=True)
+            status.fail(e)
+    finally:
+        os.close(lock_fd)
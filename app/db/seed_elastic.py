@@ -1,9 +1,14 @@
 import asyncio
 import uuid
-from typing import List, Dict
+from datetime import datetime, timedelta, timezone
+from typing import Any, List, Dict, Optional, Set
+from app.config import CHANGE_CAPTURE_UPDATED_AT_COLUMN, CHANGE_CAPTURE_BATCH_SIZE, CHANGE_CAPTURE_SEED_MARGIN_SECONDS
 from app.models.api import RecordInDb
-from app.db.crm_db import MySQLConnection
+from app.db.crm_db import crm_db, row_to_record
 from app.db.elastic import Elastic
+from app.db.reseed import ReseedStatus, utc_now
+from app.db.reduction import prepare_reduction
+from app.modules.generations import bump_generation, count_local_writes
 from app.db.collection_manager import CollectionManager
 from app.logs.logger import get_logger
 
@@ -15,92 +20,165 @@ def get_record_keys() -> List[str]:
 
 
 async def get_data(tables: List[str]) -> Dict[str, List[RecordInDb]]:
-    all_data: Dict[str, List[RecordInDb]] = {}
-    db = MySQLConnection()
-
+    # The tables are read concurrently over pooled connections
+    record_keys = get_record_keys()
     try:
-        record_keys = get_record_keys()
-        for table in tables:
-            queried_data = db.query_db(table, record_keys)
-            if queried_data:
-                all_data[table] = queried_data
-                logger.info(f"Fetched {len(queried_data)} records for table: {table}")
-            else:
-                logger.warning(f"No data fetched for table: {table}")
+        results = await asyncio.gather(*(crm_db.query_table(table, record_keys) for table in tables))
     except Exception as e:
         logger.error(f"Error fetching data: {e}", exc_info=True)
         raise
-    finally:
-        if db:
-            db.__exit__()
 
+    all_data: Dict[str, List[RecordInDb]] = {}
+    for table, queried_data in zip(tables, results):
+        if queried_data:
+            all_data[table] = queried_data
+            logger.info(f"Fetched {len(queried_data)} records for table: {table}")
+        else:
+            logger.warning(f"No data fetched for table: {table}")
     return all_data
 
 
-async def seed_elastic() -> None:
+def seed_watermark(seeded_at: str) -> datetime:
+    # CRM timestamps are naive UTC; the margin covers clock skew between this host and the database
+    since = datetime.fromisoformat(seeded_at).astimezone(timezone.utc).replace(tzinfo=None)
+    return since - timedelta(seconds=CHANGE_CAPTURE_SEED_MARGIN_SECONDS)
+
+
+async def catch_up(es: Elastic, table: str, index_name: str, read_at: str) -> Set[str]:
+    # Applies the rows the CRM changed after the table was read at read_at and removes the rows it deleted since.
+    # /sync writes made meanwhile went to the index the alias still pointed to. Returns the ids of changed records.
+    record_keys = get_record_keys()
+    await es.client.indices.refresh(index=index_name)
+    changed: Set[str] = set()
+    since: Any = seed_watermark(read_at)
+    last_id: Any = None
+    while True:
+        rows = await crm_db.query_changes(table, record_keys, CHANGE_CAPTURE_UPDATED_AT_COLUMN, since, last_id,
+                                          CHANGE_CAPTURE_BATCH_SIZE)
+        records = [row_to_record(row, record_keys) for row in rows]
+        await es.bulk_upsert_records(index_name, records)
+        changed.update(record.id for record in records)
+        if len(rows) < CHANGE_CAPTURE_BATCH_SIZE:
+            break
+        since, last_id = rows[-1][CHANGE_CAPTURE_UPDATED_AT_COLUMN], rows[-1][record_keys[0]]
+
+    table_ids = set(await crm_db.query_ids(table, record_keys[0]))
+    # An empty read is not taken as every record being deleted
+    if table_ids:
+        await es.client.indices.refresh(index=index_name)
+        deleted = {hit['_source']['id'] async for hit in es.scan_records(index_name, fields=["id"])} - table_ids
+        if deleted:
+            response = await es.client.delete_by_query(index=index_name, refresh=True,
+                                                       body={"query": {"terms": {"id": sorted(deleted)}}})
+            count_local_writes(index_name, deleted=response['deleted'])
+            changed |= deleted
+    if changed:
+        logger.info(f"Caught up {index_name} with {len(changed)} records of {table} changed since {read_at}")
+    return changed
+
+
+async def switch_alias(es: Elastic, elastic_table: str, temp_index: str) -> None:
+    backup_index = f"{elastic_table}_backup"
+
+    # Check if an alias exists for the current index
+    alias_exists = await es.client.indices.exists_alias(name=elastic_table)
+
+    if alias_exists:
+        # Retrieve the old index name associated with the alias
+        old_index = await es.client.indices.get_alias(name=elastic_table)
+        old_index_name = list(old_index.keys())[0]
+        logger.info(f"Switching alias {elastic_table} from {old_index_name} to {temp_index}")
+
+        # Update the alias to point to the new index
+        await es.client.indices.update_aliases(body={
+            "actions": [
+                {"remove": {"index": old_index_name, "alias": elastic_table}},
+                {"add": {"index": temp_index, "alias": elastic_table}}
+            ]
+        })
+
+        # Check if the backup index exists and delete it if it does
+        if await es.client.indices.exists(index=backup_index):
+            logger.info(f"Deleting old backup index: {backup_index}")
+            await es.delete_index(backup_index)
+
+        # Rename the old index to the backup index
+        logger.info(f"Renaming old index {old_index_name} to backup index {backup_index}")
+        await es.client.reindex(body={
+            "source": {"index": old_index_name},
+            "dest": {"index": backup_index}
+        }, wait_for_completion=True)
+
+        # Delete the old index after creating the backup alias
+        await es.delete_index(old_index_name)
+    else:
+        # If no alias exists, just create alias for the new index
+        logger.info(f"Creating alias {elastic_table} for {temp_index}")
+        await es.client.indices.put_alias(index=temp_index, name=elastic_table)
+
+    # The alias now points to different records, possibly embedded with a different model
+    bump_generation(elastic_table)
+
+    # Cleanup old temporary indices (if any)
+    for index in await es.client.indices.get(index=f"{elastic_table}_temp_*"):
+        if index != temp_index:
+            logger.info(f"Deleting old temporary index: {index}")
+            await es.delete_index(index)
+
+
+async def seed_elastic(status: Optional[ReseedStatus] = None) -> None:
     es = Elastic()
     try:
         collection_manager = CollectionManager()
         data_mapping = collection_manager.get_used_collections()
         my_sql_tables = list(data_mapping.keys())
         elastic_tables = list(data_mapping.values())
+        if status:
+            status.start(len(my_sql_tables))
+        # Taken before the tables are read: change capture of the new indices starts here, so rows changed during
+        # the read are not missed
+        seeded_at = utc_now()
         data = await get_data(my_sql_tables)
+        refused: List[str] = []
 
         for my_sql_table, elastic_table in zip(my_sql_tables, elastic_tables):
             # Use a unique name for the temporary index to avoid conflicts
             temp_index = f"{elastic_table}_temp_{uuid.uuid4()}"
-            backup_index = f"{elastic_table}_backup"
+
+            records = data.get(my_sql_table, [])
+            # An empty table is far more likely a broken read than a deleted collection, the alias keeps its records
+            if not records and await es.client.indices.exists_alias(name=elastic_table) and \
+                    (await es.client.count(index=elastic_table))['count'] > 0:
+                logger.error(f"Table {my_sql_table} returned no records, keeping the current {elastic_table}")
+                refused.append(my_sql_table)
+                continue
+            if status:
+                status.start_table(my_sql_table, len(records))
+            # Tables configured for reduction get a projection fitted on their vectors
+            vector_dim, vectors, meta = await prepare_reduction(es, temp_index, my_sql_table, records)
 
             # Create the temporary index
             logger.info(f"Creating index: {temp_index}")
-            await es.create_index(temp_index)
+            await es.create_index(temp_index, vector_dim=vector_dim, meta={**meta, "seeded_at": seeded_at})
 
             # Populate the temporary index with data
-            logger.info(f"Populating {temp_index} with {len(data[my_sql_table])} records")
-            await es.populate_es(temp_index, data[my_sql_table])
-
-            # Check if an alias exists for the current index
-            alias_exists = await es.client.indices.exists_alias(name=elastic_table)
-
-            if alias_exists:
-                # Retrieve the old index name associated with the alias
-                old_index = await es.client.indices.get_alias(name=elastic_table)
-                old_index_name = list(old_index.keys())[0]
-                logger.info(f"Switching alias {elastic_table} from {old_index_name} to {temp_index}")
-
-                # Update the alias to point to the new index
-                await es.client.indices.update_aliases(body={
-                    "actions": [
-                        {"remove": {"index": old_index_name, "alias": elastic_table}},
-                        {"add": {"index": temp_index, "alias": elastic_table}}
-                    ]
-                })
-
-                # Check if the backup index exists and delete it if it does
-                if await es.client.indices.exists(index=backup_index):
-                    logger.info(f"Deleting old backup index: {backup_index}")
-                    await es.delete_index(backup_index)
-
-                # Rename the old index to the backup index
-                logger.info(f"Renaming old index {old_index_name} to backup index {backup_index}")
-                await es.client.reindex(body={
-                    "source": {"index": old_index_name},
-                    "dest": {"index": backup_index}
-                }, wait_for_completion=True)
-
-                # Delete the old index after creating the backup alias
-                await es.delete_index(old_index_name)
-            else:
-                # If no alias exists, just create alias for the new index
-                logger.info(f"Creating alias {elastic_table} for {temp_index}")
-                await es.client.indices.put_alias(index=temp_index, name=elastic_table)
-
-            # Cleanup old temporary indices (if any)
-            for index in await es.client.indices.get(index=f"{elastic_table}_temp_*"):
-                if index != temp_index:
-                    logger.info(f"Deleting old temporary index: {index}")
-                    await es.delete_index(index)
-
+            logger.info(f"Populating {temp_index} with {len(records)} records")
+            await es.populate_es(temp_index, records, progress=status.add_indexed if status else None,
+                                 vectors=vectors)
+
+            # Writes made while the index was built went to the one being replaced, they are read from the CRM
+            # again: once before the swap, and once after it for those made while catching up
+            caught_up_at = utc_now()
+            await catch_up(es, my_sql_table, temp_index, seeded_at)
+            await switch_alias(es, elastic_table, temp_index)
+            changed = await catch_up(es, my_sql_table, elastic_table, caught_up_at)
+            if changed:
+                bump_generation(elastic_table, changed)
+            if status:
+                status.alias_switched(elastic_table)
+
+        if refused:
+            raise ValueError(f"Refused to replace collections with empty tables: {', '.join(refused)}")
         logger.info("Data sync complete")
     except Exception as e:
         logger.error(f"Error during Elasticsearch seeding: {e}", exc_info=True)
@@ -109,5 +187,12 @@ async def seed_elastic() -> None:
         await es.client.close()
 
 
+async def main() -> None:
+    try:
+        await seed_elastic()
+    finally:
+        await crm_db.close()
+
+
 if __name__ == "__main__":
-    asyncio.run(seed_elastic())
+    asyncio.run(main())
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+import numpy as np
+from app.config import MODEL_NAME, MODEL_REVISION
+from app.db.collection_manager import CollectionManager
+from app.db.elastic import Elastic
+from app.db.reduction import embed_names
+from app.db.seed_elastic import switch_alias
+from app.db.utils import text_fingerprint
+from app.modules.projection import Projection
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Snapshot layout, one pair of files per collection plus a manifest:
+#   manifest.json               model name/revision, dimension and row counts per collection
+#   <collection>.vectors.npy    float32 matrix (rows x dimension), loadable with mmap_mode='r'
+#   <collection>.records.jsonl  id, name, description, status and fingerprint of row i
+#   <collection>.projection.npz PCA projection of reduced collections (components, explained variance)
+SNAPSHOT_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+RECORD_FIELDS = ["id", "name", "description", "status"]
+
+
+def vectors_path(directory: str, collection: str) -> str:
+    return os.path.join(directory, f"{collection}.vectors.npy")
+
+
+def records_path(directory: str, collection: str) -> str:
+    return os.path.join(directory, f"{collection}.records.jsonl")
+
+
+def projection_path(directory: str, collection: str) -> str:
+    return os.path.join(directory, f"{collection}.projection.npz")
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, MANIFEST_FILE), 'r') as file:
+        return json.load(file)
+
+
+class CollectionSnapshot:
+    def __init__(self, directory: str, collection: str):
+        manifest = read_manifest(directory)
+        if collection not in manifest["collections"]:
+            raise ValueError(f"Collection '{collection}' not found in snapshot '{directory}'")
+        self.collection = collection
+        entry = manifest["collections"][collection]
+        self.model_name: str = entry.get("model_name", manifest["model_name"])
+        self.model_revision: str = entry.get("model_revision", manifest["model_revision"])
+        self.dimension: int = entry["dimension"]
+        # When the exported index was seeded; snapshots without it are at least as old as their export
+        self.seeded_at: str = entry.get("seeded_at") or manifest["created_at"]
+        self.projection: Optional[Projection] = None
+        if entry.get("projection"):
+            with np.load(projection_path(directory, collection)) as projection:
+                self.projection = Projection(projection["components"], float(projection["explained_variance"]))
+        # Memory-mapped, so warming a cache or an in-memory search does not copy the matrix up front
+        self.vectors: np.ndarray = np.load(vectors_path(directory, collection), mmap_mode='r')
+        with open(records_path(directory, collection), 'r') as file:
+            self.records: List[Dict[str, Any]] = [json.loads(line) for line in file]
+        if len(self.records) != self.vectors.shape[0]:
+            raise ValueError(f"Snapshot of '{collection}' has {len(self.records)} records "
+                             f"but {self.vectors.shape[0]} vectors")
+
+    def matches_current_model(self) -> bool:
+        return self.model_name == MODEL_NAME and self.model_revision == MODEL_REVISION
+
+    def stale_rows(self) -> List[int]:
+        # Rows whose name no longer matches the one their vector was embedded from, e.g. edited records files
+        return [i for i, record in enumerate(self.records)
+                if record.get('fingerprint') != text_fingerprint(record['name'])]
+
+    async def reembed(self, rows: List[int]) -> Dict[int, List[float]]:
+        vectors = await embed_names([self.records[i]['name'] for i in rows], self.model_name, self.model_revision)
+        if self.projection:
+            vectors = self.projection.apply(vectors)
+        return dict(zip(rows, vectors.tolist()))
+
+    def documents(self, replaced: Optional[Dict[int, List[float]]] = None) -> Iterator[Dict[str, Any]]:
+        # replaced holds the vectors of rows embedded again since the export, by row
+        for i, (record, vector) in enumerate(zip(self.records, self.vectors)):
+            doc = {field: record.get(field) for field in RECORD_FIELDS}
+            doc['vector'] = replaced[i] if replaced and i in replaced else vector.tolist()
+            yield doc
+
+
+async def export_collection(es: Elastic, directory: str, collection: str, index_name: str) -> Dict[str, Any]:
+    records: List[Dict[str, Any]] = []
+    chunks: List[np.ndarray] = []
+    chunk: List[List[float]] = []
+    async for hit in es.scan_records(index_name, fields=RECORD_FIELDS + ["vector"]):
+        source = hit['_source']
+        records.append({
+            **{field: source.get(field) for field in RECORD_FIELDS},
+            'fingerprint': text_fingerprint(source['name'])
+        })
+        chunk.append(source['vector'])
+        if len(chunk) >= 1000:
+            chunks.append(np.asarray(chunk, dtype=np.float32))
+            chunk = []
+    if chunk:
+        chunks.append(np.asarray(chunk, dtype=np.float32))
+    if not chunks:
+        raise ValueError(f"Index '{index_name}' contains no documents to export")
+
+    vectors = np.concatenate(chunks)
+    np.save(vectors_path(directory, collection), vectors)
+    with open(records_path(directory, collection), 'w') as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+    logger.info(f"Exported {len(records)} records of '{index_name}' to snapshot '{directory}'")
+    model_name, model_revision = await es.get_index_model(index_name)
+    seeded_at = (await es.get_cached_index_meta(index_name)).get('seeded_at')
+    # Vectors of reduced collections are only usable together with their projection
+    projection = await es.get_index_projection(index_name)
+    if projection:
+        np.savez(projection_path(directory, collection), components=projection.components,
+                 explained_variance=projection.explained_variance)
+    return {"count": len(records), "dimension": int(vectors.shape[1]), "source_index": index_name,
+            "model_name": model_name, "model_revision": model_revision, "projection": projection is not None,
+            "seeded_at": seeded_at}
+
+
+async def export_snapshot(directory: str, collections: Optional[List[str]] = None) -> Dict[str, Any]:
+    os.makedirs(directory, exist_ok=True)
+    mapping = CollectionManager().get_used_collections()
+    es = Elastic()
+    manifest: Dict[str, Any] = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "model_name": MODEL_NAME,
+        "model_revision": MODEL_REVISION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "collections": {}
+    }
+    try:
+        for collection in collections or list(mapping.keys()):
+            manifest["collections"][collection] = await export_collection(es, directory, collection,
+                                                                          mapping[collection])
+        with open(os.path.join(directory, MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+        return manifest
+    except Exception as e:
+        logger.error(f"Error exporting snapshot to '{directory}': {e}", exc_info=True)
+        raise
+    finally:
+        await es.client.close()
+
+
+async def import_snapshot(directory: str, collections: Optional[List[str]] = None, switch: bool = True,
+                          allow_model_mismatch: bool = False) -> Dict[str, str]:
+    manifest = read_manifest(directory)
+    mapping = CollectionManager().get_used_collections()
+    es = Elastic()
+    imported: Dict[str, str] = {}
+    try:
+        for collection in collections or list(manifest["collections"].keys()):
+            snapshot = CollectionSnapshot(directory, collection)
+            if not snapshot.matches_current_model() and not allow_model_mismatch:
+                raise ValueError(f"Snapshot of '{collection}' was embedded with {snapshot.model_name}@"
+                                 f"{snapshot.model_revision}, the service uses {MODEL_NAME}@{MODEL_REVISION}")
+
+            elastic_table = mapping[collection]
+            temp_index = f"{elastic_table}_temp_{uuid.uuid4()}"
+            logger.info(f"Importing {len(snapshot.records)} records of '{collection}' into {temp_index}")
+            # The reseed on startup and change capture go by the seed time of the data, not of the import
+            meta: Dict[str, Any] = {"seeded_at": snapshot.seeded_at}
+            if snapshot.projection:
+                await es.save_projection(temp_index, snapshot.projection)
+                meta["projection"] = temp_index
+            await es.create_index(temp_index, vector_dim=snapshot.dimension, model_name=snapshot.model_name,
+                                  model_revision=snapshot.model_revision, meta=meta)
+            stale = snapshot.stale_rows()
+            if stale:
+                logger.warning(f"{len(stale)} records of '{collection}' do not match their fingerprint, "
+                               f"embedding them again")
+            await es.bulk_index(temp_index, snapshot.documents(await snapshot.reembed(stale) if stale else None))
+            if switch:
+                await switch_alias(es, elastic_table, temp_index)
+            imported[collection] = temp_index
+        logger.info(f"Snapshot import from '{directory}' complete")
+        return imported
+    except Exception as e:
+        logger.error(f"Error importing snapshot from '{directory}': {e}", exc_info=True)
+        raise
+    finally:
+        await es.client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or import embedding snapshots of the collections")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("--dir", required=True, help="Snapshot directory")
+    parser.add_argument("--collections", nargs="+", help="Collections to process, all by default")
+    parser.add_argument("--no-switch", action="store_true",
+                        help="Import into new indices without moving the collection aliases to them")
+    parser.add_argument("--allow-model-mismatch", action="store_true",
+                        help="Import vectors produced by a different model or revision than the configured one")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        asyncio.run(export_snapshot(args.dir, args.collections))
+    else:
+        asyncio.run(import_snapshot(args.dir, args.collections, switch=not args.no_switch,
+                                    allow_model_mismatch=args.allow_model_mismatch))
@@ -1,4 +1,5 @@
-from typing import Any
+import hashlib
+from typing import Any, Dict, List
 from app.models.elastic import ElasticSearchResponse, Shards, Hits, Hit, TotalHits
 
 
@@ -23,3 +24,27 @@ def clean_elastic_response(response: Any) -> ElasticSearchResponse:
 
 def elastic_search_response_is_empty(response: Any) -> bool:
     return response['hits']['total']['value'] == 0
+
+
+# Fields returned for similarity hits; the stored vector is never sent back to the client.
+SIMILAR_RECORD_FIELDS = ["id", "name", "description", "status"]
+SIMILAR_RECORD_FILTER_PATH = ["hits.hits._score", "hits.hits._source"]
+
+
+# Builds SimilarRecord-shaped dicts in a single pass over the raw search response, skipping pydantic validation
+def similar_records_from_response(response: Any) -> List[Dict[str, Any]]:
+    hits = response.get('hits', {}).get('hits', [])
+    return [
+        {
+            'id': hit['_source']['id'],
+            'name': hit['_source']['name'],
+            'description': hit['_source'].get('description'),
+            'status': hit['_source'].get('status'),
+            'score': hit['_score'],
+        } for hit in hits
+    ]
+
+
+# Fingerprint of the text a vector was embedded from, used to tell whether a stored vector is still current
+def text_fingerprint(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
@@ -1,21 +1,61 @@
-from app.utils import read_logs_once
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+from app.utils import read_logs_once, JSONBytesResponse
 from pydantic import ValidationError
-from fastapi import APIRouter, FastAPI, Query
+from fastapi import APIRouter, Depends, FastAPI, Header, Query
 from fastapi.exceptions import HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from app.models.api import (RecordInDb, RecordDelete, RecordPatch, RecordCreateReplace, SimilarRecordsQuery,
                             SimilarRecordsResponse,
-                            ErrorResponse, GetCollectionsResponse, SyncRecordsPayload, SimilarRecord)
+                            ErrorResponse, GetCollectionsResponse, SyncRecordsPayload, ModelMigrationRequest,
+                            ModelMigrationStatus, MultiCollectionQuery, MultiCollectionResponse)
 from app.db.elastic import Elastic
 from app.db.collection_manager import CollectionManager, PREFIX
+from app.db.change_capture import ChangeCapture
+from app.db.crm_db import crm_db
+from app.db.migration import (get_dual_writer, start_migration, migration_authorized, read_migration_status,
+                              cleanup_stale_migrations)
+from app.db.dedupe import find_duplicates
+from app.db.generation_sync import sync_generations
+from app.db.reseed import reseed_in_background, read_reseed_status
+from app.modules.generations import bump_generation
+from app.modules.similarity_cache import similarity_cache
+from app.modules.name_index import name_indices
+from app.modules.profiling import (ProfilingMiddleware, checkpoint, span, list_profiles, load_profile,
+                                   profiling_authorized)
+from app.modules.admission import AdmissionMiddleware, embedding_admission, request_admission
+from app.config import SUGGEST_DEFAULT_TOP_K, SUGGEST_MAX_TOP_K, DEDUPE_DEFAULT_THRESHOLD, DEDUPE_TOP_K
+
+es = Elastic()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background_tasks: List[asyncio.Task] = [asyncio.create_task(sync_generations(es)),
+                                            asyncio.create_task(cleanup_stale_migrations(
+                                                es, list(CollectionManager().get_used_collections().values())))]
+    # Requests are served from the current aliases right away, the reseed swaps them once each index is complete
+    if (os.getenv('RUN_TESTS', 'false').lower() != 'true'
+            and os.getenv('RESEED_ON_STARTUP', 'true').lower() == 'true'):
+        background_tasks.append(asyncio.create_task(reseed_in_background(es)))
+    # One worker per host polls (file lock), or run python -m app.db.change_capture next to the API instead
+    if os.getenv('CHANGE_CAPTURE_ENABLED', 'false').lower() == 'true':
+        background_tasks.append(asyncio.create_task(ChangeCapture(es).run_forever()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await crm_db.close()
+
 
 app = FastAPI(
     title="ai-service",
     description="API for searching for similar records in CRM database (such as skills, markets, industries, etc..) and synchronizing data.",
-    version="1.0"
+    version="1.0",
+    lifespan=lifespan
 )
 router = APIRouter()
-es = Elastic()
 
 
 @router.get(path="/collections",
@@ -44,24 +84,39 @@ async def list_collections() -> GetCollectionsResponse:
              response_model=dict,
              responses={200: {"success": "Data received successfully"}, 500: {"model": ErrorResponse}})
 async def sync(collection_name: str, sync_records: SyncRecordsPayload):
+    checkpoint("validation")
     try:
         collection_manager = CollectionManager()
         collections = collection_manager.get_all_collections()  # Getting all collections for tests
         collection_name = collections[collection_name]
-        for record in sync_records.payload:
-            match record.data.method:
-                case 'POST' | 'PUT':
-                    record_create_replace = RecordCreateReplace(**record.data.model_dump())
-                    await es.create_replace_record(collection_name, record_create_replace)
-                case 'PATCH':
-                    record_patch = RecordPatch(**record.data.model_dump())
-                    await es.partial_update_record(collection_name, record_patch)
-                case 'DELETE':
-                    record_delete = RecordDelete(**record.data.model_dump())
-                    await es.delete_record(collection_name, record_delete)
-                case _:
-                    raise ValueError('Invalid method')
+        try:
+            for record in sync_records.payload:
+                with span("record", method=record.data.method, id=record.data.id):
+                    match record.data.method:
+                        case 'POST' | 'PUT':
+                            record_create_replace = RecordCreateReplace(**record.data.model_dump())
+                            await es.create_replace_record(collection_name, record_create_replace)
+                            synced_record = record_create_replace
+                        case 'PATCH':
+                            record_patch = RecordPatch(**record.data.model_dump())
+                            await es.partial_update_record(collection_name, record_patch)
+                            synced_record = record_patch
+                        case 'DELETE':
+                            record_delete = RecordDelete(**record.data.model_dump())
+                            await es.delete_record(collection_name, record_delete)
+                            synced_record = record_delete
+                        case _:
+                            raise ValueError('Invalid method')
+                    # Keep the shadow index of a running model migration in sync
+                    dual_writer = await get_dual_writer(es, collection_name)
+                    if dual_writer:
+                        await dual_writer.dual_write(synced_record)
+        finally:
+            # Invalidates cached results even if only part of the payload was applied
+            bump_generation(collection_name, [record.data.id for record in sync_records.payload])
         return {"message": "Data received successfully"}
+    except HTTPException:
+        raise
     except ValidationError as e:
         raise HTTPException(status_code=422, detail=e.errors())
     except Exception as e:
@@ -76,20 +131,33 @@ async def sync(collection_name: str, sync_records: SyncRecordsPayload):
              responses={200: {"description": "A list of similar records"}, 400: {"model": ErrorResponse},
                         404: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
 async def find_similar_records(collection_name: str, query_data: SimilarRecordsQuery, top_n: int = 1) -> (
-        SimilarRecordsResponse):
+        JSONBytesResponse):
+    checkpoint("validation")
     try:
         collection_manager = CollectionManager()
         collections = collection_manager.get_used_collections()
         collection_name = collections[collection_name]
-        response = SimilarRecordsResponse(data=[])
-        for text in query_data.query:
-            elastic_response = await es.similarity_search(collection_name, text, top_n)
-            if elastic_response:
-                for hit in elastic_response.hits.hits:
-                    record = SimilarRecord(**hit.source.model_dump(), score=hit.score)
-                    response.data.append(record)
-        return response
+        # Hits are already SimilarRecord-shaped dicts, so they are serialized directly instead of being
+        # validated again through response_model.
+        data: List[Dict[str, Any]] = []
+        # Queries that are exactly a record's name are answered from the name index, only the others are embedded
+        with span("exact_names", texts=len(query_data.query)):
+            name_index = name_indices.current(collection_name, lambda ids: es.name_records(collection_name, ids))
+            exact_hits = name_indices.exact_hits(name_index, query_data.query, top_n)
+            if top_n > 1:
+                exact_hits = await es.expand_exact_hits(collection_name, exact_hits, top_n)
+        remaining = [text for text, hits in zip(query_data.query, exact_hits) if hits is None]
+        with span("similarity_search", texts=len(remaining)):
+            results = iter(await similarity_cache.get_many(
+                collection_name, remaining, top_n,
+                lambda texts: es.find_similar_records(collection_name, texts, top_n)))
+        for hits in exact_hits:
+            data.extend(hits if hits is not None else next(results))
+        with span("serialization", records=len(data)):
+            return JSONBytesResponse(content={"data": data})
 
+    except HTTPException:
+        raise
     except Exception as e:
         if "not found" in str(object=e).lower():
             raise HTTPException(status_code=404, detail="Collection not found")
@@ -100,6 +168,118 @@ async def find_similar_records(collection_name: str, query_data: SimilarRecordsQ
             raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post(path="/similarities",
+             response_model=MultiCollectionResponse,
+             summary="Find top_n most similar records across collections",
+             description="Returns the top_n most similar records of every query string in each of the given "
+                         "collections (all collections by default), grouped by collection and query. Each string is "
+                         "embedded once and all collections are searched in a single multi-search.",
+             responses={200: {"description": "Similar records by collection and query"}, 404: {"model": ErrorResponse},
+                        500: {"model": ErrorResponse}})
+async def find_similar_records_across(query_data: MultiCollectionQuery, top_n: int = 1) -> JSONBytesResponse:
+    checkpoint("validation")
+    collections = CollectionManager().get_used_collections()
+    names = query_data.collections or list(collections.keys())
+    unknown = [name for name in names if name not in collections]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Collections not found: {unknown}")
+    names = list(dict.fromkeys(names))
+    try:
+        results = await es.find_similar_records_multi([collections[name] for name in names], query_data.query, top_n)
+        data = {name: [{"query": text, "records": hits or []}
+                       for text, hits in zip(query_data.query, results[collections[name]])] for name in names}
+        with span("serialization"):
+            return JSONBytesResponse(content={"data": data})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get(path="/collections/{collection_name}/suggest",
+            summary="Suggest records by name",
+            description="Returns up to top_k records whose name starts with the query (case, accent and punctuation "
+                        "insensitive), followed by typo-tolerant matches. Served from an in-memory index of the "
+                        "collection's names without running the embedding model.",
+            responses={200: {"description": "A list of suggested records"}, 404: {"model": ErrorResponse},
+                       500: {"model": ErrorResponse}})
+async def suggest(collection_name: str, q: str = Query(..., description="What the user has typed so far"),
+                  top_k: int = Query(SUGGEST_DEFAULT_TOP_K, ge=1, le=SUGGEST_MAX_TOP_K)) -> JSONBytesResponse:
+    collections = CollectionManager().get_used_collections()
+    if collection_name not in collections:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    collection_name = collections[collection_name]
+    try:
+        name_index = await name_indices.get(collection_name, lambda ids: es.name_records(collection_name, ids))
+        return JSONBytesResponse(content={"data": name_index.suggest(q, top_k)})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get(path="/collections/{collection_name}/duplicates",
+            summary="Near-duplicate records",
+            description="Groups the records of the collection whose stored vectors have at least the given cosine "
+                        "similarity, largest clusters first. Compares all pairs of records without running the "
+                        "embedding model; a large collection takes a while.",
+            responses={200: {"description": "Clusters of near-duplicate records"}, 404: {"model": ErrorResponse},
+                       500: {"model": ErrorResponse}})
+async def duplicates(collection_name: str,
+                     threshold: float = Query(DEDUPE_DEFAULT_THRESHOLD, gt=0, le=1,
+                                              description="Minimum cosine similarity within a cluster"),
+                     top_k: int = Query(DEDUPE_TOP_K, ge=1, le=100)) -> JSONBytesResponse:
+    collections = CollectionManager().get_used_collections()
+    if collection_name not in collections:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    try:
+        return JSONBytesResponse(content=await find_duplicates(es, collections[collection_name], threshold, top_k))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(path="/collections/{collection_name}/migrations",
+             response_model=ModelMigrationStatus,
+             summary="Start a model migration",
+             description="Re-embeds the collection with another model (revision) into a shadow index in the background. "
+                         "Writes through /sync are applied to both indices and the alias is switched once the shadow "
+                         "index has caught up. Requires the MIGRATION_TOKEN in X-Migration-Token and a model listed "
+                         "in MIGRATION_ALLOWED_MODELS.",
+             responses={202: {"model": ModelMigrationStatus}, 400: {"model": ErrorResponse},
+                        403: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 409: {"model": ErrorResponse}},
+             status_code=202)
+async def migrate_collection(collection_name: str, migration_request: ModelMigrationRequest,
+                             x_migration_token: Optional[str] = Header(None)) -> ModelMigrationStatus:
+    if not migration_authorized(x_migration_token):
+        raise HTTPException(status_code=403, detail="Invalid or missing migration token")
+    collections = CollectionManager().get_used_collections()
+    if collection_name not in collections:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    try:
+        migration = await start_migration(es, collection_name, collections[collection_name],
+                                          migration_request.model_name, migration_request.model_revision,
+                                          cpu_budget=migration_request.cpu_budget,
+                                          max_docs_per_second=migration_request.max_docs_per_second)
+        return migration.status()
+    except PermissionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.get(path="/collections/{collection_name}/migrations",
+            response_model=ModelMigrationStatus,
+            summary="Model migration status",
+            description="Returns the progress of the latest model migration of the collection.",
+            responses={404: {"model": ErrorResponse}})
+async def migration_status(collection_name: str) -> ModelMigrationStatus:
+    collections = CollectionManager().get_used_collections()
+    if collection_name not in collections:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    status = await read_migration_status(es, collections[collection_name])
+    if not status:
+        raise HTTPException(status_code=404, detail="No migration found for collection")
+    return status
+
+
 async def health_check():
     return True
 
@@ -108,7 +288,63 @@ async def health_check():
 async def ping():
     elastic = "success" if await es.client.ping() else "an error has occurred while connecting to Elasticsearch"
     ai_service = "success" if await health_check() else "an error has occurred while connecting to AI service"
-    return {"elastic": elastic, "ai-service": ai_service}
+    return {"elastic": elastic, "ai-service": ai_service, "crm-db": await crm_db.health_check(),
+            "reseed": read_reseed_status()}
+
+
+@router.get(path="/metrics",
+            summary="Service metrics",
+            description="Returns hit rate and memory use of the similarity result cache, the size of the "
+                        "in-memory name indices, the share of queries answered by exact name matches and the "
+                        "admission control queue and shed counts and the CRM database connection pool.")
+async def metrics() -> Dict[str, Any]:
+    return {"similarity_cache": similarity_cache.stats(), "name_indices": name_indices.stats(),
+            "admission": {"requests": request_admission.stats(), "embedding": embedding_admission.stats()},
+            "crm_db": crm_db.stats()}
+
+
+def require_profiling_token(x_profiling_token: Optional[str] = Header(None)) -> None:
+    # Profiles hold request paths, span attributes (record ids) and stacks; a separate header from X-Profile, so
+    # reading them does not profile the read
+    if not profiling_authorized(x_profiling_token):
+        raise HTTPException(status_code=403, detail="Invalid or missing profiling token")
+
+
+@router.get(path="/profiles",
+            summary="List stored request profiles",
+            description="Returns the newest profiles of requests profiled on demand or captured for being slow. "
+                        "Requires the PROFILING_TOKEN in X-Profiling-Token.",
+            responses={403: {"model": ErrorResponse}},
+            dependencies=[Depends(require_profiling_token)])
+async def profiles(limit: int = Query(50, ge=1, description="Number of profiles to return")) -> Dict[str, Any]:
+    return {"profiles": await asyncio.to_thread(list_profiles, limit)}
+
+
+@router.get(path="/profiles/{profile_id}",
+            summary="Get a request profile",
+            description="Returns the span breakdown of a profiled request. Requires the PROFILING_TOKEN in "
+                        "X-Profiling-Token.",
+            responses={403: {"model": ErrorResponse}, 404: {"model": ErrorResponse}},
+            dependencies=[Depends(require_profiling_token)])
+async def profile(profile_id: str) -> Dict[str, Any]:
+    result = await asyncio.to_thread(load_profile, profile_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return result
+
+
+@router.get(path="/profiles/{profile_id}/flamegraph",
+            response_class=PlainTextResponse,
+            summary="Get the flame graph of a request profile",
+            description="Returns the sampled stacks of a profiled request in folded format (flamegraph.pl, "
+                        "speedscope). Requires the PROFILING_TOKEN in X-Profiling-Token.",
+            responses={403: {"model": ErrorResponse}, 404: {"model": ErrorResponse}},
+            dependencies=[Depends(require_profiling_token)])
+async def profile_flamegraph(profile_id: str) -> PlainTextResponse:
+    result = await asyncio.to_thread(load_profile, profile_id)
+    if result is None or not result.get("flamegraph"):
+        raise HTTPException(status_code=404, detail="Flame graph not found")
+    return PlainTextResponse(content=result["flamegraph"])
 
 
 @router.get(path="/logs", response_class=HTMLResponse)
@@ -142,3 +378,5 @@ async def info(n: int = Query(10, description="Number of lines of stdout to retr
 
 
 app.include_router(router=router, prefix="/api/v1", tags=["v1"])
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(ProfilingMiddleware)
@@ -1,6 +1,7 @@
-from pydantic import BaseModel, Field, field_validator, model_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+from datetime import datetime
 from enum import Enum
-from typing import List, Literal, Optional, Union, Any
+from typing import Dict, List, Literal, Optional, Union, Any
 from fastapi import HTTPException
 
 
@@ -97,3 +98,43 @@ class SimilarRecordsQuery(BaseModel):
 
 class SimilarRecordsResponse(BaseModel):
     data: List[SimilarRecord]
+
+
+class MultiCollectionQuery(BaseModel):
+    query: List[str] = Field(..., min_length=1)
+    collections: Optional[List[str]] = Field(None, min_length=1, description="Collections to search, all by default")
+
+
+class QuerySimilarRecords(BaseModel):
+    query: str
+    records: List[SimilarRecord]
+
+
+class MultiCollectionResponse(BaseModel):
+    data: Dict[str, List[QuerySimilarRecords]]
+
+
+class ModelMigrationRequest(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    model_name: str = Field(..., min_length=1)
+    model_revision: str = Field(..., min_length=1)
+    cpu_budget: Optional[float] = Field(None, gt=0, le=1, description="Share of CPU time the re-embedding may use")
+    max_docs_per_second: Optional[float] = Field(None, gt=0)
+
+
+class ModelMigrationStatus(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    collection: str
+    model_name: str
+    model_revision: str
+    state: str
+    source_index: Optional[str] = None
+    shadow_index: str
+    total: int
+    processed: int
+    dual_writes: int
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    error: Optional[str] = None
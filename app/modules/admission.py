@@ -0,0 +1,184 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+import orjson
+from fastapi.exceptions import HTTPException
+from app.config import (MAX_CONCURRENT_REQUESTS, EMBEDDING_MAX_CONCURRENT, EMBEDDING_MAX_QUEUED,
+                        REQUEST_TIMEOUT_SECONDS)
+from app.modules.profiling import span
+
+# Monotonic deadline of the current search or sync request. Work outside such requests (reseeds, migrations,
+# change capture) has none and is never shed.
+request_deadline: ContextVar[Optional[float]] = ContextVar('request_deadline', default=None)
+
+
+class Overloaded(HTTPException):
+    def __init__(self, retry_after: int, detail: str = "Service overloaded, retry later"):
+        super().__init__(status_code=503, detail=detail, headers={"Retry-After": str(retry_after)})
+
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=504, detail="Request deadline exceeded")
+
+
+class EmbeddingAdmission:
+    # Bounded FIFO in front of the model. Waiters whose request deadline passes leave the queue before they
+    # reach the model, and a full queue rejects new work right away instead of letting it time out later.
+    def __init__(self, max_concurrent: int = EMBEDDING_MAX_CONCURRENT, max_queued: int = EMBEDDING_MAX_QUEUED):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.queued_total = 0
+        self.shed_queue_full = 0
+        self.shed_deadline = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        # Moving average of the time an admitted call holds its slot, used for Retry-After
+        self.service_time = 0.1
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.service_time * (len(self.waiters) + 1) / self.max_concurrent))
+
+    def _release(self) -> None:
+        # The slot is handed to the oldest waiter that is still waiting
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    async def _acquire(self, deadline: float) -> None:
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_queued:
+            self.shed_queue_full += 1
+            raise Overloaded(self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.queued_total += 1
+        start = time.monotonic()
+        try:
+            with span("embedding_queue"):
+                await asyncio.wait_for(waiter, timeout=max(0.0, deadline - start))
+        except asyncio.TimeoutError:
+            self.shed_deadline += 1
+            raise DeadlineExceeded()
+        except asyncio.CancelledError:
+            # Cancelled right after being handed the slot: pass it on
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            # A waiter that was not handed the slot leaves the queue, so it no longer counts against max_queued
+            try:
+                self.waiters.remove(waiter)
+            except ValueError:
+                pass
+            wait = time.monotonic() - start
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        deadline = request_deadline.get()
+        if deadline is None:
+            yield
+            return
+        if time.monotonic() >= deadline:
+            self.shed_deadline += 1
+            raise DeadlineExceeded()
+        await self._acquire(deadline)
+        try:
+            # The caller may have timed out while queued
+            if time.monotonic() >= deadline:
+                self.shed_deadline += 1
+                raise DeadlineExceeded()
+            self.admitted += 1
+            start = time.monotonic()
+            try:
+                yield
+            finally:
+                self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - start)
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_deadline": self.shed_deadline,
+            "queue_wait_avg_seconds": self.queue_wait_total / self.queued_total if self.queued_total else 0.0,
+            "queue_wait_max_seconds": self.queue_wait_max,
+            "service_time_seconds": self.service_time
+        }
+
+
+embedding_admission = EmbeddingAdmission()
+
+
+def is_admission_controlled(method: str, path: str) -> bool:
+    return method == "POST" and (path.endswith("/similarities") or path.endswith("/sync"))
+
+
+class RequestAdmission:
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_REQUESTS):
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.rejected = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": self.in_flight, "max_concurrent": self.max_concurrent, "rejected": self.rejected}
+
+
+request_admission = RequestAdmission()
+
+
+def request_timeout(headers: List[Tuple[bytes, bytes]]) -> float:
+    for key, value in headers:
+        if key == b"x-request-timeout":
+            try:
+                return min(REQUEST_TIMEOUT_SECONDS, max(0.0, float(value)))
+            except ValueError:
+                break
+    return REQUEST_TIMEOUT_SECONDS
+
+
+class AdmissionMiddleware:
+    # Caps the search and sync requests in flight and gives each of them a deadline
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not is_admission_controlled(scope["method"], scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        if request_admission.in_flight >= request_admission.max_concurrent:
+            request_admission.rejected += 1
+            await send({"type": "http.response.start", "status": 503, "headers": [
+                (b"content-type", b"application/json"),
+                (b"retry-after", str(embedding_admission.retry_after()).encode())]})
+            await send({"type": "http.response.body",
+                        "body": orjson.dumps({"detail": "Too many requests in flight, retry later"})})
+            return
+
+        token = request_deadline.set(time.monotonic() + request_timeout(scope["headers"]))
+        request_admission.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_admission.in_flight -= 1
+            request_deadline.reset(token)
@@ -1,17 +1,115 @@
 import asyncio
+import gc
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from typing import List
+import torch
+from typing import Dict, List, Set, Tuple
 from torch import Tensor
 from sentence_transformers import SentenceTransformer
+from app.config import MODEL_NAME, MODEL_REVISION, MIGRATION_ALLOWED_MODELS
+from app.modules.profiling import span
+from app.modules.admission import embedding_admission
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
 
 model = SentenceTransformer(
-    model_name_or_path='Alibaba-NLP/gte-large-en-v1.5', trust_remote_code=True,
-    revision='a0d6174973604c8ef416d9f6ed0f4c17ab32d78d')
+    model_name_or_path=MODEL_NAME, trust_remote_code=True,
+    revision=MODEL_REVISION)
+
+# Loaded models by (name, revision); other revisions are only loaded for model migrations. The configured model
+# is loaded before the workers fork and shared by them, the others are loaded by every worker that needs them.
+models: Dict[Tuple[str, str], SentenceTransformer] = {(MODEL_NAME, MODEL_REVISION): model}
+# Models being loaded in a thread, so concurrent callers wait for the same load
+loading: Dict[Tuple[str, str], asyncio.Task] = {}
+
+# One encode at a time per process: concurrent encodes would each start their own set of torch threads and
+# oversubscribe the worker's CPU share. The thread is only started on first use, so never before a fork.
+encode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encode")
+
+
+def is_allowed_model(model_name: str, revision: str) -> bool:
+    return (model_name, revision) == (MODEL_NAME, MODEL_REVISION) or (model_name, revision) in MIGRATION_ALLOWED_MODELS
+
+
+def load_model(model_name: str = MODEL_NAME, revision: str = MODEL_REVISION) -> SentenceTransformer:
+    key = (model_name, revision)
+    if key not in models:
+        # Loading runs code from the model repository, whatever an index's _meta or a request names
+        if not is_allowed_model(model_name, revision):
+            raise ValueError(f"Model {model_name}@{revision} is not in MIGRATION_ALLOWED_MODELS")
+        models[key] = SentenceTransformer(model_name_or_path=model_name, trust_remote_code=True, revision=revision)
+    return models[key]
+
+
+def configure_threads(intra_op_threads: int, inter_op_threads: int = 1) -> None:
+    # Called once per worker right after fork, before the worker runs any inference
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError as e:
+        # Inter-op threads can only be set before the first parallel work in the process
+        logger.warning(f"Could not set torch inter-op threads to {inter_op_threads}: {e}")
+    logger.info(f"Torch configured with {intra_op_threads} intra-op and {inter_op_threads} inter-op threads")
+
+
+def _start_loading(model_name: str, revision: str) -> asyncio.Task:
+    key = (model_name, revision)
+    task = loading.get(key)
+    if task is None:
+        # Loading reads (or downloads) the weights for seconds, the event loop keeps serving meanwhile
+        task = asyncio.create_task(asyncio.to_thread(load_model, model_name, revision))
+        task.add_done_callback(lambda _: loading.pop(key, None))
+        loading[key] = task
+    return task
+
+
+async def ensure_model(model_name: str = MODEL_NAME, revision: str = MODEL_REVISION) -> SentenceTransformer:
+    loaded = models.get((model_name, revision))
+    if loaded is not None:
+        return loaded
+    return await asyncio.shield(_start_loading(model_name, revision))
+
+
+def preload_model(model_name: str, revision: str) -> None:
+    # Loads a model in the background ahead of its first use
+    if (model_name, revision) in models:
+        return
+    _start_loading(model_name, revision).add_done_callback(_log_preload_failure)
+
+
+def _log_preload_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Preloading a model failed: {task.exception()}")
+
+
+def evict_models(in_use: Set[Tuple[str, str]]) -> None:
+    # Drops models nothing refers to anymore (after a migration switched or failed), never the configured one
+    unused = [key for key in models if key not in in_use and key != (MODEL_NAME, MODEL_REVISION)]
+    for key in unused:
+        del models[key]
+        logger.info(f"Evicted unused model {key[0]}@{key[1]}")
+    if unused:
+        gc.collect()
+
+
+async def get_model_dimension(model_name: str = MODEL_NAME, revision: str = MODEL_REVISION) -> int:
+    dimension = (await ensure_model(model_name, revision)).get_sentence_embedding_dimension()
+    if dimension is None:
+        raise ValueError(f"Unknown embedding dimension for model {model_name}@{revision}")
+    return dimension
 
 
-async def get_embedding(texts: List[str]) -> List[List[float]]:
-    embeddings = model.encode(texts, show_progress_bar=False, convert_to_tensor=True)
+async def get_embedding(texts: List[str], model_name: str = MODEL_NAME,
+                        revision: str = MODEL_REVISION) -> List[List[float]]:
+    encoder = await ensure_model(model_name, revision)
+    # Encoding runs in a worker thread (torch releases the GIL) so the event loop keeps serving requests
+    # Request-path calls wait for an admission slot and are shed when the queue is full or their deadline passed
+    async with embedding_admission.slot():
+        with span("embedding", texts=len(texts)):
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                encode_executor, lambda: encoder.encode(texts, show_progress_bar=False, convert_to_tensor=True))
 
     if isinstance(embeddings, Tensor) or isinstance(embeddings, np.ndarray):
         return embeddings.tolist()
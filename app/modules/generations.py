@@ -0,0 +1,162 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+from app.db.collection_manager import CollectionManager
+
+# Per-collection generation counters, bumped on every write to a collection and on every alias swap.
+# In-memory state derived from a collection (caches, lookup indices) is only valid for the generation it was
+# built at. The counters live in a small memory-mapped file so that all workers on a host see each other's
+# bumps; collections outside CollectionManager fall back to process-local counters.
+GENERATIONS_FILE = os.getenv('GENERATIONS_FILE', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'ai-service-generations'))
+SLOT = struct.Struct('<qd')  # generation, wall-clock time of the last bump
+# Index and delete operations this host made on each collection, after the generation slots. Operations counted
+# here are known to the host's generations already, polling for other replicas' writes subtracts them.
+WRITES = struct.Struct('<qq')
+# Ids of the records each bump changed, as JSON lines of [collection, generation, ids], so in-memory state can be
+# updated instead of rebuilt. Bumps that do not know their records (alias swaps, writes on other replicas) leave a
+# gap. The journal starts over once it exceeds CHANGES_MAX_BYTES, readers then see gaps and rebuild.
+CHANGES_FILE = f"{GENERATIONS_FILE}.changes"
+CHANGES_MAX_BYTES = 256 * 1024
+
+local_generations: Dict[str, Tuple[int, float]] = {}
+
+
+class SharedGenerations:
+    def __init__(self, path: str = GENERATIONS_FILE, changes_path: str = CHANGES_FILE):
+        self.path = path
+        self.changes_path = changes_path
+        self.slots = {name: i for i, name in enumerate(sorted(CollectionManager().get_all_collections().values()))}
+        self.writes_offset = SLOT.size * len(self.slots)
+        size = self.writes_offset + WRITES.size * len(self.slots)
+        self.fd: Optional[int] = None
+        self.fd_pid: Optional[int] = None
+        fd = self.lock_fd()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+                # Generations of a new file start over, changes recorded under the old numbers no longer apply
+                open(self.changes_path, 'w').close()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        # The shared mapping stays valid across fork
+        self.map = mmap.mmap(fd, size)
+
+    def lock_fd(self) -> int:
+        # flock belongs to the open file, and a descriptor inherited from the gunicorn master is the same open file
+        # in every worker, so the workers would not exclude each other. Each process opens the file itself.
+        if self.fd_pid != os.getpid():
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.fd_pid = os.getpid()
+        return self.fd
+
+    def read(self, collection: str) -> Optional[Tuple[int, float]]:
+        slot = self.slots.get(collection)
+        if slot is None:
+            return None
+        return SLOT.unpack_from(self.map, slot * SLOT.size)
+
+    def read_writes(self, collection: str) -> Optional[Tuple[int, int]]:
+        slot = self.slots.get(collection)
+        if slot is None:
+            return None
+        return WRITES.unpack_from(self.map, self.writes_offset + slot * WRITES.size)
+
+    def count_writes(self, collection: str, indexed: int, deleted: int) -> None:
+        slot = self.slots.get(collection)
+        if slot is None:
+            return
+        fd = self.lock_fd()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            total_indexed, total_deleted = WRITES.unpack_from(self.map, self.writes_offset + slot * WRITES.size)
+            WRITES.pack_into(self.map, self.writes_offset + slot * WRITES.size, total_indexed + indexed,
+                             total_deleted + deleted)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def bump(self, collection: str, record_ids: Optional[Iterable[str]] = None) -> Optional[int]:
+        slot = self.slots.get(collection)
+        if slot is None:
+            return None
+        fd = self.lock_fd()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            generation, _ = SLOT.unpack_from(self.map, slot * SLOT.size)
+            SLOT.pack_into(self.map, slot * SLOT.size, generation + 1, time.time())
+            if record_ids is not None:
+                # Written under the same lock, a reader never sees a generation before its changes
+                line = json.dumps([collection, generation + 1, sorted(set(record_ids))]) + "\n"
+                with open(self.changes_path, 'a') as file:
+                    if file.tell() + len(line) > CHANGES_MAX_BYTES:
+                        file.truncate(0)
+                    file.write(line)
+            return generation + 1
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def changes(self, collection: str, since: int, until: int) -> Optional[Set[str]]:
+        fd = self.lock_fd()
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            with open(self.changes_path, 'r') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return None
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        changed: Dict[int, Set[str]] = {}
+        for line in lines:
+            name, generation, ids = json.loads(line)
+            if name == collection and since < generation <= until:
+                changed[generation] = set(ids)
+        if len(changed) < until - since:
+            return None
+        return set().union(*changed.values())
+
+
+shared_generations = SharedGenerations()
+
+
+def get_generation(collection: str) -> int:
+    shared = shared_generations.read(collection)
+    return shared[0] if shared else local_generations.get(collection, (0, 0.0))[0]
+
+
+def bump_generation(collection: str, record_ids: Optional[Iterable[str]] = None) -> int:
+    # record_ids are the records the bump stands for, None when they are unknown
+    generation = shared_generations.bump(collection, record_ids)
+    if generation is None:
+        generation = local_generations.get(collection, (0, 0.0))[0] + 1
+        local_generations[collection] = (generation, time.time())
+    return generation
+
+
+def changed_records(collection: str, since: int, until: int) -> Optional[Set[str]]:
+    # Ids of the records changed between two generations, None when a bump in between did not record them
+    if until <= since:
+        return set()
+    if collection not in shared_generations.slots:
+        return None
+    return shared_generations.changes(collection, since, until)
+
+
+def count_local_writes(collection: str, indexed: int = 0, deleted: int = 0) -> None:
+    # Called for every index or delete operation Elasticsearch applied to a collection alias from this host
+    shared_generations.count_writes(collection, indexed, deleted)
+
+
+def local_writes(collection: str) -> Tuple[int, int]:
+    return shared_generations.read_writes(collection) or (0, 0)
+
+
+def seconds_since_bump(collection: str) -> float:
+    shared = shared_generations.read(collection)
+    bumped_at = shared[1] if shared else local_generations.get(collection, (0, 0.0))[1]
+    return time.time() - bumped_at if bumped_at else float('inf')
@@ -0,0 +1,236 @@
+import asyncio
+import bisect
+import math
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+from app.config import SUGGEST_FUZZY_MIN_SIMILARITY, NAME_INDEX_MAX_CHANGES
+from app.modules.generations import get_generation, changed_records
+from app.utils import normalize_name
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+NameRecord = Dict[str, Any]
+# Loads the records with the given ids, or every record of the collection for None
+NameLoader = Callable[[Optional[List[str]]], Awaitable[List[NameRecord]]]
+
+
+def trigrams(name: str) -> List[str]:
+    # Padded at the start only: queries are prefixes of what the user is typing
+    padded = f"  {name}"
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+class NameIndex:
+    # In-memory lookup over the names of one collection generation: every word-start suffix of the normalized names
+    # for prefix matches, bucketed by the length of the name, and trigram postings for typo-tolerant matches.
+    # Records changed by later generations are applied in place; a removed record leaves its slot behind.
+    def __init__(self, records: List[NameRecord], generation: int):
+        self.generation = generation
+        self.records: List[Optional[NameRecord]] = []
+        self.names: List[str] = []
+        self.slots: Dict[str, List[int]] = defaultdict(list)
+        self.removed: Set[int] = set()
+        self.exact: Dict[str, List[int]] = defaultdict(list)
+        # Sorted (key, slot) pairs by name length: whole names rank before names with a later word matching,
+        # shorter names first, without scanning every name that shares a short prefix
+        self.name_keys: Dict[int, List[Tuple[str, int]]] = defaultdict(list)
+        self.word_keys: Dict[int, List[Tuple[str, int]]] = defaultdict(list)
+        self.postings: Dict[str, np.ndarray] = {}
+        postings = self._add(records, sort=False)
+        for buckets in (self.name_keys, self.word_keys):
+            for bucket in buckets.values():
+                bucket.sort()
+        self.postings = {trigram: np.array(ids, dtype=np.int32) for trigram, ids in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.records) - len(self.removed)
+
+    @staticmethod
+    def _keys(name: str) -> List[str]:
+        keys, start = [], 0
+        for word in name.split(" "):
+            keys.append(name[start:])
+            start += len(word) + 1
+        return keys
+
+    def _add(self, records: List[NameRecord], sort: bool = True) -> Dict[str, List[int]]:
+        postings: Dict[str, List[int]] = defaultdict(list)
+        for record in records:
+            i = len(self.records)
+            name = normalize_name(record["name"])
+            self.records.append(record)
+            self.names.append(name)
+            self.slots[record["id"]].append(i)
+            self.exact[name].append(i)
+            for position, key in enumerate(self._keys(name)):
+                bucket = (self.word_keys if position else self.name_keys)[len(name)]
+                if sort:
+                    bisect.insort(bucket, (key, i))
+                else:
+                    bucket.append((key, i))
+            for trigram in set(trigrams(name)):
+                postings[trigram].append(i)
+        return postings
+
+    def _remove(self, record_id: str) -> None:
+        for i in self.slots.pop(record_id, []):
+            name = self.names[i]
+            self.exact[name].remove(i)
+            if not self.exact[name]:
+                del self.exact[name]
+            for position, key in enumerate(self._keys(name)):
+                bucket = (self.word_keys if position else self.name_keys)[len(name)]
+                del bucket[bisect.bisect_left(bucket, (key, i))]
+            # Trigram postings keep the slot, fuzzy matching skips removed slots
+            self.records[i] = None
+            self.removed.add(i)
+
+    def needs_rebuild(self, changes: int) -> bool:
+        # Many changes at once are cheaper to rebuild, and removed slots only take memory
+        return changes > NAME_INDEX_MAX_CHANGES or len(self.removed) + changes > len(self)
+
+    def apply(self, changed_ids: Set[str], records: List[NameRecord], generation: int) -> None:
+        # records are the current versions of the changed records, changed ids without one were deleted
+        for record_id in changed_ids:
+            self._remove(record_id)
+        for trigram, ids in self._add(records).items():
+            added = np.array(ids, dtype=np.int32)
+            self.postings[trigram] = np.concatenate([self.postings[trigram], added]) \
+                if trigram in self.postings else added
+        self.generation = generation
+
+    def prefix_matches(self, query: str, limit: int) -> List[int]:
+        # Names starting with the query rank before names with a later word starting with it, shorter names first
+        matches: List[int] = []
+        for buckets in (self.name_keys, self.word_keys):
+            for length in sorted(length for length in buckets if length >= len(query)):
+                bucket = buckets[length]
+                position = bisect.bisect_left(bucket, (query,))
+                while position < len(bucket) and bucket[position][0].startswith(query):
+                    i = bucket[position][1]
+                    if i not in matches:
+                        matches.append(i)
+                        if len(matches) == limit:
+                            return matches
+                    position += 1
+        return matches
+
+    def fuzzy_matches(self, query: str, limit: int, exclude: List[int]) -> List[int]:
+        query_trigrams = set(trigrams(query))
+        lists = [self.postings[trigram] for trigram in query_trigrams if trigram in self.postings]
+        if not lists:
+            return []
+        shared = np.bincount(np.concatenate(lists), minlength=len(self.records))
+        shared[exclude] = 0
+        shared[list(self.removed)] = 0
+        candidates = np.flatnonzero(shared >= math.ceil(SUGGEST_FUZZY_MIN_SIMILARITY * len(query_trigrams)))
+        ranked = sorted(candidates.tolist(), key=lambda i: (-shared[i], len(self.names[i])))
+        return ranked[:limit]
+
+    def suggest(self, query: str, top_k: int) -> List[NameRecord]:
+        normalized = normalize_name(query)
+        if not normalized:
+            return []
+        matches = self.prefix_matches(normalized, top_k)
+        # Fuzzy matching needs a few characters, shorter queries would match nearly everything
+        if len(matches) < top_k and len(normalized) >= 3:
+            matches += self.fuzzy_matches(normalized, top_k - len(matches), matches)
+        return [{"id": self.records[i]["id"], "name": self.records[i]["name"]} for i in matches]
+
+    def exact_matches(self, text: str) -> List[NameRecord]:
+        return [self.records[i] for i in self.exact.get(normalize_name(text), [])]  # type: ignore
+
+
+class NameIndices:
+    # One NameIndex per collection, brought up to date whenever the collection's generation changes (every /sync
+    # write, change capture batch and alias swap). Only the records a write changed are loaded again when every bump
+    # since the index's generation recorded them, otherwise the index is rebuilt from the whole collection. Requests
+    # keep using the previous generation meanwhile.
+    def __init__(self):
+        self.indices: Dict[str, NameIndex] = {}
+        self.building: Dict[str, asyncio.Task] = {}
+        self.exact_lookup_count = 0
+        self.exact_hit_count = 0
+
+    async def get(self, collection: str, load: NameLoader) -> NameIndex:
+        generation = get_generation(collection)
+        index = self.indices.get(collection)
+        if index is not None and index.generation == generation:
+            return index
+        task = self._start_build(collection, generation, load)
+        if index is None:
+            return await asyncio.shield(task)
+        return index
+
+    def current(self, collection: str, load: NameLoader) -> Optional[NameIndex]:
+        # Only an index built at the current generation may answer in place of a search, a stale one could miss
+        # a name that was just synced. A missing or stale index is (re)built in the background meanwhile.
+        generation = get_generation(collection)
+        index = self.indices.get(collection)
+        if index is not None and index.generation == generation:
+            return index
+        self._start_build(collection, generation, load)
+        return None
+
+    def _start_build(self, collection: str, generation: int,
+                     load: NameLoader) -> asyncio.Task:
+        task = self.building.get(collection)
+        if task is None:
+            task = asyncio.create_task(self._build(collection, generation, load))
+            # Failures are logged by _build, nobody may be awaiting the task
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self.building[collection] = task
+        return task
+
+    def exact_hits(self, index: Optional[NameIndex], texts: List[str],
+                   top_n: int) -> List[Optional[List[Dict[str, Any]]]]:
+        # Queries naming a record of the collection are answered with that record at score 1.0, None for the rest
+        self.exact_lookup_count += len(texts)
+        if index is None:
+            return [None] * len(texts)
+        results: List[Optional[List[Dict[str, Any]]]] = []
+        for text in texts:
+            matches = index.exact_matches(text)[:top_n]
+            results.append([{'id': record['id'], 'name': record['name'], 'description': record.get('description'),
+                             'status': record.get('status'), 'score': 1.0} for record in matches] or None)
+        self.exact_hit_count += sum(hits is not None for hits in results)
+        return results
+
+    async def _build(self, collection: str, generation: int,
+                     load: NameLoader) -> NameIndex:
+        try:
+            index = self.indices.get(collection)
+            changed = changed_records(collection, index.generation, generation) if index else None
+            if index is not None and changed is not None and not index.needs_rebuild(len(changed)):
+                records = await load(sorted(changed)) if changed else []
+                index.apply(changed, records, generation)
+                logger.info(f"Updated name index of '{collection}' to generation {generation} with "
+                            f"{len(changed)} changed records")
+                return index
+            records = await load(None)
+            index = await asyncio.to_thread(NameIndex, records, generation)
+            self.indices[collection] = index
+            logger.info(f"Built name index of '{collection}' at generation {generation} with {len(index)} records")
+            return index
+        except Exception as e:
+            logger.error(f"Error building name index of '{collection}': {e}", exc_info=True)
+            # Keep serving the previous index, the next request retries the build
+            if collection in self.indices:
+                return self.indices[collection]
+            raise
+        finally:
+            self.building.pop(collection, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "collections": {collection: {"generation": index.generation, "records": len(index)}
+                            for collection, index in self.indices.items()},
+            "exact_lookups": self.exact_lookup_count,
+            "exact_hits": self.exact_hit_count,
+            "exact_hit_ratio": self.exact_hit_count / self.exact_lookup_count if self.exact_lookup_count else 0.0
+        }
+
+
+name_indices = NameIndices()
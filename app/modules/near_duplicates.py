@@ -0,0 +1,73 @@
+from typing import Any, Dict, List, Tuple
+import numpy as np
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def similar_pairs(vectors: np.ndarray, threshold: float, top_k: int,
+                  block_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # All pairs i < j with cosine similarity >= threshold, at most top_k per i. Rows are compared a block at a time
+    # against the rows after the block start, so memory stays at block_size x rows scores instead of rows x rows.
+    normalized = normalize_rows(vectors)
+    firsts, seconds, scores = [], [], []
+    for start in range(0, len(normalized), block_size):
+        block = normalized[start:start + block_size]
+        block_scores = block @ normalized[start:].T
+        # Only the upper triangle: every pair once, no row paired with itself
+        block_scores[np.tril_indices(len(block), 0, block_scores.shape[1])] = -np.inf
+        rows, columns = np.nonzero(block_scores >= threshold)
+        values = block_scores[rows, columns]
+        # Keep the top_k best matches of every row: rank the matches within each row by descending score
+        order = np.lexsort((-values, rows))
+        rows, columns, values = rows[order], columns[order], values[order]
+        row_starts = np.searchsorted(rows, rows, side='left')
+        keep = np.arange(len(rows)) - row_starts < top_k
+        firsts.append(rows[keep] + start)
+        seconds.append(columns[keep] + start)
+        scores.append(values[keep])
+    if not firsts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(scores)
+
+
+def connected_components(size: int, firsts: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+    # Union-find over the pairs, returns the root of every row
+    parents = np.arange(size)
+
+    def find(i: int) -> int:
+        root = i
+        while parents[root] != root:
+            root = parents[root]
+        while parents[i] != root:
+            parents[i], i = root, parents[i]
+        return root
+
+    for first, second in zip(firsts.tolist(), seconds.tolist()):
+        first_root, second_root = find(first), find(second)
+        if first_root != second_root:
+            parents[max(first_root, second_root)] = min(first_root, second_root)
+    return np.array([find(i) for i in range(size)])
+
+
+def duplicate_clusters(records: List[Dict[str, Any]], vectors: np.ndarray, threshold: float, top_k: int,
+                       block_size: int) -> List[Dict[str, Any]]:
+    # Groups of records connected by pairs above the threshold, largest groups first. Similarity is transitive
+    # within a group, so two of its records may score below the threshold with each other.
+    firsts, seconds, scores = similar_pairs(vectors, threshold, top_k, block_size)
+    roots = connected_components(len(records), firsts, seconds)
+    min_scores: Dict[int, float] = {}
+    for first, score in zip(roots[firsts].tolist(), scores.tolist()):
+        min_scores[first] = min(score, min_scores.get(first, score))
+    members: Dict[int, List[int]] = {root: [] for root in min_scores}
+    for i, root in enumerate(roots.tolist()):
+        if root in members:
+            members[root].append(i)
+    clusters = [{
+        "size": len(rows),
+        "min_score": round(min_scores[root], 6),
+        "records": [{"id": records[i]["id"], "name": records[i]["name"]} for i in rows]
+    } for root, rows in members.items()]
+    return sorted(clusters, key=lambda cluster: (-cluster["size"], -cluster["min_score"]))
@@ -0,0 +1,223 @@
+import asyncio
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import parse_qs
+from app.config import (PROFILE_SLOW_REQUEST_SECONDS, PROFILE_RING_DIR, PROFILE_RING_SIZE,
+                        PROFILE_SAMPLE_INTERVAL_SECONDS)
+from app.utils import write_json_atomic
+from app.logs.logger import get_logger
+
+logger = get_logger(__name__)
+
+# On-demand profiling is only possible when a token is configured
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN')
+
+
+class StackSampler(threading.Thread):
+    # Samples the stacks of every thread of the process at a fixed interval and counts them in the folded format
+    # flame graph tools read (flamegraph.pl, speedscope). The event loop thread also runs other requests, so its
+    # samples are not all attributable to the profiled one.
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL_SECONDS):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join([names.get(thread_id, str(thread_id))] + stack[::-1])] += 1
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.join()
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, requested: bool, flamegraph: bool):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.requested = requested
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.checkpoint_at = self.start
+        self.depth = 0
+        self.spans: List[Dict[str, Any]] = []
+        self.sampler = StackSampler() if flamegraph else None
+        if self.sampler:
+            self.sampler.start()
+
+    def add_span(self, name: str, start: float, end: float, depth: int, **attributes: Any) -> None:
+        self.spans.append({
+            "name": name,
+            "start_ms": round((start - self.start) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+            "depth": depth,
+            **attributes
+        })
+
+    def finish(self, status_code: Optional[int]) -> Dict[str, Any]:
+        duration = time.perf_counter() - self.start
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "started_at": self.started_at,
+            "duration_ms": round(duration * 1000, 3),
+            "trigger": "requested" if self.requested else "slow",
+            "spans": sorted(self.spans, key=lambda span: span["start_ms"]),
+            "flamegraph": self.sampler.stop() if self.sampler else None
+        }
+
+
+current_profile: ContextVar[Optional[RequestProfile]] = ContextVar('current_profile', default=None)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[None]:
+    # Times the enclosed block as part of the current request's profile, a no-op outside profiled requests
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    depth = profile.depth
+    profile.depth += 1
+    try:
+        yield
+    finally:
+        profile.depth -= 1
+        profile.add_span(name, start, time.perf_counter(), depth, **attributes)
+
+
+def checkpoint(name: str) -> None:
+    # Records the time since the previous checkpoint (or the start of the request) as a span. Called first thing
+    # in an endpoint, it covers reading and validating the request body.
+    profile = current_profile.get()
+    if profile is None:
+        return
+    now = time.perf_counter()
+    profile.add_span(name, profile.checkpoint_at, now, profile.depth)
+    profile.checkpoint_at = now
+
+
+def profile_file(profile_id: str) -> Optional[str]:
+    for name in os.listdir(PROFILE_RING_DIR) if os.path.isdir(PROFILE_RING_DIR) else []:
+        if name.endswith(f"-{profile_id}.json"):
+            return os.path.join(PROFILE_RING_DIR, name)
+    return None
+
+
+def save_profile(profile: Dict[str, Any]) -> None:
+    # File names start with the time in milliseconds, so the oldest profiles sort first. Every worker writes to
+    # the same directory.
+    name = f"{int(time.time() * 1000):015d}-{profile['id']}.json"
+    write_json_atomic(os.path.join(PROFILE_RING_DIR, name), profile)
+    names = sorted(name for name in os.listdir(PROFILE_RING_DIR) if name.endswith(".json"))
+    for name in names[:max(0, len(names) - PROFILE_RING_SIZE)]:
+        try:
+            os.remove(os.path.join(PROFILE_RING_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles(limit: int) -> List[Dict[str, Any]]:
+    if not os.path.isdir(PROFILE_RING_DIR):
+        return []
+    summaries = []
+    for name in sorted((name for name in os.listdir(PROFILE_RING_DIR) if name.endswith(".json")),
+                       reverse=True)[:limit]:
+        try:
+            with open(os.path.join(PROFILE_RING_DIR, name), 'r') as file:
+                profile = json.load(file)
+        except FileNotFoundError:
+            continue
+        summaries.append({key: profile[key] for key in
+                          ("id", "method", "path", "status_code", "started_at", "duration_ms", "trigger")})
+    return summaries
+
+
+def load_profile(profile_id: str) -> Optional[Dict[str, Any]]:
+    path = profile_file(profile_id)
+    if path is None:
+        return None
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def profiling_authorized(token: Optional[str]) -> bool:
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+
+def profiling_requested(headers: Dict[str, str], query_string: bytes) -> bool:
+    token = headers.get('x-profile') or parse_qs(query_string.decode('latin-1')).get('profile', [None])[0]
+    return profiling_authorized(token)
+
+
+class ProfilingMiddleware:
+    # Pure ASGI middleware, so the profile context variable is visible to the endpoint and everything it awaits
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope["headers"]}
+        requested = profiling_requested(headers, scope.get("query_string", b""))
+        if not requested and PROFILE_SLOW_REQUEST_SECONDS is None:
+            await self.app(scope, receive, send)
+            return
+
+        flamegraph = requested and headers.get('x-profile-flamegraph', '').lower() == 'true'
+        profile = RequestProfile(scope["method"], scope["path"], requested, flamegraph)
+        token = current_profile.set(profile)
+        status_code: Optional[int] = None
+
+        async def send_with_profile(message: Dict[str, Any]) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if requested:
+                    message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            current_profile.reset(token)
+            result = profile.finish(status_code)
+            slow = (PROFILE_SLOW_REQUEST_SECONDS is not None
+                    and result["duration_ms"] >= PROFILE_SLOW_REQUEST_SECONDS * 1000)
+            if requested or slow:
+                try:
+                    await asyncio.to_thread(save_profile, result)
+                    if not requested:
+                        logger.warning(f"Slow request {result['method']} {result['path']} took "
+                                       f"{result['duration_ms']} ms, profile {result['id']}")
+                except Exception as e:
+                    logger.error(f"Error saving profile {result['id']}: {e}", exc_info=True)
@@ -0,0 +1,59 @@
+from typing import Any, Dict, List, Sequence, Union
+import numpy as np
+
+Vectors = Union[np.ndarray, Sequence[Sequence[float]]]
+
+
+class Projection:
+    # Linear reduction of a collection's embeddings onto an orthonormal basis: the direction of the collection mean
+    # followed by its top principal components. Vectors are not centered, so cosine scores between projected
+    # vectors stay close to the full-dimension ones. Stored and query vectors go through the same projection.
+    def __init__(self, components: np.ndarray, explained_variance: float):
+        self.components = components.astype(np.float32)  # dimension x source dimension
+        self.explained_variance = explained_variance
+
+    @property
+    def dimension(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def source_dimension(self) -> int:
+        return self.components.shape[1]
+
+    def apply(self, vectors: Vectors) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32) @ self.components.T
+
+    def to_doc(self) -> Dict[str, Any]:
+        return {
+            "dimension": self.dimension,
+            "source_dimension": self.source_dimension,
+            "explained_variance": self.explained_variance,
+            "projection": {"components": self.components.tolist()}
+        }
+
+    @classmethod
+    def from_doc(cls, doc: Dict[str, Any]) -> 'Projection':
+        return cls(np.asarray(doc["projection"]["components"]), doc["explained_variance"])
+
+
+def fit_projection(vectors: Vectors, dimension: int) -> Projection:
+    matrix = np.asarray(vectors, dtype=np.float64)
+    if dimension >= min(matrix.shape):
+        raise ValueError(f"Cannot reduce {matrix.shape[0]} vectors of dimension {matrix.shape[1]} "
+                         f"to {dimension} dimensions")
+    mean = matrix.mean(axis=0)
+    _, singular_values, principal = np.linalg.svd(matrix - mean, full_matrices=False)
+    basis, _ = np.linalg.qr(np.vstack([mean, principal[:dimension - 1]]).T)
+    variance = singular_values ** 2
+    # Share of the variance around the mean kept by the principal components
+    return Projection(basis.T, float(variance[:dimension - 1].sum() / variance.sum()))
+
+
+def top_k_neighbours(vectors: np.ndarray, queries: List[int], k: int) -> np.ndarray:
+    # Indices of the k nearest rows by cosine similarity for each query row, the query row itself excluded
+    normalized = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scores = normalized[queries] @ normalized.T
+    scores[np.arange(len(queries)), queries] = -np.inf
+    top = np.argpartition(-scores, k, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
@@ -0,0 +1,152 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import orjson
+from app.config import (SIMILARITY_CACHE_MAX_ENTRIES, SIMILARITY_CACHE_MAX_BYTES, SIMILARITY_CACHE_TTL_SECONDS,
+                        ELASTIC_REFRESH_INTERVAL_SECONDS)
+from app.modules.admission import DeadlineExceeded, Overloaded
+from app.modules.generations import get_generation, seconds_since_bump
+from app.utils import normalize_query
+
+CacheKey = Tuple[str, str, int, str]
+Hits = List[Dict[str, Any]]
+
+
+class CacheEntry:
+    __slots__ = ("generation", "expires_at", "hits", "size")
+
+    def __init__(self, generation: int, expires_at: float, hits: Hits, size: int):
+        self.generation = generation
+        self.expires_at = expires_at
+        self.hits = hits
+        self.size = size
+
+
+class SimilarityCache:
+    # LRU cache of similarity hits per (collection, normalized text, top_n, filters). Entries are only valid for
+    # the collection generation they were computed at, and concurrent misses for the same key share one
+    # computation.
+    def __init__(self, max_entries: int = SIMILARITY_CACHE_MAX_ENTRIES, max_bytes: int = SIMILARITY_CACHE_MAX_BYTES,
+                 ttl_seconds: float = SIMILARITY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        self.in_flight: Dict[CacheKey, asyncio.Future] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(collection: str, text: str, top_n: int, filters: Optional[Dict[str, Any]] = None) -> CacheKey:
+        filters_key = orjson.dumps(filters, option=orjson.OPT_SORT_KEYS).decode() if filters else ""
+        return collection, normalize_query(text), top_n, filters_key
+
+    def _lookup(self, key: CacheKey, generation: int) -> Optional[Hits]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.generation != generation or entry.expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry.hits
+
+    def _store(self, key: CacheKey, generation: int, hits: Hits) -> None:
+        size = len(orjson.dumps(hits))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = CacheEntry(generation, time.monotonic() + self.ttl_seconds, hits, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+
+    async def get_many(self, collection: str, texts: List[str], top_n: int,
+                       compute: Callable[[List[str]], Awaitable[List[Optional[Hits]]]],
+                       filters: Optional[Dict[str, Any]] = None) -> List[Hits]:
+        # compute returns None for texts whose search failed, those are returned as empty and not cached
+        generation = get_generation(collection)
+        # Searches right after a write may not see it yet, so their results are returned but not cached
+        cacheable = seconds_since_bump(collection) > ELASTIC_REFRESH_INTERVAL_SECONDS
+        results: List[Optional[Hits]] = [None] * len(texts)
+        waiting: List[Tuple[int, asyncio.Future]] = []
+        owned: Dict[CacheKey, List[int]] = {}
+
+        for i, text in enumerate(texts):
+            key = self.make_key(collection, text, top_n, filters)
+            hits = self._lookup(key, generation)
+            if hits is not None:
+                self.hits += 1
+                results[i] = hits
+            elif key in owned:
+                owned[key].append(i)
+            elif key in self.in_flight:
+                self.coalesced += 1
+                waiting.append((i, self.in_flight[key]))
+            else:
+                self.misses += 1
+                owned[key] = [i]
+                self.in_flight[key] = asyncio.get_running_loop().create_future()
+
+        if owned:
+            keys = list(owned.keys())
+            try:
+                computed = await compute([texts[owned[key][0]] for key in keys])
+            except BaseException as e:
+                for key in keys:
+                    future = self.in_flight.pop(key)
+                    # Deadlines and admission are the owning request's own, waiters are not failed for them
+                    if isinstance(e, (asyncio.CancelledError, DeadlineExceeded, Overloaded)):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+                        # Mark the exception as retrieved, it is re-raised here and in every waiter
+                        future.exception()
+                raise
+            store = cacheable and get_generation(collection) == generation
+            for key, computed_hits in zip(keys, computed):
+                hits = computed_hits if computed_hits is not None else []
+                if store and computed_hits is not None:
+                    self._store(key, generation, hits)
+                self.in_flight.pop(key).set_result(hits)
+                for i in owned[key]:
+                    results[i] = hits
+
+        for i, future in waiting:
+            try:
+                # Shielded so that a cancelled waiter does not cancel the computation other requests wait on
+                results[i] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The request owning the computation went away or was shed, compute this text ourselves under this
+                # request's deadline and admission
+                results[i] = (await compute([texts[i]]))[0] or []
+        return results  # type: ignore
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "in_flight": len(self.in_flight)
+        }
+
+
+similarity_cache = SimilarityCache()
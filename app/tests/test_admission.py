@@ -0,0 +1,117 @@
+import asyncio
+import time
+import pytest
+from app.modules.admission import EmbeddingAdmission, Overloaded, DeadlineExceeded, request_deadline
+from app.modules.similarity_cache import SimilarityCache
+
+
+async def hold(admission: EmbeddingAdmission, release: asyncio.Event) -> None:
+    async with admission.slot():
+        await release.wait()
+
+
+async def wait_for_slot(admission: EmbeddingAdmission, timeout: float) -> None:
+    request_deadline.set(time.monotonic() + timeout)
+    async with admission.slot():
+        pass
+
+
+@pytest.mark.asyncio
+async def test_admission_queues_and_sheds_when_full():
+    admission = EmbeddingAdmission(max_concurrent=1, max_queued=1)
+    release = asyncio.Event()
+    request_deadline.set(time.monotonic() + 10)
+    holder = asyncio.create_task(hold(admission, release))
+    await asyncio.sleep(0)
+    queued = asyncio.create_task(wait_for_slot(admission, 10))
+    await asyncio.sleep(0)
+    assert admission.stats()["queued"] == 1
+
+    with pytest.raises(Overloaded):
+        await wait_for_slot(admission, 10)
+    assert admission.shed_queue_full == 1
+
+    release.set()
+    await asyncio.gather(holder, queued)
+    assert admission.stats()["active"] == 0
+    assert admission.stats()["queued"] == 0
+    assert admission.admitted == 2
+
+
+@pytest.mark.asyncio
+async def test_timed_out_waiters_leave_the_queue():
+    admission = EmbeddingAdmission(max_concurrent=1, max_queued=2)
+    release = asyncio.Event()
+    request_deadline.set(time.monotonic() + 10)
+    holder = asyncio.create_task(hold(admission, release))
+    await asyncio.sleep(0)
+
+    for _ in range(3):
+        with pytest.raises(DeadlineExceeded):
+            await wait_for_slot(admission, 0.01)
+    assert admission.shed_deadline == 3
+    assert admission.stats()["queued"] == 0
+
+    # The queue has room again for waiters that do get the slot
+    queued = [asyncio.create_task(wait_for_slot(admission, 10)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert admission.stats()["queued"] == 2
+    release.set()
+    await asyncio.gather(holder, *queued)
+    assert admission.stats()["active"] == 0
+    assert admission.shed_queue_full == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_the_queue():
+    admission = EmbeddingAdmission(max_concurrent=1, max_queued=1)
+    release = asyncio.Event()
+    request_deadline.set(time.monotonic() + 10)
+    holder = asyncio.create_task(hold(admission, release))
+    await asyncio.sleep(0)
+    queued = asyncio.create_task(wait_for_slot(admission, 10))
+    await asyncio.sleep(0)
+    queued.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await queued
+    assert admission.stats()["queued"] == 0
+
+    release.set()
+    await holder
+    assert admission.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_work_without_deadline_is_not_admission_controlled():
+    admission = EmbeddingAdmission(max_concurrent=1, max_queued=0)
+    request_deadline.set(None)
+    async with admission.slot():
+        async with admission.slot():
+            pass
+    assert admission.admitted == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesced_waiters_recompute_when_the_owner_is_shed():
+    cache = SimilarityCache()
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def shed(texts):
+        started.set()
+        await release.wait()
+        raise DeadlineExceeded()
+
+    async def compute(texts):
+        return [[{"id": text}] for text in texts]
+
+    owner = asyncio.create_task(cache.get_many("skills", ["python"], 1, shed))
+    await started.wait()
+    waiter = asyncio.create_task(cache.get_many("skills", ["python"], 1, compute))
+    await asyncio.sleep(0)
+    assert cache.coalesced == 1
+    release.set()
+
+    with pytest.raises(DeadlineExceeded):
+        await owner
+    assert await waiter == [[{"id": "python"}]]
@@ -42,6 +42,88 @@ def test_find_similar_records():
     json_response = response.json()
     assert "data" in json_response
     assert any(record["name"] == "Python" for record in json_response["data"])
+    assert all("vector" not in record for record in json_response["data"])
+
+
+def test_find_similar_records_top_n():
+    payload = {
+        "query": ["Python", "Sales"]
+    }
+    response = requests.post(url("collections/skills/similarities?top_n=5"), json=payload)
+    assert response.status_code == 200
+    records = response.json()["data"]
+    assert len(records) == 10
+    assert all(set(record.keys()) == {"id", "name", "description", "status", "score"} for record in records)
+
+
+def test_similarity_cache_metrics():
+    # Not a skill name, exact names are answered by the name index without going through the cache
+    payload = {
+        "query": ["Python programming language"]
+    }
+    requests.post(url("collections/skills/similarities?top_n=1"), json=payload)
+    before = requests.get(url("metrics")).json()["similarity_cache"]
+    response = requests.post(url("collections/skills/similarities?top_n=1"),
+                             json={"query": [" python  programming language "]})
+    assert response.status_code == 200
+    after = requests.get(url("metrics")).json()["similarity_cache"]
+    assert after["hits"] == before["hits"] + 1
+
+
+def test_find_similar_records_across_collections():
+    payload = {
+        "query": ["Python", "Sales"],
+        "collections": ["skills", "industries"]
+    }
+    response = requests.post(url("similarities?top_n=3"), json=payload)
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert set(data.keys()) == {"skills", "industries"}
+    for results in data.values():
+        assert [result["query"] for result in results] == ["Python", "Sales"]
+        assert all(len(result["records"]) == 3 for result in results)
+
+
+def test_exact_name_fast_path():
+    # Suggest waits for the name index to be built
+    requests.get(url("collections/skills/suggest"), params={"q": "python"})
+    before = requests.get(url("metrics")).json()["name_indices"]
+    response = requests.post(url("collections/skills/similarities?top_n=1"), json={"query": [" python "]})
+    assert response.status_code == 200
+    assert response.json()["data"][0]["name"] == "Python"
+    assert response.json()["data"][0]["score"] == 1.0
+    after = requests.get(url("metrics")).json()["name_indices"]
+    assert after["exact_hits"] == before["exact_hits"] + 1
+
+
+def test_suggest():
+    response = requests.get(url("collections/skills/suggest"), params={"q": "pyth", "top_k": 5})
+    assert response.status_code == 200
+    records = response.json()["data"]
+    assert 0 < len(records) <= 5
+    assert records[0]["name"].lower().startswith("pyth")
+    assert all(set(record.keys()) == {"id", "name"} for record in records)
+
+
+def test_migration_requires_token():
+    response = requests.post(url("collections/skills/migrations"),
+                             json={"model_name": "someone/untrusted-model", "model_revision": "main"})
+    assert response.status_code == 403
+
+
+def test_profiles_require_token():
+    assert requests.get(url("profiles")).status_code == 403
+    assert requests.get(url("profiles/some-profile"), headers={"X-Profiling-Token": "wrong"}).status_code == 403
+
+
+def test_duplicates():
+    response = requests.get(url("collections/skills/duplicates"), params={"threshold": 0.95})
+    assert response.status_code == 200
+    report = response.json()
+    assert report["records"] > 0
+    for cluster in report["clusters"]:
+        assert cluster["size"] == len(cluster["records"]) >= 2
+        assert cluster["min_score"] >= 0.95
 
 
 ID = "9999999"
@@ -0,0 +1,31 @@
+from app.db.change_capture import rewind_watermark
+from app.db.seed_elastic import seed_watermark
+
+SEEDED_AT = "2026-10-18T10:00:00+00:00"
+
+
+def test_watermark_of_the_current_seed_is_kept():
+    watermark = {"updated_at": "2026-10-18T12:00:00", "id": "42", "seeded_at": SEEDED_AT}
+    assert rewind_watermark(watermark, SEEDED_AT) is watermark
+
+
+def test_watermark_rewinds_to_a_new_seed():
+    watermark = {"updated_at": "2026-10-19T08:00:00", "id": "42", "seeded_at": SEEDED_AT}
+    reseeded_at = "2026-10-19T07:00:00+00:00"
+    assert rewind_watermark(watermark, reseeded_at) == {
+        "updated_at": seed_watermark(reseeded_at).isoformat(), "id": None, "seeded_at": reseeded_at}
+    assert seed_watermark(reseeded_at).isoformat() < "2026-10-19T07:00:00"
+
+
+def test_watermark_behind_a_new_seed_only_records_it():
+    watermark = {"updated_at": "2026-10-18T12:00:00", "id": "42", "seeded_at": SEEDED_AT}
+    reseeded_at = "2026-10-19T07:00:00+00:00"
+    assert rewind_watermark(watermark, reseeded_at) == {**watermark, "seeded_at": reseeded_at}
+
+
+def test_watermarks_without_a_seed_rewind_once():
+    watermark = {"updated_at": "2026-10-19T08:00:00", "id": "42"}
+    rewound = rewind_watermark(watermark, SEEDED_AT)
+    assert rewound["updated_at"] == seed_watermark(SEEDED_AT).isoformat() and rewound["id"] is None
+    assert rewind_watermark(rewound, SEEDED_AT) is rewound
+    assert rewind_watermark(watermark, None) is watermark
@@ -0,0 +1,77 @@
+from typing import Any, Callable, Dict, List
+import pytest
+from app.db import elastic
+from app.models.api import RecordCreateReplace
+
+ALIAS = "embeddings_skills"
+MODELS = {"embeddings_skills_1": "old-model", "embeddings_skills_2": "new-model"}
+
+
+class FakeIndices:
+    def __init__(self, client: "FakeClient"):
+        self.client = client
+
+    async def get_alias(self, name: str) -> Dict[str, Any]:
+        return {self.client.alias: {"aliases": {name: {}}}}
+
+    async def get_mapping(self, index: str) -> Dict[str, Any]:
+        index = self.client.alias if index == ALIAS else index
+        return {index: {"mappings": {"_meta": {"model_name": MODELS[index], "model_revision": "main"}}}}
+
+
+class FakeClient:
+    # Documents by index and id, ALIAS points to one of the indices
+    def __init__(self):
+        self.alias = "embeddings_skills_1"
+        self.docs: Dict[str, Dict[str, Dict[str, Any]]] = {index: {} for index in MODELS}
+        self.indices = FakeIndices(self)
+        self.after_index: Callable[[], None] = lambda: None
+
+    async def search(self, index: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        record_id = body["query"]["term"]["id"]
+        return {"hits": {"hits": [{"_id": record_id}] if record_id in self.docs[index] else []}}
+
+    async def index(self, index: str, document: Dict[str, Any], id: Any = None) -> Dict[str, Any]:
+        self.docs[index][document["id"]] = document
+        self.after_index()
+        return {"_id": document["id"]}
+
+
+@pytest.fixture
+def es(monkeypatch) -> elastic.Elastic:
+    async def get_embedding(texts: List[str], model_name: str, model_revision: str) -> List[List[float]]:
+        return [[1.0 if model_name == "old-model" else 2.0] for _ in texts]
+
+    monkeypatch.setattr(elastic, "get_embedding", get_embedding)
+    monkeypatch.setattr(elastic, "count_local_writes", lambda *args, **kwargs: None)
+    monkeypatch.setattr(elastic, "index_metas", {})
+    es = elastic.Elastic.__new__(elastic.Elastic)
+    es.client = FakeClient()  # type: ignore
+    return es
+
+
+def record(name: str) -> RecordCreateReplace:
+    return RecordCreateReplace(id="1", name=name, description=None, status=None, method="PUT")
+
+
+@pytest.mark.asyncio
+async def test_write_after_an_alias_swap_on_another_host_uses_the_new_index(es):
+    await es.create_replace_record(ALIAS, record("Python"))
+    # Switched elsewhere, this host's generation (and so its cached meta) has not changed yet
+    es.client.alias = "embeddings_skills_2"
+    await es.create_replace_record(ALIAS, record("Kotlin"))
+
+    assert es.client.docs["embeddings_skills_2"]["1"]["name"] == "Kotlin"
+    assert es.client.docs["embeddings_skills_2"]["1"]["vector"] == [2.0]
+
+
+@pytest.mark.asyncio
+async def test_write_is_repeated_when_the_alias_moves_during_it(es):
+    def switch() -> None:
+        es.client.alias = "embeddings_skills_2"
+
+    es.client.after_index = switch
+    await es.create_replace_record(ALIAS, record("Python"))
+
+    assert es.client.docs["embeddings_skills_1"]["1"]["vector"] == [1.0]
+    assert es.client.docs["embeddings_skills_2"]["1"]["vector"] == [2.0]
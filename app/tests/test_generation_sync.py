@@ -0,0 +1,58 @@
+from typing import Dict, List
+import pytest
+from app.db import generation_sync
+from app.modules import generations
+
+ALIAS = "embeddings_skills"
+
+
+@pytest.fixture
+def signatures(tmp_path, monkeypatch) -> Dict[str, generation_sync.Signature]:
+    shared = generations.SharedGenerations(str(tmp_path / "generations"), str(tmp_path / "generations.changes"))
+    monkeypatch.setattr(generations, "shared_generations", shared)
+    current = {ALIAS: ("embeddings_skills_1", 100, 10)}
+
+    async def read_signatures(es: object, aliases: List[str]) -> Dict[str, generation_sync.Signature]:
+        return dict(current)
+
+    monkeypatch.setattr(generation_sync, "read_signatures", read_signatures)
+    return current
+
+
+@pytest.mark.asyncio
+async def test_local_writes_keep_their_journaled_changes(signatures):
+    seen: Dict[str, generation_sync.Seen] = {}
+    await generation_sync.poll(None, [ALIAS], seen)
+    start = generations.get_generation(ALIAS)
+
+    # A /sync write of one record on this host: one index operation, journaled with its id
+    generations.count_local_writes(ALIAS, indexed=1)
+    generations.bump_generation(ALIAS, ["42"])
+    signatures[ALIAS] = ("embeddings_skills_1", 101, 10)
+    await generation_sync.poll(None, [ALIAS], seen)
+
+    assert generations.get_generation(ALIAS) == start + 1
+    assert generations.changed_records(ALIAS, start, generations.get_generation(ALIAS)) == {"42"}
+
+
+@pytest.mark.asyncio
+async def test_writes_of_other_replicas_bump_the_generation(signatures):
+    seen: Dict[str, generation_sync.Seen] = {}
+    await generation_sync.poll(None, [ALIAS], seen)
+    start = generations.get_generation(ALIAS)
+
+    generations.count_local_writes(ALIAS, indexed=1)
+    generations.bump_generation(ALIAS, ["42"])
+    # One more delete than this host made
+    signatures[ALIAS] = ("embeddings_skills_1", 101, 11)
+    await generation_sync.poll(None, [ALIAS], seen)
+    assert generations.get_generation(ALIAS) == start + 2
+    assert generations.changed_records(ALIAS, start, generations.get_generation(ALIAS)) is None
+
+    # Alias swaps always do
+    signatures[ALIAS] = ("embeddings_skills_2", 0, 0)
+    await generation_sync.poll(None, [ALIAS], seen)
+    assert generations.get_generation(ALIAS) == start + 3
+
+    await generation_sync.poll(None, [ALIAS], seen)
+    assert generations.get_generation(ALIAS) == start + 3
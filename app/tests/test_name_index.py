@@ -0,0 +1,32 @@
+from app.modules.name_index import NameIndex
+
+RECORDS = [{"id": "1", "name": "Python"}, {"id": "2", "name": "Python 3"}, {"id": "3", "name": "Data Python"},
+           {"id": "4", "name": "Pyramid"}, {"id": "5", "name": "CPython"}]
+
+
+def names(index: NameIndex, query: str, top_k: int = 5):
+    return [record["name"] for record in index.suggest(query, top_k)]
+
+
+def test_prefix_matches_rank_name_starts_first_and_shorter_names_first():
+    index = NameIndex(RECORDS, 1)
+    assert names(index, "py") == ["Python", "Pyramid", "Python 3", "Data Python"]
+    assert names(index, "PY", top_k=2) == ["Python", "Pyramid"]
+
+
+def test_fuzzy_matches_fill_up_with_shared_trigrams():
+    index = NameIndex(RECORDS, 1)
+    assert names(index, "pyton") == ["Python", "Python 3"]
+    assert names(index, "data pyth") == ["Data Python"]
+
+
+def test_changed_records_are_applied_in_place():
+    index = NameIndex(RECORDS, 1)
+    index.apply({"1", "4"}, [{"id": "1", "name": "Ruby"}], 2)
+    assert index.generation == 2
+    assert len(index) == 4
+    assert names(index, "py") == ["Python 3", "Data Python"]
+    assert names(index, "pyton") == ["Python 3"]
+    assert names(index, "ru") == ["Ruby"]
+    assert index.exact_matches(" RUBY ") == [{"id": "1", "name": "Ruby"}]
+    assert index.exact_matches("Python") == []
@@ -0,0 +1,29 @@
+import numpy as np
+from app.modules.near_duplicates import duplicate_clusters, similar_pairs
+
+RECORDS = [{"id": str(i), "name": name} for i, name in enumerate(["Python", "python", "Java", "Pyhton", "Rust"])]
+VECTORS = np.array([[1.0, 0.0, 0.0], [0.99, 0.14, 0.0], [0.0, 1.0, 0.0], [0.96, 0.28, 0.0], [0.0, 0.0, 1.0]])
+
+
+def test_similar_pairs_are_found_across_blocks():
+    for block_size in (1, 2, 5):
+        firsts, seconds, scores = similar_pairs(VECTORS, 0.95, 10, block_size)
+        assert sorted(zip(firsts.tolist(), seconds.tolist())) == [(0, 1), (0, 3), (1, 3)]
+        assert np.all(scores >= 0.95)
+
+
+def test_duplicate_clusters_group_connected_records():
+    clusters = duplicate_clusters(RECORDS, VECTORS, 0.95, 10, 2)
+    assert len(clusters) == 1
+    assert clusters[0]["size"] == 3
+    assert [record["name"] for record in clusters[0]["records"]] == ["Python", "python", "Pyhton"]
+    assert 0.95 <= clusters[0]["min_score"] < 0.97
+
+
+def test_clusters_are_transitive_and_ordered_by_size():
+    records = RECORDS + [{"id": "5", "name": "Rust lang"}]
+    # 0 - 1 - 3 form a chain at 0.97 where 0 and 3 alone are below it
+    vectors = np.vstack([VECTORS, [0.0, 0.1, 1.0]])
+    clusters = duplicate_clusters(records, vectors, 0.97, 1, 6)
+    assert [cluster["size"] for cluster in clusters] == [3, 2]
+    assert [record["id"] for record in clusters[1]["records"]] == ["4", "5"]
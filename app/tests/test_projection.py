@@ -0,0 +1,75 @@
+from typing import Any, Dict, List
+import numpy as np
+import pytest
+from app.config import VECTOR_DIMENSION
+from app.db import reduction
+from app.db.elastic import Elastic
+from app.models.api import RecordInDb
+from app.modules.projection import Projection, fit_projection
+
+
+def sample_vectors(rows: int = 50, dimension: int = 16) -> np.ndarray:
+    return np.random.default_rng(0).normal(size=(rows, dimension)).astype(np.float32) + 1.0
+
+
+def test_projection_basis_is_orthonormal():
+    vectors = sample_vectors()
+    projection = fit_projection(vectors, 4)
+    assert projection.components.shape == (4, 16)
+    np.testing.assert_allclose(projection.components @ projection.components.T, np.eye(4), atol=1e-5)
+    # The first direction is the collection mean
+    mean = vectors.mean(axis=0)
+    assert abs(projection.components[0] @ mean) == pytest.approx(np.linalg.norm(mean), rel=1e-4)
+    assert 0 < projection.explained_variance < 1
+
+
+def test_projection_round_trips_through_its_document():
+    vectors = sample_vectors()
+    projection = fit_projection(vectors, 4)
+    loaded = Projection.from_doc(projection.to_doc())
+    assert (loaded.dimension, loaded.source_dimension) == (4, 16)
+    assert loaded.apply(vectors).shape == (50, 4)
+    np.testing.assert_allclose(loaded.apply(vectors), projection.apply(vectors), atol=1e-6)
+
+
+def test_projection_needs_more_vectors_than_dimensions():
+    with pytest.raises(ValueError):
+        fit_projection(sample_vectors(rows=4), 4)
+
+
+class ProjectionStore:
+    def __init__(self):
+        self.saved: Dict[str, Dict[str, Any]] = {}
+
+    async def save_projection(self, projection_id: str, projection: Projection) -> None:
+        self.saved[projection_id] = projection.to_doc()
+
+    async def load_projection(self, projection_id: str) -> Projection:
+        return Projection.from_doc(self.saved[projection_id])
+
+
+@pytest.mark.asyncio
+async def test_reduced_index_meta_loads_the_projection_of_its_vectors(monkeypatch):
+    vectors = sample_vectors()
+    records = [RecordInDb(id=str(i), name=f"skill {i}") for i in range(len(vectors))]
+
+    async def embed_names(names: List[str]) -> np.ndarray:
+        return vectors[[int(name.split()[1]) for name in names]]
+
+    monkeypatch.setattr(reduction, "embed_names", embed_names)
+    monkeypatch.setattr(reduction, "VECTOR_REDUCTION_DIMENSIONS", {"skills": 4})
+    es = Elastic.__new__(Elastic)
+    store = ProjectionStore()
+    monkeypatch.setattr(es, "save_projection", store.save_projection)
+    monkeypatch.setattr(es, "load_projection", store.load_projection)
+
+    dimension, reduced, meta = await reduction.prepare_reduction(es, "embeddings_skills_1", "skills", records)
+    assert dimension == 4
+    assert meta == {"projection": "embeddings_skills_1"}
+    assert len(reduced) == len(records) and all(len(vector) == 4 for vector in reduced)
+    # seed_elastic stores meta in the new index's _meta, queries and writes are projected from there
+    projection = await es.get_projection(meta)
+    np.testing.assert_allclose(projection.apply(vectors), reduced, atol=1e-5)
+
+    assert await reduction.prepare_reduction(es, "embeddings_markets_1", "markets", records) == (
+        VECTOR_DIMENSION, None, {})
@@ -0,0 +1,124 @@
+from datetime import datetime
+from typing import Any, Dict, List
+import pytest
+from app.db import seed_elastic
+from app.models.api import RecordInDb
+
+OLD = datetime(2020, 1, 1)
+
+
+class FakeCrm:
+    def __init__(self, names: Dict[str, str]):
+        self.rows = {record_id: {"id": record_id, "name": name, "description": None, "status": None,
+                                 "updated_at": OLD} for record_id, name in names.items()}
+
+    def change(self, record_id: str, name: str) -> None:
+        self.rows[record_id] = {**self.rows.get(record_id, {"id": record_id, "description": None, "status": None}),
+                                "name": name, "updated_at": datetime.utcnow()}
+
+    async def query_table(self, table: str, col_names: List[str]) -> List[RecordInDb]:
+        return [seed_elastic.row_to_record(row, col_names) for row in self.rows.values()]
+
+    async def query_changes(self, table: str, col_names: List[str], updated_at_column: str, since: Any, last_id: Any,
+                            limit: int) -> List[Dict[str, Any]]:
+        rows = sorted(self.rows.values(), key=lambda row: (row["updated_at"], row["id"]))
+        return [row for row in rows if row["updated_at"] > since or
+                (row["updated_at"] == since and last_id is not None and row["id"] > last_id)][:limit]
+
+    async def query_ids(self, table: str, id_column: str) -> List[str]:
+        return list(self.rows)
+
+
+class FakeIndices:
+    def __init__(self, es: "FakeElastic"):
+        self.es = es
+
+    async def refresh(self, index: str) -> None:
+        pass
+
+    async def exists_alias(self, name: str) -> bool:
+        return name in self.es.aliases
+
+
+class FakeClient:
+    def __init__(self, es: "FakeElastic"):
+        self.es = es
+        self.indices = FakeIndices(es)
+
+    async def count(self, index: str) -> Dict[str, int]:
+        return {"count": len(self.es.docs(index))}
+
+    async def delete_by_query(self, index: str, body: Dict[str, Any], refresh: bool) -> Dict[str, int]:
+        deleted = [self.es.docs(index).pop(record_id, None) for record_id in body["query"]["terms"]["id"]]
+        return {"deleted": sum(name is not None for name in deleted)}
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeElastic:
+    # Indices of {id: name}, and aliases pointing at them
+    def __init__(self):
+        self.indices: Dict[str, Dict[str, str]] = {"embeddings_skills_old": {}}
+        self.aliases = {"embeddings_skills": "embeddings_skills_old"}
+        self.client = FakeClient(self)
+        self.during_populate = lambda: None
+
+    def docs(self, index: str) -> Dict[str, str]:
+        return self.indices[self.aliases.get(index, index)]
+
+    async def create_index(self, index_name: str, **kwargs: Any) -> None:
+        self.indices[index_name] = {}
+
+    async def populate_es(self, index_name: str, data: List[RecordInDb], **kwargs: Any) -> None:
+        self.during_populate()
+        self.docs(index_name).update({record.id: record.name for record in data})
+
+    async def bulk_upsert_records(self, index_name: str, records: List[RecordInDb]) -> int:
+        self.docs(index_name).update({record.id: record.name for record in records})
+        return len(records)
+
+    async def scan_records(self, index_name: str, fields: List[str]):
+        for record_id in list(self.docs(index_name)):
+            yield {"_source": {"id": record_id}}
+
+
+@pytest.mark.asyncio
+async def test_writes_during_a_reseed_survive_the_swap(monkeypatch):
+    crm = FakeCrm({"1": "Python", "2": "Java", "3": "Cobol"})
+    es = FakeElastic()
+    es.indices["embeddings_skills_old"] = {"1": "Python", "2": "Java", "3": "Cobol"}
+    bumps: List[set] = []
+
+    def sync_while_populating() -> None:
+        # /sync writes reach the index the alias still points to, and the CRM
+        crm.change("1", "Python 3")
+        crm.change("4", "Rust")
+        del crm.rows["3"]
+        es.docs("embeddings_skills").update({"1": "Python 3", "4": "Rust"})
+        es.docs("embeddings_skills").pop("3")
+
+    async def switch_alias(_, alias: str, temp_index: str) -> None:
+        # A write landing between the catch-up and the swap
+        crm.change("2", "Kotlin")
+        es.docs(alias)["2"] = "Kotlin"
+        es.aliases[alias] = temp_index
+
+    async def prepare_reduction(*args: Any) -> Any:
+        return 1024, None, {}
+
+    es.during_populate = sync_while_populating
+    monkeypatch.setattr(seed_elastic, "crm_db", crm)
+    monkeypatch.setattr(seed_elastic, "Elastic", lambda: es)
+    monkeypatch.setattr(seed_elastic, "CollectionManager", lambda: type(
+        "Collections", (), {"get_used_collections": lambda self: {"skills": "embeddings_skills"}})())
+    monkeypatch.setattr(seed_elastic, "switch_alias", switch_alias)
+    monkeypatch.setattr(seed_elastic, "prepare_reduction", prepare_reduction)
+    monkeypatch.setattr(seed_elastic, "bump_generation", lambda alias, ids=None: bumps.append(set(ids or ())))
+
+    await seed_elastic.seed_elastic()
+
+    assert es.aliases["embeddings_skills"] != "embeddings_skills_old"
+    assert es.docs("embeddings_skills") == {"1": "Python 3", "2": "Kotlin", "4": "Rust"}
+    # The swapped-in index changed after the swap, cached results of it are invalidated
+    assert len(bumps) == 1 and "2" in bumps[0]
@@ -0,0 +1,72 @@
+import asyncio
+from typing import Dict, List
+import pytest
+from app.modules import similarity_cache
+from app.modules.similarity_cache import SimilarityCache
+
+
+@pytest.fixture
+def generations(monkeypatch) -> Dict[str, int]:
+    current = {"skills": 1}
+    monkeypatch.setattr(similarity_cache, "get_generation", lambda collection: current[collection])
+    monkeypatch.setattr(similarity_cache, "seconds_since_bump", lambda collection: float('inf'))
+    return current
+
+
+class Search:
+    def __init__(self):
+        self.calls: List[List[str]] = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self, texts: List[str]):
+        self.calls.append(texts)
+        await self.release.wait()
+        return [[{"id": text}] for text in texts]
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_entries_are_evicted(generations):
+    cache = SimilarityCache(max_entries=2)
+    search = Search()
+    await cache.get_many("skills", ["python", "java"], 1, search)
+    await cache.get_many("skills", ["python"], 1, search)
+    await cache.get_many("skills", ["rust"], 1, search)
+    assert cache.evictions == 1
+
+    search.calls.clear()
+    await cache.get_many("skills", ["python", "rust", "java"], 1, search)
+    assert search.calls == [["java"]]
+
+
+@pytest.mark.asyncio
+async def test_entries_of_an_older_generation_are_not_served(generations):
+    cache = SimilarityCache()
+    search = Search()
+    await cache.get_many("skills", ["Python"], 1, search)
+    # Normalized like the key
+    assert await cache.get_many("skills", [" python "], 1, search) == [[{"id": "Python"}]]
+    assert cache.hits == 1
+
+    generations["skills"] = 2
+    await cache.get_many("skills", ["python"], 1, search)
+    assert search.calls == [["Python"], ["python"]]
+    assert cache.stats()["entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_search(generations):
+    cache = SimilarityCache()
+    search = Search()
+    search.release.clear()
+    first = asyncio.create_task(cache.get_many("skills", ["python"], 1, search))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(cache.get_many("skills", ["python", "python"], 1, search))
+    await asyncio.sleep(0)
+    search.release.set()
+
+    assert await first == [[{"id": "python"}]]
+    assert await second == [[{"id": "python"}], [{"id": "python"}]]
+    assert search.calls == [["python"]]
+    assert cache.coalesced == 2
+    assert cache.stats()["in_flight"] == 0
@@ -0,0 +1,83 @@
+import json
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+import numpy as np
+import pytest
+from app.config import MODEL_NAME, MODEL_REVISION
+from app.db import snapshot
+
+DOCS = [{"id": "1", "name": "Python", "description": None, "status": None, "vector": [1.0, 0.0]},
+        {"id": "2", "name": "Kotlin", "description": "JVM", "status": None, "vector": [0.0, 1.0]}]
+
+
+class FakeClient:
+    async def close(self) -> None:
+        pass
+
+
+class FakeElastic:
+    # Serves DOCS from every index and keeps what is imported by index
+    imported: Dict[str, List[Dict[str, Any]]] = {}
+
+    def __init__(self):
+        self.client = FakeClient()
+
+    async def scan_records(self, index_name: str, fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        for doc in DOCS:
+            yield {"_source": doc}
+
+    async def get_index_model(self, index_name: str):
+        return MODEL_NAME, MODEL_REVISION
+
+    async def get_cached_index_meta(self, index_name: str) -> Dict[str, Any]:
+        return {"seeded_at": "2026-01-01T00:00:00+00:00"}
+
+    async def get_index_projection(self, index_name: str) -> None:
+        return None
+
+    async def create_index(self, index_name: str, **kwargs: Any) -> None:
+        self.imported[index_name] = []
+
+    async def bulk_index(self, index_name: str, docs: Iterable[Dict[str, Any]]) -> int:
+        self.imported[index_name].extend(docs)
+        return len(self.imported[index_name])
+
+
+@pytest.fixture
+def embedded(monkeypatch) -> List[List[str]]:
+    calls: List[List[str]] = []
+
+    async def embed_names(names: List[str], model_name: str, revision: str) -> np.ndarray:
+        calls.append(names)
+        return np.full((len(names), 2), 0.5, dtype=np.float32)
+
+    monkeypatch.setattr(snapshot, "Elastic", FakeElastic)
+    monkeypatch.setattr(snapshot, "embed_names", embed_names)
+    FakeElastic.imported = {}
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_snapshot_round_trip(tmp_path, embedded):
+    manifest = await snapshot.export_snapshot(str(tmp_path), ["skills"])
+    assert manifest["collections"]["skills"]["count"] == 2
+
+    imported = await snapshot.import_snapshot(str(tmp_path), ["skills"], switch=False)
+    assert FakeElastic.imported[imported["skills"]] == DOCS
+    assert embedded == []
+
+
+@pytest.mark.asyncio
+async def test_import_embeds_records_changed_since_the_export_again(tmp_path, embedded):
+    await snapshot.export_snapshot(str(tmp_path), ["skills"])
+    path = snapshot.records_path(str(tmp_path), "skills")
+    with open(path) as file:
+        records = [json.loads(line) for line in file]
+    records[1]["name"] = "Kotlin Multiplatform"
+    with open(path, "w") as file:
+        file.writelines(json.dumps(record) + "\n" for record in records)
+
+    imported = await snapshot.import_snapshot(str(tmp_path), ["skills"], switch=False)
+    docs = FakeElastic.imported[imported["skills"]]
+    assert embedded == [["Kotlin Multiplatform"]]
+    assert docs[0]["vector"] == [1.0, 0.0]
+    assert docs[1] == {**DOCS[1], "name": "Kotlin Multiplatform", "vector": [0.5, 0.5]}
@@ -1,8 +1,66 @@
+import fcntl
+import json
+import os
+import re
 import subprocess
+import unicodedata
+from typing import Any, Optional
+import orjson
 from fastapi import HTTPException
+from fastapi.responses import Response
+
+
+class JSONBytesResponse(Response):
+    # Serializes plain dicts/lists with orjson, bypassing response_model validation
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+# Written to a temporary file first so readers and crashes never see a truncated file
+def write_json_atomic(path: str, data: Any) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_file = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_file, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_file, path)
+
+
+# Exclusive lock held for as long as the returned descriptor stays open, None if another process holds it. Each
+# caller opens the file itself, flock does not exclude processes sharing one open file (e.g. inherited by fork).
+def try_lock_file(path: str) -> Optional[int]:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
 
 
 def read_logs_once(n: int) -> str:
     with open('app/logs/app.log', 'r') as file:
         lines = file.readlines()
     return ''.join(lines[-n:])  # Return the last 'n' lines
+
+
+# gte-large-en-v1.5 lowercases its input, so case and surrounding/repeated whitespace do not change the embedding
+def normalize_query(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+NAME_SEPARATORS = re.compile(r"[^\w+#&]+")
+
+
+# Names that differ only in case, accents, whitespace or punctuation are the same name. '+', '#' and '&' are kept
+# so that C, C++ and C# stay distinct.
+def normalize_name(name: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(NAME_SEPARATORS.sub(" ", stripped.casefold()).replace("_", " ").split())
@@ -0,0 +1,41 @@
+import gc
+import os
+
+# Production serving: gunicorn -c gunicorn.conf.py app.main:app
+#
+# The app (and with it the gte-large weights) is imported once in the master before forking, so the workers
+# share the weight pages copy-on-write instead of loading ~1.7 GB each. Every worker then limits torch to
+# TORCH_THREADS, at most its share of CPU_BUDGET cores, N workers x all cores would oversubscribe the CPU.
+#
+#   CPU_BUDGET              cores the service may use in total (default: all cores of the machine)
+#   TORCH_THREADS           intra-op threads per worker (default: 4), lowered to fit workers x threads
+#                           into CPU_BUDGET
+#   WEB_CONCURRENCY         workers (default: CPU_BUDGET // TORCH_THREADS)
+
+# Tokenizer threads started in the master do not survive the fork
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+cpu_budget = int(os.getenv("CPU_BUDGET", os.cpu_count() or 1))
+torch_threads = int(os.getenv("TORCH_THREADS", min(4, cpu_budget)))
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", max(1, cpu_budget // torch_threads)))
+preload_app = True
+worker_threads = max(1, min(torch_threads, cpu_budget // workers))
+# A cold worker can take a while to answer its first request
+timeout = 120
+graceful_timeout = 30
+
+
+def when_ready(server):
+    # Everything allocated while preloading is moved out of the garbage collector's reach, otherwise the first
+    # collection in each worker touches those objects and un-shares their pages
+    gc.freeze()
+    server.log.info(f"Serving with {workers} workers x {worker_threads} torch threads "
+                    f"(CPU budget {cpu_budget})")
+
+
+def post_fork(server, worker):
+    from app.modules.embedding_model import configure_threads
+    configure_threads(worker_threads)
@@ -3,13 +3,15 @@
 # Wait for DB to start
 sleep 5
 
-# Conditionally seed Elastic
-if [ "$RUN_TESTS" != "true" ]; then
-  python -m app.db.seed_elastic
-fi
+# Elastic is reseeded in the background once the API is up (see app/db/reseed.py)
 
-# Run FastAPI application with Uvicorn on port 8000
-uvicorn app.main:app --host 0.0.0.0 --port 8000 --reload
+# Run FastAPI application on port 8000: preloaded gunicorn workers in production (see gunicorn.conf.py),
+# a single reloading Uvicorn process otherwise
+if [ "$SERVING_MODE" = "production" ]; then
+  gunicorn -c gunicorn.conf.py app.main:app
+else
+  uvicorn app.main:app --host 0.0.0.0 --port 8000 --reload
+fi
 
 # Run the command provided by the Dockerfile
 exec "$@"